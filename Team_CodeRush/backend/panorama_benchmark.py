@@ -0,0 +1,339 @@
+"""
+Benchmark harness for panorama_service.
+
+Generates synthetic equirectangular, fisheye and cubemap inputs, times the
+decode / preprocess / convert / encode stages separately (plus peak memory:
+allocations traced by tracemalloc, which sees NumPy buffers but not Pillow's or
+numba's, and the process's peak RSS), and drives the Flask routes through the test client with concurrent
+requests. Results are emitted as JSON so runs can be compared.
+
+Usage:
+    python panorama_benchmark.py --widths 2048,4096 --output bench.json
+    python panorama_benchmark.py --widths 2048,4096 --compare bench.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import panorama_service as ps
+
+SCENARIOS = ['equirect', 'fisheye', 'cubemap']
+ROUTES = ['/convert', '/stitch']
+
+def synthetic_image(width, height, seed=0):
+    """Smooth gradients plus noise, so JPEG sizes and resampling cost look like real photos"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        127 + 100 * np.sin(x / max(width, 1) * 6.28 * 3),
+        127 + 100 * np.cos(y / max(height, 1) * 6.28 * 2),
+        127 + 60 * np.sin((x + y) / max(width, 1) * 6.28 * 5)
+    ], axis=-1)
+    base += rng.normal(0, 12, base.shape).astype(np.float32)
+    return Image.fromarray(np.clip(base, 0, 255).astype(np.uint8))
+
+def jpeg_bytes(image, quality=92):
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def unique_bytes(data, index):
+    """Bytes after the JPEG EOI marker are ignored by decoders but defeat the content-hash dedup"""
+    return data + f'bench-{index}-{time.time_ns()}'.encode()
+
+def make_inputs(scenario, output_width, input_scale):
+    """Encoded synthetic input(s) sized relative to the output width"""
+    if scenario == 'equirect':
+        width = int(output_width * input_scale)
+        return [jpeg_bytes(synthetic_image(width, width // 2))]
+    if scenario == 'fisheye':
+        size = int(output_width * input_scale / 2)
+        image = np.asarray(synthetic_image(size, size)).copy()
+        y, x = np.ogrid[0:size, 0:size]
+        image[np.hypot(x + 0.5 - size / 2, y + 0.5 - size / 2) >= size / 2] = 0  # Circular, black corners
+        return [jpeg_bytes(Image.fromarray(image))]
+    if scenario == 'cubemap':
+        face = int(output_width * input_scale / 4 / 0.80)
+        return [jpeg_bytes(synthetic_image(face, face, seed=i)) for i in range(6)]
+    raise ValueError(f'Unknown scenario {scenario}')
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'min': round(ordered[0], 5),
+        'median': round(statistics.median(ordered), 5),
+        'mean': round(statistics.fmean(ordered), 5),
+        'max': round(ordered[-1], 5),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 5)
+    }
+
+def run_pipeline(scenario, inputs, output_width, presets, blend=False):
+    """One pass through the same stages the routes run, returning per-stage seconds and encoded sizes"""
+    timings = {}
+    sizes = {}
+
+    start = time.perf_counter()
+    if scenario == 'cubemap':
+        min_size = ps.stitch_face_source_size(output_width)
+        images = [ps.open_upload_image(io.BytesIO(data), min_size) for data in inputs]
+    else:
+        image = ps.open_upload_image(io.BytesIO(inputs[0]), ps.equirect_source_size(output_width))
+    timings['decode'] = time.perf_counter() - start
+
+    if scenario == 'cubemap':
+        start = time.perf_counter()
+        faces = dict(zip(ps.CUBEMAP_FACES, images))
+        target_size = min(img.width for img in images)
+        padded = ps.preprocess_cube_faces(faces, target_size, fov_correction=0.80)
+        timings['preprocess'] = time.perf_counter() - start
+
+        if blend:
+            start = time.perf_counter()
+            ps.blend_cube_seams(padded)
+            timings['blend'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        equirect = ps.padded_cubemap_to_equirect(padded, output_width // 2, output_width)
+        result = Image.fromarray(equirect)
+        timings['convert'] = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        result = ps.convert_image_to_equirect(image, output_width)
+        timings['convert'] = time.perf_counter() - start
+
+    for name in presets:
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        sizes[name] = ps.encode_image(result, buffer, ps.get_encoder(name))
+        timings[f'encode:{name}'] = time.perf_counter() - start
+
+    return timings, sizes
+
+def max_rss_bytes():
+    """Peak resident set size of this process so far (None where the resource module is missing)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Linux reports KiB
+
+def bench_stages(scenario, output_width, repeat, presets, input_scale, blend=False):
+    inputs = make_inputs(scenario, output_width, input_scale)
+
+    # First pass runs with an empty remap cache so the grid build cost shows up separately
+    ps.remap_cache.clear()
+    cold, sizes = run_pipeline(scenario, inputs, output_width, presets, blend)
+
+    samples = {}
+    for _ in range(repeat):
+        timings, sizes = run_pipeline(scenario, inputs, output_width, presets, blend)
+        for stage, seconds in timings.items():
+            samples.setdefault(stage, []).append(seconds)
+
+    # Separate pass for memory: tracemalloc slows allocation, so keep it out of the timings
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    run_pipeline(scenario, inputs, output_width, presets, blend)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'scenario': scenario,
+        'outputWidth': output_width,
+        'inputBytes': sum(len(data) for data in inputs),
+        'coldConvertSeconds': round(cold['convert'], 5),
+        'stages': {stage: summarize(values) for stage, values in samples.items()},
+        'peakTracedBytes': peak,
+        # High-water mark of the whole process, so it never drops from one scenario to the next
+        'maxRssBytes': max_rss_bytes(),
+        'encodedBytes': sizes
+    }
+
+def route_request(route, inputs, output_width, index):
+    """Send one request through a fresh test client, returning (seconds, status code)"""
+    client = ps.app.test_client()
+    if route == '/stitch':
+        data = {
+            face: (io.BytesIO(unique_bytes(face_data, index)), f'{face}.jpg')
+            for face, face_data in zip(ps.CUBEMAP_FACES, inputs)
+        }
+    else:
+        data = {'file': (io.BytesIO(unique_bytes(inputs[0], index)), 'bench.jpg')}
+    data['width'] = str(output_width)
+
+    start = time.perf_counter()
+    response = client.post(route, data=data, content_type='multipart/form-data')
+    response.get_data()
+    return time.perf_counter() - start, response.status_code
+
+def bench_route(route, output_width, concurrency, requests, input_scale):
+    scenario = 'cubemap' if route == '/stitch' else 'fisheye'
+    inputs = make_inputs(scenario, output_width, input_scale)
+
+    # Warm the remap cache so we measure steady state, not the first grid build
+    route_request(route, inputs, output_width, -1)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(
+            lambda i: route_request(route, inputs, output_width, i), range(requests)
+        ))
+    wall = time.perf_counter() - start
+
+    latencies = [seconds for seconds, status in results if status == 200]
+    return {
+        'route': route,
+        'outputWidth': output_width,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(1 for _, status in results if status != 200),
+        'latency': summarize(latencies) if latencies else None,
+        'throughputPerSecond': round(len(latencies) / wall, 3)
+    }
+
+def compare(results, baseline, threshold):
+    """List metrics that got slower than baseline by more than threshold (ratio)"""
+    regressions = []
+
+    baseline_stages = {(r['scenario'], r['outputWidth']): r for r in baseline.get('stages', [])}
+    for run in results.get('stages', []):
+        base = baseline_stages.get((run['scenario'], run['outputWidth']))
+        if not base:
+            continue
+        for stage, summary in run['stages'].items():
+            if stage not in base['stages']:
+                continue
+            ratio = summary['median'] / max(base['stages'][stage]['median'], 1e-9)
+            if ratio > threshold:
+                regressions.append({
+                    'metric': f"stage {run['scenario']}@{run['outputWidth']} {stage} median",
+                    'baseline': base['stages'][stage]['median'],
+                    'current': summary['median'],
+                    'ratio': round(ratio, 3)
+                })
+
+    baseline_routes = {(r['route'], r['outputWidth'], r['concurrency']): r for r in baseline.get('routes', [])}
+    for run in results.get('routes', []):
+        base = baseline_routes.get((run['route'], run['outputWidth'], run['concurrency']))
+        if not base or not base['latency'] or not run['latency']:
+            continue
+        ratio = run['latency']['p95'] / max(base['latency']['p95'], 1e-9)
+        if ratio > threshold:
+            regressions.append({
+                'metric': f"route {run['route']}@{run['outputWidth']} x{run['concurrency']} p95",
+                'baseline': base['latency']['p95'],
+                'current': run['latency']['p95'],
+                'ratio': round(ratio, 3)
+            })
+
+    return regressions
+
+def parse_list(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+def run_benchmarks(args, widths, presets):
+    """Stage and route results for every width, scenario and route in args"""
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pillow': Image.__version__,
+            'cpuCount': os.cpu_count(),
+            'samplerThreads': ps.SAMPLER_THREADS,
+            'samplerBackend': ps.SAMPLER_BACKEND,
+            'args': vars(args)
+        },
+        'stages': [],
+        'routes': []
+    }
+
+    for width in widths:
+        for scenario in parse_list(args.scenarios):
+            print(f'stages {scenario} @ {width}...', file=sys.stderr)
+            results['stages'].append(
+                bench_stages(scenario, width, args.repeat, presets, args.input_scale, args.blend)
+            )
+
+    for width in widths:
+        for route in parse_list(args.routes):
+            for concurrency in parse_list(args.concurrency, int):
+                print(f'route {route} @ {width} x{concurrency}...', file=sys.stderr)
+                results['routes'].append(
+                    bench_route(route, width, concurrency, args.requests, args.input_scale)
+                )
+
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the panorama conversion pipeline')
+    parser.add_argument('--widths', default='2048,4096', help='Output widths, comma separated')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Stage scenarios to run')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed passes per stage scenario')
+    parser.add_argument('--presets', default='jpeg,jpeg-fast', help='Encoder presets to time')
+    parser.add_argument('--input-scale', type=float, default=1.5, help='Input size relative to the output')
+    parser.add_argument('--blend', action='store_true', help='Include seam blending in the cubemap scenario')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='Routes to load test ("" to skip)')
+    parser.add_argument('--concurrency', default='1,4', help='Concurrent clients per route run')
+    parser.add_argument('--requests', type=int, default=8, help='Requests per route run')
+    parser.add_argument('--output', help='Write JSON here instead of stdout')
+    parser.add_argument('--compare', help='Baseline JSON from an earlier run')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio that counts as a regression')
+    args = parser.parse_args(argv)
+
+    widths = parse_list(args.widths, int)
+    presets = parse_list(args.presets)
+    for name in presets:
+        ps.get_encoder(name)  # Fail fast on unknown or unsupported presets
+
+    # Keep benchmark outputs away from the real OUTPUT_FOLDER, and remove them afterwards
+    folders = (ps.OUTPUT_FOLDER, ps.TILES_FOLDER)
+    workdir = tempfile.mkdtemp(prefix='panorama-bench-')
+    try:
+        ps.OUTPUT_FOLDER = workdir
+        ps.TILES_FOLDER = os.path.join(workdir, 'tiles')
+        os.makedirs(ps.TILES_FOLDER, exist_ok=True)
+        results = run_benchmarks(args, widths, presets)
+    finally:
+        ps.OUTPUT_FOLDER, ps.TILES_FOLDER = folders
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        results['regressions'] = compare(results, baseline, args.threshold)
+        if results['regressions']:
+            exit_code = 1
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    for regression in results.get('regressions', []):
+        print(f"REGRESSION {regression['metric']}: {regression['baseline']} -> "
+              f"{regression['current']} ({regression['ratio']}x)", file=sys.stderr)
+
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
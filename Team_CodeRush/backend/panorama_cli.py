@@ -0,0 +1,290 @@
+"""
+Offline bulk conversion for panorama_service.
+
+Walks an input directory and writes one equirectangular output per panorama,
+mirroring the directory layout under the output directory:
+  - every image file is converted with convert_to_equirectangular
+  - every directory holding front/back/left/right/top/bottom images is stitched
+    into <dir>.<ext> (those face files are not converted on their own)
+Inputs that would write the same output (pano.jpg and pano.png) are reported as
+failed instead of overwriting each other; rename one of them.
+
+Each finished item is appended to a state file in the output directory, keyed by
+the input's size/mtime and the output settings. Re-running skips items that are
+already up to date, so an interrupted run resumes where it stopped, and changing
+--width, --preset, --quality or --blend re-renders everything.
+
+Usage:
+    python panorama_cli.py archive/ rendered/ --width 4096 --workers 8
+    python panorama_cli.py archive/ rendered/ --width 8192 --preset webp --quality 80
+    python panorama_cli.py shoots/ rendered/ --blend
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import panorama_service as ps
+
+STATE_FILENAME = '.panorama-cli-state.jsonl'
+
+def build_encoder(preset, quality=None):
+    """Encoder preset, optionally with its quality overridden (part of the settings key)"""
+    encoder = ps.get_encoder(preset)
+    if quality is None:
+        return encoder
+    if 'quality' not in encoder.options:
+        raise ValueError(f'Preset "{encoder.name}" has no quality setting')
+    return ps.EncoderPreset(encoder.name, encoder.pil_format, encoder.mimetype, encoder.extension,
+                            dict(encoder.options, quality=quality))
+
+def find_faces(filenames):
+    """Face name -> filename when a directory holds all six cubemap faces, else None"""
+    faces = {}
+    for filename in filenames:
+        stem = os.path.splitext(filename)[0].lower()
+        if stem in ps.CUBEMAP_FACES and ps.allowed_file(filename):
+            faces[stem] = filename
+    return faces if len(faces) == len(ps.CUBEMAP_FACES) else None
+
+def discover(input_dir, output_dir, extension):
+    """Yield work items (kind, key, sources, output) in a stable order"""
+    input_dir = os.path.abspath(input_dir)
+    output_dir = os.path.abspath(output_dir)
+
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        # Never walk into our own outputs when they live inside the input tree
+        dirnames[:] = sorted(d for d in dirnames
+                             if not d.startswith('.') and os.path.join(dirpath, d) != output_dir)
+        rel_dir = os.path.relpath(dirpath, input_dir)
+
+        face_files = set()
+        faces = find_faces(filenames)
+        if faces:
+            name = os.path.basename(input_dir) if rel_dir == '.' else rel_dir
+            face_files = set(faces.values())
+            yield {
+                'kind': 'stitch',
+                'key': os.path.join(rel_dir, ''),
+                'sources': [os.path.join(dirpath, faces[face]) for face in ps.CUBEMAP_FACES],
+                'output': f'{name}.{extension}'
+            }
+
+        for filename in sorted(filenames):
+            if filename in face_files or filename.startswith('.') or not ps.allowed_file(filename):
+                continue
+            rel = os.path.normpath(os.path.join(rel_dir, filename))
+            yield {
+                'kind': 'convert',
+                'key': rel,
+                'sources': [os.path.join(dirpath, filename)],
+                'output': f'{os.path.splitext(rel)[0]}.{extension}'
+            }
+
+def signature(sources):
+    """Cheap change detection: size + mtime of every input file"""
+    parts = []
+    for path in sources:
+        st = os.stat(path)
+        parts.append(f'{st.st_size}:{st.st_mtime_ns}')
+    return ','.join(parts)
+
+def load_state(state_path):
+    """Last record per key from the append-only state file (a torn last line is ignored)"""
+    records = {}
+    if not os.path.exists(state_path):
+        return records
+    with open(state_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['key']] = record
+    return records
+
+def process_item(kind, sources, output_path, output_width, encoder, blend=False):
+    """Worker-process entry point: convert or stitch one item, returns (seconds, output bytes)"""
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    if kind == 'stitch':
+        min_size = ps.stitch_face_source_size(output_width)
+        faces = {face: ps.open_image(path, min_size) for face, path in zip(ps.CUBEMAP_FACES, sources)}
+        equirect_image = ps.stitch_faces(faces, output_width, ps.use_low_memory(output_width), blend)
+        ps.save_panorama(equirect_image, output_path, encoder)
+    else:
+        success, error = ps.convert_to_equirectangular(sources[0], output_path, output_width, encoder)
+        if not success:
+            raise RuntimeError(error)
+
+    return time.perf_counter() - start, os.path.getsize(output_path)
+
+class Progress:
+    """Running counters plus a throttled one-line progress report on stderr"""
+    def __init__(self, total, output_width, interval):
+        self.total = total
+        self.pixels = output_width * (output_width // 2)
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.converted = 0
+        self.failed = 0
+        self.output_bytes = 0
+        self.work_seconds = 0.0
+
+    def record(self, seconds=None, nbytes=0):
+        if seconds is None:
+            self.failed += 1
+            return
+        self.converted += 1
+        self.output_bytes += nbytes
+        self.work_seconds += seconds
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        finished = self.converted + self.failed
+        rate = self.converted / elapsed if elapsed else 0.0
+        return {
+            'total': self.total,
+            'converted': self.converted,
+            'failed': self.failed,
+            'remaining': self.total - finished,
+            'elapsedSeconds': round(elapsed, 2),
+            'itemsPerSecond': round(rate, 3),
+            'megapixelsPerSecond': round(rate * self.pixels / 1e6, 2),
+            'meanItemSeconds': round(self.work_seconds / self.converted, 3) if self.converted else None,
+            'outputBytes': self.output_bytes,
+            'etaSeconds': round((self.total - finished) / rate) if rate else None
+        }
+
+    def maybe_report(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        s = self.summary()
+        eta = f"{s['etaSeconds']}s" if s['etaSeconds'] is not None else '?'
+        print(f"[{s['converted'] + s['failed']}/{s['total']}] {s['itemsPerSecond']} items/s, "
+              f"{s['megapixelsPerSecond']} MP/s, {s['failed']} failed, ETA {eta}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert or stitch every panorama under a directory')
+    parser.add_argument('input_dir', help='Directory tree to read panoramas from')
+    parser.add_argument('output_dir', help='Directory to write outputs (and the resume state) to')
+    parser.add_argument('--width', type=int, default=4096, help='Output width (height is width/2)')
+    parser.add_argument('--preset', default=ps.DEFAULT_ENCODER, help='Encoder preset (see /encoders)')
+    parser.add_argument('--quality', type=int, help='Override the preset quality')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+    parser.add_argument('--blend', action='store_true', help='Even out exposure and seams when stitching faces')
+    parser.add_argument('--force', action='store_true', help='Re-render even when outputs are up to date')
+    parser.add_argument('--progress-interval', type=float, default=10, help='Seconds between progress lines')
+    parser.add_argument('--json', action='store_true', help='Print the final stats as JSON on stdout')
+    args = parser.parse_args(argv)
+
+    try:
+        encoder = build_encoder(args.preset, args.quality)
+    except ValueError as e:
+        parser.error(str(e))
+    output_width = min(args.width, 8192)  # Max 8K, same as the HTTP routes
+    settings = f'{output_width}:{encoder.cache_key}'
+    if args.blend:
+        settings += ':blend'
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    state_path = os.path.join(args.output_dir, STATE_FILENAME)
+    state = {} if args.force else load_state(state_path)
+
+    # Step 1: find the work, skipping items whose output is already up to date. Inputs that
+    # map to the same output (pano.jpg and pano.png, or a shoot directory and a <dir>.jpg
+    # beside it) would overwrite each other, so none of them is rendered
+    items = list(discover(args.input_dir, args.output_dir, encoder.extension))
+    writers = {}
+    for item in items:
+        writers.setdefault(os.path.normcase(item['output']), []).append(item['key'])
+    todo = []
+    conflicts = []
+    skipped = 0
+    for item in items:
+        item['signature'] = signature(item['sources'])
+        others = [key for key in writers[os.path.normcase(item['output'])] if key != item['key']]
+        if others:
+            item['error'] = f"Output {item['output']} is also written by {', '.join(others)}"
+            conflicts.append(item)
+            continue
+        record = state.get(item['key'])
+        if (record and record.get('status') == 'done' and record.get('signature') == item['signature']
+                and record.get('settings') == settings
+                and os.path.exists(os.path.join(args.output_dir, item['output']))):
+            skipped += 1
+            continue
+        todo.append(item)
+    print(f'{len(todo)} to render, {skipped} up to date, {len(conflicts)} conflicting', file=sys.stderr)
+
+    # Step 2: render with a bounded number of items in flight, recording each one as it finishes
+    progress = Progress(len(todo) + len(conflicts), output_width, args.progress_interval)
+    pending = {}
+    items = iter(todo)
+    interrupted = False
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=ps.job_process_context(),
+                               initializer=ps._init_job_worker)
+    try:
+        with open(state_path, 'a') as state_file:
+            def fill():
+                while len(pending) < args.workers * 2:
+                    item = next(items, None)
+                    if item is None:
+                        return
+                    output_path = os.path.join(args.output_dir, item['output'])
+                    future = pool.submit(process_item, item['kind'], item['sources'], output_path,
+                                         output_width, encoder, args.blend)
+                    pending[future] = item
+
+            for item in conflicts:
+                record = {'key': item['key'], 'signature': item['signature'], 'settings': settings,
+                          'output': item['output'], 'finishedAt': time.time(),
+                          'status': 'failed', 'error': item['error']}
+                progress.record()
+                print(f"FAILED {item['key']}: {item['error']}", file=sys.stderr)
+                state_file.write(json.dumps(record) + '\n')
+            state_file.flush()
+
+            fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item = pending.pop(future)
+                    record = {'key': item['key'], 'signature': item['signature'], 'settings': settings,
+                              'output': item['output'], 'finishedAt': time.time()}
+                    try:
+                        seconds, nbytes = future.result()
+                        record.update({'status': 'done', 'seconds': round(seconds, 3), 'bytes': nbytes})
+                        progress.record(seconds, nbytes)
+                    except Exception as e:
+                        record.update({'status': 'failed', 'error': str(e)})
+                        progress.record()
+                        print(f"FAILED {item['key']}: {e}", file=sys.stderr)
+                    state_file.write(json.dumps(record) + '\n')
+                    state_file.flush()
+                fill()
+                progress.maybe_report()
+    except KeyboardInterrupt:
+        interrupted = True
+        print('Interrupted, finished items are recorded; re-run to resume', file=sys.stderr)
+    finally:
+        pool.shutdown(wait=not interrupted, cancel_futures=True)
+
+    progress.maybe_report(force=True)
+    stats = progress.summary()
+    stats['skipped'] = skipped
+    if args.json:
+        print(json.dumps(stats, indent=2))
+
+    if interrupted:
+        return 130
+    return 1 if progress.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
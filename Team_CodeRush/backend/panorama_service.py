@@ -1,12 +1,37 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, request, jsonify, send_file, Response, g, has_request_context
 from flask_cors import CORS
 from PIL import Image
 import py360convert
 import numpy as np
+import atexit
 import io
 import os
+import hashlib
+import json
+import math
+import multiprocessing
+import re
+import shutil
+import sqlite3
+import threading
+import queue
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.utils import secure_filename
+import tempfile
 import uuid
+import zipfile
+from urllib.parse import urlencode
+
+try:
+    import numba
+except ImportError:  # Optional: JIT-compiled bilinear sampler, the NumPy one is used without it
+    numba = None
 
 # Fix for NumPy 1.20+ compatibility
 if not hasattr(np, 'bool'):
@@ -22,182 +47,3454 @@ if not hasattr(np, 'object'):
 if not hasattr(np, 'str'):
     np.str = str
 
-app = Flask(__name__)
-CORS(app)
+app = Flask(__name__)
+CORS(app)
+
+UPLOAD_FOLDER = 'uploads/panoramas'
+OUTPUT_FOLDER = 'outputs'
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+JPEG_QUALITY = 95
+STREAM_QUEUE_CHUNKS = 16
+CUBEMAP_FACES = ['front', 'back', 'left', 'right', 'top', 'bottom']
+CUBE_FACE_ORDER = ['front', 'right', 'back', 'left', 'top', 'bottom']  # py360convert order [F, R, B, L, U, D]
+WALL_FACES = {'front', 'right', 'back', 'left'}
+
+TILES_FOLDER = os.path.join(OUTPUT_FOLDER, 'tiles')
+
+# Multi-resolution cube tiles (Pannellum "multires" layout)
+TILE_SIZE = 512
+TILE_QUALITY = 85
+CUBE_FACE_LETTERS = ['f', 'r', 'b', 'l', 'u', 'd']  # same order as py360convert [F, R, B, L, U, D]
+
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(TILES_FOLDER, exist_ok=True)
+
+app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+app.config['TILES_FOLDER'] = TILES_FOLDER
+app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max for panoramas
+
+# Bilinear remap grids are 8 bytes per output pixel (int32 index + two uint16 weights): an 8K grid
+# is 256MB and a 4K one 64MB, so 768MB holds three 8K grids, or one plus eight 4K ones
+REMAP_CACHE_MAX_BYTES = int(os.environ.get('PANORAMA_REMAP_CACHE_MB', 768)) * 1024 * 1024
+app.config['REMAP_CACHE_MAX_BYTES'] = REMAP_CACHE_MAX_BYTES
+
+# Output rows sampled per pass, keeps float temporaries small on 8K outputs
+REMAP_BAND_ROWS = 256
+
+# Threads used to sample one conversion in parallel row bands (1 = serial)
+SAMPLER_THREADS = int(os.environ.get('PANORAMA_SAMPLER_THREADS', os.cpu_count() or 1))
+# Job worker processes already run one conversion per core, so they sample serially by default
+JOB_SAMPLER_THREADS = int(os.environ.get('PANORAMA_JOB_SAMPLER_THREADS', 1))
+app.config['SAMPLER_THREADS'] = SAMPLER_THREADS
+
+# Memory-bounded mode: outputs at least this wide are sampled in strips straight into the PIL
+# image and their encoded bytes spill to disk (PANORAMA_LOW_MEMORY_WIDTH=0 uses it for every size)
+LOW_MEMORY_WIDTH = int(os.environ.get('PANORAMA_LOW_MEMORY_WIDTH', 8192))
+LOW_MEMORY_STRIP_ROWS = 512
+LOW_MEMORY_SPOOL_BYTES = 8 * 1024 * 1024
+# Estimated bytes that in-flight conversions in this process may hold at once (0 disables the budget)
+MEMORY_BUDGET_BYTES = int(os.environ.get('PANORAMA_MEMORY_BUDGET_MB', 2048)) * 1024 * 1024
+# How long a request queues for budget before it is turned away with 503
+MEMORY_WAIT_SECONDS = float(os.environ.get('PANORAMA_MEMORY_WAIT_SECONDS', 30))
+
+# Bilinear weights are 8-bit fixed point (0..256), blended in uint16 like libjpeg/Pillow do
+SAMPLER_WEIGHT_BITS = 8
+SAMPLER_WEIGHT_ONE = 1 << SAMPLER_WEIGHT_BITS
+# "numba" JIT-compiles the sampler loop, "numpy" forces the vectorised fallback, "auto" picks numba if installed
+SAMPLER_BACKEND = os.environ.get('PANORAMA_SAMPLER', 'auto').lower()
+if SAMPLER_BACKEND == 'auto':
+    SAMPLER_BACKEND = 'numba' if numba is not None else 'numpy'
+if SAMPLER_BACKEND == 'numba' and numba is None:
+    raise RuntimeError('PANORAMA_SAMPLER=numba but numba is not installed')
+app.config['SAMPLER_BACKEND'] = SAMPLER_BACKEND
+app.config['LOW_MEMORY_WIDTH'] = LOW_MEMORY_WIDTH
+app.config['MEMORY_BUDGET_BYTES'] = MEMORY_BUDGET_BYTES
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+# ---------------------------------------------------------------------------
+# Instrumentation
+# ---------------------------------------------------------------------------
+
+# tracemalloc slows every allocation and its counters are process-wide, so memory tracing is opt-in
+TRACE_MEMORY = os.environ.get('PANORAMA_TRACE_MEMORY', '').lower() in ('1', 'true', 'yes')
+# Always send Server-Timing (otherwise only when the request has ?timing=1)
+SERVER_TIMING = os.environ.get('PANORAMA_SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+app.config['TRACE_MEMORY'] = TRACE_MEMORY
+app.config['SERVER_TIMING'] = SERVER_TIMING
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 4, 16, 64, 256, 1024))
+
+if TRACE_MEMORY:
+    tracemalloc.start()
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+class Histogram:
+    """Minimal Prometheus histogram keyed by label sets"""
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{_format_labels(key, le=bound)} {count}')
+                lines.append(f'{self.name}_bucket{_format_labels(key, le="+Inf")} {series["count"]}')
+                lines.append(f'{self.name}_sum{_format_labels(key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{_format_labels(key)} {series["count"]}')
+        return lines
+
+class Counter:
+    """Minimal Prometheus counter keyed by label sets"""
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._series.items()):
+                lines.append(f'{self.name}{_format_labels(key)} {value}')
+        return lines
+
+request_seconds = Histogram('panorama_request_duration_seconds', 'Request wall time', LATENCY_BUCKETS)
+stage_seconds = Histogram('panorama_stage_duration_seconds', 'Per-stage wall time', LATENCY_BUCKETS)
+stage_cpu_seconds = Counter(
+    'panorama_stage_cpu_seconds_total', 'Per-stage CPU time of the request thread and the sampler/decode pool work it started'
+)
+stage_allocated_bytes = Histogram(
+    'panorama_stage_allocated_bytes', 'Per-stage peak traced allocation (PANORAMA_TRACE_MEMORY=1)', BYTES_BUCKETS
+)
+
+@contextmanager
+def stage(name):
+    """
+    Time one pipeline stage of the current request (wall, request-thread CPU, and with
+    PANORAMA_TRACE_MEMORY=1 the peak bytes allocated). Repeated stages add up.
+    CPU of pool threads working for the stage is added through charge_cpu().
+    No-op outside a request, e.g. in job workers or the benchmark.
+    """
+    if not has_request_context():
+        yield
+        return
+
+    outer_stage = g.get('stage_name')
+    g.stage_name = name
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    if TRACE_MEMORY:
+        memory_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        g.stage_name = outer_stage
+        timings = g.setdefault('stage_timings', OrderedDict())
+        entry = timings.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'bytes': 0})
+        entry['wall'] += time.perf_counter() - wall_start
+        entry['cpu'] += time.thread_time() - cpu_start
+        if TRACE_MEMORY:
+            entry['bytes'] += max(tracemalloc.get_traced_memory()[1] - memory_start, 0)
+
+def charge_cpu(func, name=None):
+    """
+    Wrap work handed to a thread pool so its CPU time counts toward a stage of the current
+    request (name, or the stage running now); stage() alone only sees the request thread.
+    Returns func unchanged outside a request.
+    """
+    if not has_request_context() or 'pool_cpu' not in g:
+        return func
+    name = name or g.get('stage_name')
+    pool_cpu = g.pool_cpu
+
+    def timed(*args):
+        start = time.thread_time()
+        try:
+            return func(*args)
+        finally:
+            pool_cpu.append((name, time.thread_time() - start))
+    return timed
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.stage_timings = OrderedDict()
+    g.pool_cpu = []
+
+@app.after_request
+def record_request_metrics(response):
+    """Fold this request's stage timings into the /metrics histograms and optionally add Server-Timing"""
+    if 'request_start' not in g:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    total = time.perf_counter() - g.request_start
+    request_seconds.observe({'route': route, 'method': request.method, 'status': response.status_code}, total)
+
+    timings = g.get('stage_timings') or OrderedDict()
+    for name, seconds in g.get('pool_cpu', ()):
+        if name:
+            timings.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'bytes': 0})['cpu'] += seconds
+    for name, entry in timings.items():
+        labels = {'route': route, 'stage': name}
+        stage_seconds.observe(labels, entry['wall'])
+        stage_cpu_seconds.inc(labels, entry['cpu'])
+        if TRACE_MEMORY:
+            stage_allocated_bytes.observe(labels, entry['bytes'])
+
+    if SERVER_TIMING or request.args.get('timing') in ('1', 'true', 'yes'):
+        parts = [f'{name};dur={entry["wall"] * 1000:.1f}' for name, entry in timings.items()]
+        parts.append(f'total;dur={total * 1000:.1f}')
+        response.headers['Server-Timing'] = ', '.join(parts)
+        response.headers['Timing-Allow-Origin'] = '*'
+
+    return response
+
+# ---------------------------------------------------------------------------
+# Output encoders
+# ---------------------------------------------------------------------------
+
+class EncoderPreset:
+    """
+    Named output encoding: PIL format + save() options + content type.
+    streaming_options replaces options when the encoder output is streamed while encoding.
+    """
+    def __init__(self, name, pil_format, mimetype, extension, options, streaming_options=None):
+        self.name = name
+        self.pil_format = pil_format
+        self.mimetype = mimetype
+        self.extension = extension
+        self.options = options
+        self.streaming_options = streaming_options
+
+    @property
+    def available(self):
+        """Whether the local Pillow build can write this format (WebP/AVIF depend on compiled codecs)"""
+        Image.init()
+        return self.pil_format in Image.SAVE
+
+    def save_kwargs(self, streaming=False):
+        if streaming and self.streaming_options is not None:
+            return dict(self.streaming_options)
+        return dict(self.options)
+
+    @property
+    def cache_key(self):
+        return f"{self.name}:{sorted(self.options.items())}"
+
+ENCODER_PRESETS = OrderedDict((preset.name, preset) for preset in [
+    # Original output: optimize=True adds a second Huffman pass, which can't start streaming until the scan is done
+    EncoderPreset('jpeg', 'JPEG', 'image/jpeg', 'jpg',
+                  {'quality': JPEG_QUALITY, 'optimize': True}, {'quality': JPEG_QUALITY}),
+    EncoderPreset('jpeg-fast', 'JPEG', 'image/jpeg', 'jpg', {'quality': JPEG_QUALITY}),
+    EncoderPreset('jpeg-progressive', 'JPEG', 'image/jpeg', 'jpg',
+                  {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True}),
+    EncoderPreset('webp', 'WEBP', 'image/webp', 'webp', {'quality': 85, 'method': 4}),
+    EncoderPreset('avif', 'AVIF', 'image/avif', 'avif', {'quality': 70, 'speed': 8}),
+    EncoderPreset('png', 'PNG', 'image/png', 'png', {'compress_level': 6})
+])
+ENCODER_ALIASES = {'jpg': 'jpeg', 'fast': 'jpeg-fast', 'progressive': 'jpeg-progressive'}
+DEFAULT_ENCODER = 'jpeg'
+# Accept-header negotiation order; only types the client lists explicitly count, not */*
+NEGOTIATED_ENCODERS = ['avif', 'webp']
+MIMETYPES_BY_EXTENSION = {preset.extension: preset.mimetype for preset in ENCODER_PRESETS.values()}
+
+class EncoderStats:
+    """Per-preset encode time and output size counters"""
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, nbytes, pixels):
+        with self._lock:
+            stats = self._stats.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'pixels': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['bytes'] += nbytes
+            stats['pixels'] += pixels
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                name: {
+                    'count': stats['count'],
+                    'totalSeconds': round(stats['seconds'], 4),
+                    'totalBytes': stats['bytes'],
+                    'avgSeconds': round(stats['seconds'] / stats['count'], 4),
+                    'avgBytes': stats['bytes'] // stats['count'],
+                    'bytesPerMegapixel': int(stats['bytes'] / max(stats['pixels'] / 1e6, 1e-6))
+                }
+                for name, stats in self._stats.items()
+            }
+
+encoder_stats = EncoderStats()
+
+def get_encoder(name):
+    """Look up a preset by name (or alias), raising ValueError if unknown or unsupported here"""
+    name = ENCODER_ALIASES.get(name.lower(), name.lower())
+    preset = ENCODER_PRESETS.get(name)
+    if preset is None:
+        raise ValueError(f'Unknown output preset {name}')
+    if not preset.available:
+        raise ValueError(f'Output preset {name} is not supported by this server')
+    return preset
+
+def choose_encoder(negotiate=False):
+    """
+    Encoder for the current request: explicit preset/format parameter first, then
+    (when the response body is the image itself) the Accept header, then the default.
+    """
+    name = (request.args.get('preset') or request.form.get('preset') or
+            request.args.get('format') or request.form.get('format'))
+    if name:
+        return get_encoder(name)
+
+    if negotiate:
+        accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+        for candidate in NEGOTIATED_ENCODERS:
+            preset = ENCODER_PRESETS[candidate]
+            if preset.mimetype in accepted and preset.available:
+                return preset
+
+    return ENCODER_PRESETS[DEFAULT_ENCODER]
+
+def encode_image(image, fp, encoder, streaming=False):
+    """Encode image into a binary file object with a preset, recording time and size"""
+    start = time.perf_counter()
+    with stage('encode'):
+        image.save(fp, encoder.pil_format, **encoder.save_kwargs(streaming))
+    nbytes = fp.bytes_written if isinstance(fp, _QueueWriter) else fp.tell()
+    encoder_stats.record(encoder.name, time.perf_counter() - start, nbytes, image.width * image.height)
+    return nbytes
+
+def content_filename(inputs, output_width, encoder=None, mode='convert'):
+    """
+    Content-addressed output name: sha256 over the input bytes and conversion parameters.
+    inputs is a list of byte strings or upload streams (one per uploaded file, in a fixed order);
+    streams are hashed in chunks, so spooled uploads are never read into memory whole.
+    """
+    encoder = encoder or ENCODER_PRESETS[DEFAULT_ENCODER]
+    digest = hashlib.sha256(f'{mode}:{output_width}:{encoder.cache_key}'.encode())
+    for data in inputs:
+        # Hash each part separately so boundaries between files are unambiguous
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            digest.update(hashlib.sha256(data).digest())
+        else:
+            digest.update(stream_digest(upload_stream(data)))
+            data.seek(0)
+    return f"{digest.hexdigest()}.{encoder.extension}"
+
+def stream_digest(stream, chunk_size=1024 * 1024):
+    """sha256 of a binary stream read in chunks (hashlib.file_digest needs Python 3.11)"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.digest()
+
+def output_exists(filename):
+    """True when the output is stored; a hit counts as an access for LRU eviction"""
+    store = get_output_store()
+    if not store.exists(filename):
+        return False
+    store.touch(filename)
+    return True
+
+class _QueueWriter(io.RawIOBase):
+    """Write-only file object that hands each encoded chunk to a queue"""
+    def __init__(self, chunks, cancelled):
+        self._chunks = chunks
+        self._cancelled = cancelled
+        self.bytes_written = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        while True:
+            if self._cancelled.is_set():
+                raise IOError('Client went away')
+            try:
+                self._chunks.put(bytes(data), timeout=1)
+                self.bytes_written += len(data)
+                return len(data)
+            except queue.Full:
+                continue
+
+def stream_encoded_image(image, encoder):
+    """
+    Generator yielding the encoded image chunk by chunk while a background thread is still encoding.
+    Only one encoded chunk queue is held in memory instead of the full file.
+    An encoder failure is raised from the generator once the chunks before it are sent, so the
+    server aborts the response instead of ending a truncated file as if it were complete.
+    """
+    chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    done = object()
+    failure = []
+
+    def encode():
+        try:
+            encode_image(image, _QueueWriter(chunks, cancelled), encoder, streaming=True)
+        except Exception as e:
+            if not cancelled.is_set():
+                failure.append(e)
+        finally:
+            while not cancelled.is_set():
+                try:
+                    chunks.put(done, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+    threading.Thread(target=encode, daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+        if failure:
+            raise failure[0]
+    finally:
+        # Client disconnected (or we finished): unblock the encoder thread
+        cancelled.set()
+
+def save_panorama(image, output_path, encoder=None):
+    """Write via a temp file + rename so a concurrent lookup never sees a half-written file"""
+    encoder = encoder or ENCODER_PRESETS[DEFAULT_ENCODER]
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            encode_image(image, f, encoder)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def save_output(image, output_filename, encoder=None, projection=None):
+    """
+    save_panorama into the output store and index it, so it counts toward the quota
+    (projection: the input's classified kind, returned again on cache hits)
+    """
+    store = get_output_store()
+    output_path = store.path_for(output_filename)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    save_panorama(image, output_path, encoder)
+    store.add(output_filename, os.path.getsize(output_path), projection)
+
+# ---------------------------------------------------------------------------
+# Output store
+# ---------------------------------------------------------------------------
+
+# Bytes of stored panoramas + their tile pyramids (0 = unlimited); eviction frees down to the low-water mark
+OUTPUT_QUOTA_BYTES = int(os.environ.get('PANORAMA_OUTPUT_QUOTA_MB', 20480)) * 1024 * 1024
+# Share of that for derived outputs (previews, renders, alternate encodings; 0 = no separate limit).
+# They can be rebuilt from their panorama, so the overall quota evicts them before any panorama.
+OUTPUT_DERIVED_QUOTA_BYTES = int(os.environ.get('PANORAMA_DERIVED_QUOTA_MB', 4096)) * 1024 * 1024
+OUTPUT_LOW_WATER = 0.9
+# Outputs nobody has requested for this long are dropped (0 = only the quota evicts)
+OUTPUT_TTL_SECONDS = float(os.environ.get('PANORAMA_OUTPUT_TTL_DAYS', 0)) * 86400
+OUTPUT_INDEX_FILENAME = 'index.sqlite3'
+# Last-access writes are throttled per output; eviction passes run at most this often (or once
+# enough new bytes have been written)
+OUTPUT_TOUCH_INTERVAL = 60
+OUTPUT_EVICT_INTERVAL = 30
+# In-memory copies of the most-served panoramas
+HOT_CACHE_MAX_BYTES = int(os.environ.get('PANORAMA_HOT_CACHE_MB', 256)) * 1024 * 1024
+HOT_CACHE_MAX_OBJECT_BYTES = 16 * 1024 * 1024
+HOT_CACHE_MIN_HITS = 2
+app.config['OUTPUT_QUOTA_BYTES'] = OUTPUT_QUOTA_BYTES
+app.config['OUTPUT_DERIVED_QUOTA_BYTES'] = OUTPUT_DERIVED_QUOTA_BYTES
+app.config['OUTPUT_TTL_SECONDS'] = OUTPUT_TTL_SECONDS
+app.config['HOT_CACHE_MAX_BYTES'] = HOT_CACHE_MAX_BYTES
+
+def shard_path(root, name):
+    """root/ab/cd/name, with ab/cd taken from a hash of the name so no directory grows huge"""
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    return os.path.join(root, digest[:2], digest[2:4], name)
+
+def is_derived(filename):
+    """Previews, renders and alternate encodings are stored as <panorama filename>.<...>"""
+    return filename.count('.') > 1
+
+class OutputStore:
+    """
+    Sharded panorama storage with an on-disk SQLite index of sizes and last access times.
+    Keeps the total under a byte quota (least recently used first, derived outputs before
+    panoramas), derived outputs under their own quota, and optionally drops outputs idle
+    longer than a TTL; tile pyramids and derived outputs are evicted with their panorama.
+    Usable from request threads and job worker processes (each opens its own connection).
+    """
+    def __init__(self, root, max_bytes=0, ttl_seconds=0, derived_max_bytes=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.derived_max_bytes = derived_max_bytes
+        self.index_path = os.path.join(root, OUTPUT_INDEX_FILENAME)
+        self.evictions = 0
+        self._local = threading.local()
+        self._touched = {}
+        self._last_evict = time.monotonic()
+        self._added_since_evict = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(root, exist_ok=True)
+        needs_rebuild = not os.path.exists(self.index_path)
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                'filename TEXT PRIMARY KEY, size INTEGER NOT NULL, tiles_size INTEGER NOT NULL DEFAULT 0, '
+                'created REAL NOT NULL, last_access REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS outputs_last_access ON outputs (last_access)')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(outputs)')}
+            if 'projection' not in columns:  # Index from before projections were recorded
+                conn.execute('ALTER TABLE outputs ADD COLUMN projection TEXT')
+            if 'derived' not in columns:
+                conn.execute('ALTER TABLE outputs ADD COLUMN derived INTEGER NOT NULL DEFAULT 0')
+                conn.execute("UPDATE outputs SET derived = 1 WHERE filename LIKE '%.%.%'")
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'job_id TEXT PRIMARY KEY, type TEXT NOT NULL, status TEXT NOT NULL, filename TEXT, '
+                'created REAL NOT NULL, finished REAL, result TEXT, error TEXT)'
+            )
+        if needs_rebuild:
+            self.rebuild()
+
+    def _connection(self):
+        """One connection per thread, reopened after a fork"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.index_path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def path_for(self, filename):
+        return shard_path(self.root, filename)
+
+    def locate(self, filename):
+        """Path of a stored output (sharded, or flat from before sharding), or None"""
+        filename = secure_filename(filename)
+        if not filename:
+            return None
+        for path in (self.path_for(filename), os.path.join(self.root, filename)):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def exists(self, filename):
+        return self.locate(filename) is not None
+
+    def add(self, filename, size, projection=None):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT INTO outputs (filename, size, created, last_access, projection, derived) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT(filename) DO UPDATE SET size = excluded.size, last_access = excluded.last_access, '
+                'projection = COALESCE(excluded.projection, projection)',
+                (filename, size, now, now, projection, is_derived(filename))
+            )
+        with self._lock:
+            self._added_since_evict += size
+            self._touched[filename] = now
+        self.maybe_evict()
+
+    def save_job(self, job_id, job):
+        """Record a background job's status, so every worker process sharing this store can report it"""
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT INTO jobs (job_id, type, status, filename, created, finished, result, error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(job_id) DO UPDATE SET status = excluded.status, '
+                'finished = excluded.finished, result = excluded.result, error = excluded.error',
+                (job_id, job['type'], job['status'], job['filename'], job['createdAt'], job['finishedAt'],
+                 json.dumps(job['result']) if job['result'] is not None else None, job['error'])
+            )
+            conn.execute(
+                'DELETE FROM jobs WHERE created < (SELECT created FROM jobs ORDER BY created DESC LIMIT 1 OFFSET ?)',
+                (JOB_HISTORY_LIMIT,)
+            )
+
+    def load_job(self, job_id):
+        """A job recorded by save_job (in the in-memory job table's format), or None"""
+        row = self._connection().execute(
+            'SELECT type, status, filename, created, finished, result, error FROM jobs WHERE job_id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        kind, status, filename, created, finished, result, error = row
+        return {
+            'type': kind,
+            'status': status,
+            'createdAt': created,
+            'finishedAt': finished,
+            'filename': filename,
+            'future': None,
+            'result': json.loads(result) if result else None,
+            'error': error
+        }
+
+    def projection_of(self, filename):
+        """Projection kind recorded for a stored conversion, or None (stitches, older outputs)"""
+        row = self._connection().execute(
+            'SELECT projection FROM outputs WHERE filename = ?', (filename,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_tiles_size(self, filename, nbytes):
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE outputs SET tiles_size = ? WHERE filename = ?', (nbytes, filename))
+
+    def touch(self, filename):
+        """Record an access; written at most once per OUTPUT_TOUCH_INTERVAL per output"""
+        now = time.time()
+        with self._lock:
+            if now - self._touched.get(filename, 0) < OUTPUT_TOUCH_INTERVAL:
+                return
+            if len(self._touched) > 100000:
+                self._touched.clear()
+            self._touched[filename] = now
+        conn = self._connection()
+        with conn:
+            conn.execute('UPDATE outputs SET last_access = ? WHERE filename = ?', (now, filename))
+        self.maybe_evict()
+
+    def maybe_evict(self):
+        quotas = [quota for quota in (self.max_bytes, self.derived_max_bytes) if quota]
+        if not quotas and not self.ttl_seconds:
+            return 0
+        with self._lock:
+            overdue = time.monotonic() - self._last_evict >= OUTPUT_EVICT_INTERVAL
+            filling = quotas and self._added_since_evict > min(quotas) * (1 - OUTPUT_LOW_WATER)
+            if not overdue and not filling:
+                return 0
+            self._last_evict = time.monotonic()
+            self._added_since_evict = 0
+        return self.evict()
+
+    def evict(self):
+        """
+        Drop outputs idle past the TTL, then least recently used derived outputs while over their
+        quota, then least recently used outputs, derived ones first, while over the overall quota
+        (each quota is freed down to its low-water mark)
+        """
+        conn = self._connection()
+        victims = {}
+        if self.ttl_seconds:
+            cutoff = time.time() - self.ttl_seconds
+            victims.update(conn.execute(
+                'SELECT filename, size + tiles_size FROM outputs WHERE last_access < ?', (cutoff,)
+            ).fetchall())
+
+        if self.derived_max_bytes:
+            self._select_lru(conn, 'WHERE derived = 1', self.derived_max_bytes, victims)
+        if self.max_bytes:
+            self._select_lru(conn, '', self.max_bytes, victims)
+
+        for filename in victims:
+            self.remove(filename)
+        return len(victims)
+
+    def _select_lru(self, conn, where, max_bytes, victims):
+        """Add outputs (derived first, then least recently used) to victims until the rest fit the low-water mark"""
+        rows = conn.execute(
+            f'SELECT filename, size + tiles_size FROM outputs {where} ORDER BY derived DESC, last_access'
+        ).fetchall()
+        total = sum(size for filename, size in rows if filename not in victims)
+        if total <= max_bytes:
+            return
+        target = max_bytes * OUTPUT_LOW_WATER
+        for filename, size in rows:
+            if total <= target:
+                break
+            if filename not in victims:
+                victims[filename] = size
+                total -= size
+
+    def remove(self, filename):
+        path = self.locate(filename)
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        stem = os.path.splitext(filename)[0]
+        for tiles_dir in (tiles_dir_for(filename), os.path.join(TILES_FOLDER, stem)):
+            shutil.rmtree(tiles_dir, ignore_errors=True)
+
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM outputs WHERE filename = ?', (filename,))
+        hot_cache.discard(filename)
+        master_cache.discard_where(lambda key: key[0] == filename)
+        with self._lock:
+            self._touched.pop(filename, None)
+            self.evictions += 1
+
+        # Alternate encodings, previews and renders are all stored as <filename>.<...> and go with it
+        prefix = f'{filename}.'
+        related = conn.execute(
+            'SELECT filename FROM outputs WHERE substr(filename, 1, ?) = ?', (len(prefix), prefix)
+        ).fetchall()
+        for (name,) in related:
+            self.remove(name)
+
+    def rebuild(self):
+        """Index the outputs already on disk (first run, or after the index file was deleted)"""
+        tiles_root = os.path.abspath(TILES_FOLDER)
+        rows = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if os.path.abspath(os.path.join(dirpath, d)) != tiles_root]
+            for filename in filenames:
+                if filename.rsplit('.', 1)[-1].lower() not in MIMETYPES_BY_EXTENSION:
+                    continue
+                st = os.stat(os.path.join(dirpath, filename))
+                rows.append((filename, st.st_size, st.st_mtime, st.st_mtime, is_derived(filename)))
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO outputs (filename, size, created, last_access, derived) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+
+    def stats(self):
+        conn = self._connection()
+        entries, total, derived = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size + tiles_size), 0), '
+            'COALESCE(SUM(CASE WHEN derived = 1 THEN size + tiles_size ELSE 0 END), 0) FROM outputs'
+        ).fetchone()
+        return {
+            'entries': entries,
+            'bytes': total,
+            'derivedBytes': derived,
+            'maxBytes': self.max_bytes,
+            'derivedMaxBytes': self.derived_max_bytes,
+            'ttlSeconds': self.ttl_seconds,
+            'evictions': self.evictions
+        }
+
+_output_store = None
+_output_store_lock = threading.Lock()
+
+def get_output_store():
+    """Store for the current OUTPUT_FOLDER (recreated when it changes, e.g. in the benchmark)"""
+    global _output_store
+    with _output_store_lock:
+        if _output_store is None or _output_store.root != OUTPUT_FOLDER:
+            _output_store = OutputStore(OUTPUT_FOLDER, OUTPUT_QUOTA_BYTES, OUTPUT_TTL_SECONDS,
+                                        OUTPUT_DERIVED_QUOTA_BYTES)
+        return _output_store
+
+class HotObjectCache:
+    """
+    Byte-bounded LRU of encoded panoramas (bytes, mtime) for /panorama/<filename>.
+    An object is only loaded once it has been requested min_hits times, so one-off
+    downloads don't push out the panoramas that are actually popular.
+    """
+    def __init__(self, max_bytes, max_object_bytes, min_hits=2):
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.min_hits = min_hits
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def admit(self, key, path):
+        """Count a request for key and cache the file once it is hot; returns (bytes, mtime) when cached"""
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            if len(self._requests) > 10000:
+                self._requests.clear()
+            count = self._requests[key] = self._requests.get(key, 0) + 1
+        if count < self.min_hits or os.path.getsize(path) > self.max_object_bytes:
+            return None
+
+        with open(path, 'rb') as f:
+            entry = (f.read(), os.fstat(f.fileno()).st_mtime)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self.current_bytes += len(entry[0])
+                self._requests.pop(key, None)
+                while self.current_bytes > self.max_bytes:
+                    _, (evicted, _) = self._entries.popitem(last=False)
+                    self.current_bytes -= len(evicted)
+        return entry
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= len(entry[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+hot_cache = HotObjectCache(HOT_CACHE_MAX_BYTES, HOT_CACHE_MAX_OBJECT_BYTES, HOT_CACHE_MIN_HITS)
+
+# Alternate encodings of stored panoramas (e.g. PANORAMA_VARIANTS=avif,webp), served to clients whose
+# Accept header lists them. Each is encoded once in the background the first time a client could use
+# it and stored next to the original as <filename>.<ext>, counting toward the quota.
+VARIANT_ENCODERS = [name for name in os.environ.get('PANORAMA_VARIANTS', '').split(',') if name]
+app.config['VARIANT_ENCODERS'] = VARIANT_ENCODERS
+
+_variant_executor = None
+_variant_executor_pid = None
+_variant_lock = threading.Lock()
+_variants_pending = set()
+_variants_useless = set()
+
+def variant_filename(filename, encoder):
+    return f'{filename}.{encoder.extension}'
+
+def build_variant(filename, encoder_name):
+    """Encode one stored panorama with another preset; kept only when it is smaller than the original"""
+    try:
+        store = get_output_store()
+        source_path = store.locate(filename)
+        if source_path is None:
+            return
+        encoder = ENCODER_PRESETS[encoder_name]
+        image = open_upload_image(source_path)
+        buffer = io.BytesIO()
+        encode_image(image, buffer, encoder)
+        if buffer.tell() >= os.path.getsize(source_path):
+            with _variant_lock:
+                _variants_useless.add((filename, encoder_name))
+            return
+
+        name = variant_filename(filename, encoder)
+        output_path = store.path_for(name)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getbuffer())
+        os.replace(tmp_path, output_path)
+        store.add(name, buffer.tell())
+    except Exception as e:
+        app.logger.error('Building %s variant of %s failed: %s', encoder_name, filename, e)
+    finally:
+        with _variant_lock:
+            _variants_pending.discard((filename, encoder_name))
+
+def negotiate_variant(filename):
+    """
+    Stored variant of filename that the request's Accept header prefers, as (variant filename, preset),
+    or None. Missing variants the client could have used are queued for building.
+    """
+    global _variant_executor, _variant_executor_pid
+    if not VARIANT_ENCODERS:
+        return None
+
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    extension = filename.rsplit('.', 1)[-1].lower()
+    store = get_output_store()
+    for name in VARIANT_ENCODERS:
+        encoder = ENCODER_PRESETS.get(name)
+        if encoder is None or encoder.extension == extension or encoder.mimetype not in accepted:
+            continue
+        if store.exists(variant_filename(filename, encoder)):
+            return variant_filename(filename, encoder), encoder
+
+        key = (filename, name)
+        with _variant_lock:
+            if key in _variants_pending or key in _variants_useless or not encoder.available:
+                continue
+            _variants_pending.add(key)
+            if _variant_executor is None or _variant_executor_pid != os.getpid():
+                _variant_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='variants')
+                _variant_executor_pid = os.getpid()
+        _variant_executor.submit(build_variant, filename, name)
+    return None
+
+DERIVATIVE_KINDS = ('equirect', 'face', 'perspective')
+
+class Derivative:
+    """
+    Image rendered from a stored panorama: the previews saved next to it (?size=<name>) and the
+    on-demand renders of /panorama/<filename>?width=...&projection=...
+    kind 'equirect' is the whole panorama at width x width/2, 'face' one cube face at width x width,
+    'perspective' a pinhole view of width x height looking at yaw/pitch with a horizontal fov.
+    """
+    def __init__(self, name, kind, width, height=None, face='front', yaw=0.0, pitch=0.0, fov=90.0):
+        if kind not in DERIVATIVE_KINDS:
+            raise ValueError(f'Unknown derivative kind "{kind}"')
+        if face not in CUBE_FACE_ORDER:
+            raise ValueError(f'Unknown cube face "{face}"')
+        self.name = name
+        self.kind = kind
+        self.width = width
+        if height is None:
+            height = {'equirect': width // 2, 'face': width}.get(kind, width * 3 // 4)
+        self.height = max(height, 1)
+        self.face = face
+        self.yaw = yaw
+        self.pitch = pitch
+        self.fov = fov
+
+    @property
+    def source_width(self):
+        """Equirect width this derivative needs (a cube face spans a quarter of it)"""
+        if self.kind == 'face':
+            return self.width * 4
+        if self.kind == 'perspective':
+            # Match the view's pixels per radian at its centre (narrow views would ask for more
+            # than any stored panorama has)
+            width = 2 * int(self.width * math.pi / math.tan(math.radians(self.fov) / 2) / 2)
+            return min(width, RENDER_MAX_WIDTH)
+        return self.width
+
+    def scale(self, image):
+        """The equirect reduced to source_width (never enlarged); reducing_gap box-reduces by an integer factor first"""
+        width = self.source_width
+        if image.width <= width:
+            return image
+        return image.resize((width, max(width // 2, 1)), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    def render(self, source):
+        """Render from an equirect already passed through scale()"""
+        if self.kind == 'equirect':
+            if source.size != (self.width, self.height):
+                source = source.resize((self.width, self.height), Image.Resampling.LANCZOS)
+            return source
+        if self.kind == 'face':
+            return Image.fromarray(equirect_to_cube_face(np.asarray(source), self.width, self.face))
+        return Image.fromarray(equirect_to_perspective(np.asarray(source), self.width, self.height,
+                                                       self.yaw, self.pitch, self.fov))
+
+    def sample(self, padded):
+        """Render a face or perspective view straight from a padded RGBX master (see get_master_level)"""
+        src_size = (padded.shape[1] - 2, padded.shape[2] - 2)
+        if self.kind == 'face':
+            table = cube_face_table(src_size, self.width, self.face)
+        else:
+            table = get_remap_table('e2p', src_size, self.width, self.height, view=(self.yaw, self.pitch, self.fov))
+        return Image.fromarray(parallel_remap(padded, table, channels=3))
+
+    def query(self):
+        """Query args that parse_render_request turns back into this derivative"""
+        args = {'projection': self.kind, 'width': self.width}
+        if self.kind == 'face':
+            args['face'] = self.face
+        elif self.kind == 'perspective':
+            args.update(height=self.height, yaw=f'{self.yaw:g}', pitch=f'{self.pitch:g}', fov=f'{self.fov:g}')
+        return args
+
+def parse_derivatives(spec):
+    """'thumb:equirect:480,face:face:256' -> OrderedDict of name -> Derivative"""
+    derivatives = OrderedDict()
+    for item in spec.split(','):
+        if item:
+            name, kind, width = item.split(':')
+            derivatives[name] = Derivative(name, kind, int(width))
+    return derivatives
+
+# Previews rendered from the in-memory result of every conversion (PANORAMA_DERIVATIVES="" turns them off)
+DERIVATIVES = parse_derivatives(
+    os.environ.get('PANORAMA_DERIVATIVES', 'thumb:equirect:480,placeholder:equirect:64,face:face:256')
+)
+DERIVATIVE_ENCODER = EncoderPreset('derivative', 'JPEG', 'image/jpeg', 'jpg', {'quality': 80, 'optimize': True})
+app.config['DERIVATIVES'] = list(DERIVATIVES)
+
+def derivative_filename(filename, name):
+    return f'{filename}.{name}.jpg'
+
+def preview_urls(filename):
+    return {name: f'/panorama/{filename}?size={name}' for name in DERIVATIVES}
+
+def estimate_render_memory(derivative):
+    """Rough peak bytes of rendering from a stored panorama: a draft decode can be up to 2x source_width"""
+    width = derivative.source_width
+    decoded = 2 * width * width * 4
+    sampled = derivative.width * derivative.height * 3
+    return decoded + width * (width // 2) * 4 + sampled + estimate_sampler_memory(derivative.width, derivative.height)
+
+_render_locks = {}
+_render_locks_lock = threading.Lock()
+
+def render_from_master(filename, derivative, output_filename, encoder):
+    """
+    Render derivative from the stored panorama into output_filename unless it is already stored.
+    Faces and perspective views sample a cached decoded master (see get_master_level); equirects
+    decode JPEGs at reduced DCT scale (the draft only needs source_width). Concurrent requests
+    for the same cold render wait for one render. False if the master is gone.
+    """
+    store = get_output_store()
+    if store.exists(output_filename):
+        return True
+    with _render_locks_lock:
+        lock = _render_locks.setdefault(output_filename, threading.Lock())
+    with lock:
+        try:
+            if store.exists(output_filename):
+                return True
+            source_path = store.locate(filename)
+            if source_path is None:
+                return False
+            with memory_budget.reserve(estimate_render_memory(derivative)):
+                if derivative.kind == 'equirect':
+                    width = derivative.source_width
+                    image = load_rgb(open_image(source_path, (width, width // 2)))
+                    with stage('render'):
+                        rendered = derivative.render(derivative.scale(image))
+                    del image
+                else:
+                    padded = get_master_level(filename, source_path, derivative.source_width)
+                    with stage('render'):
+                        rendered = derivative.sample(padded)
+                    del padded
+                save_output(rendered, output_filename, encoder)
+            return True
+        finally:
+            with _render_locks_lock:
+                _render_locks.pop(output_filename, None)
+
+def save_derivatives(image, filename):
+    """Render and store every preview from the already-converted image, so nothing is decoded again"""
+    with stage('derivatives'):
+        # Largest first, each scaled from the previous one, so the full-size image is only reduced once
+        source = image
+        for derivative in sorted(DERIVATIVES.values(), key=lambda d: d.source_width, reverse=True):
+            source = derivative.scale(source)
+            save_output(derivative.render(source), derivative_filename(filename, derivative.name),
+                        DERIVATIVE_ENCODER)
+
+def ensure_derivative(filename, name):
+    """Make sure a preview exists, rendering it from the stored panorama if it predates previews"""
+    return render_from_master(filename, DERIVATIVES[name], derivative_filename(filename, name), DERIVATIVE_ENCODER)
+
+# On-demand renders: /panorama/<filename>?width=1024, ?projection=face&face=right&width=512,
+# ?projection=perspective&yaw=30&pitch=-10&fov=75&width=800&height=600, each with &format=<preset>.
+# Rendered on first access and stored as <filename>.<spec>.<ext>, so they count toward the derived-output
+# quota, are evicted least-recently-used before any panorama (and with their panorama), and hot ones come
+# from hot_cache. Sizes and angles are snapped to a grid so arbitrary parameters can't mint unbounded renders.
+RENDER_PARAMS = ('width', 'height', 'projection', 'face', 'yaw', 'pitch', 'fov', 'format', 'preset')
+RENDER_MAX_WIDTH = 8192
+RENDER_MAX_VIEW_SIZE = 4096
+RENDER_SIZE_STEP = 64
+RENDER_ANGLE_STEP = 1
+RENDER_FOV_STEP = 5
+app.config['RENDER_MAX_WIDTH'] = RENDER_MAX_WIDTH
+
+def _render_number(args, name, default, low, high, cast=float):
+    try:
+        value = cast(args.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} must be a number')
+    if not low <= value <= high:
+        raise ValueError(f'{name} must be between {low} and {high}')
+    return value
+
+def _snap(value, step, low, high):
+    """Nearest multiple of step within low..high, so near-identical requests share one stored render"""
+    return min(max(int(round(value / step)) * step, low), high)
+
+def parse_render_request(args):
+    """Query args -> (Derivative, EncoderPreset); the derivative name is the canonical spec. ValueError if invalid"""
+    projection = args.get('projection', 'equirect')
+    if projection not in DERIVATIVE_KINDS:
+        raise ValueError(f'projection must be one of: {", ".join(DERIVATIVE_KINDS)}')
+    encoder = get_encoder(args.get('format') or args.get('preset') or DEFAULT_ENCODER)
+
+    if projection == 'equirect':
+        width = _render_number(args, 'width', 2048, 16, RENDER_MAX_WIDTH, int)
+        width = _snap(width, RENDER_SIZE_STEP, RENDER_SIZE_STEP, RENDER_MAX_WIDTH)
+        return Derivative(f'w{width}', projection, width), encoder
+
+    width = _render_number(args, 'width', 1024, 16, RENDER_MAX_VIEW_SIZE, int)
+    width = _snap(width, RENDER_SIZE_STEP, RENDER_SIZE_STEP, RENDER_MAX_VIEW_SIZE)
+    if projection == 'face':
+        face = args.get('face', 'front')
+        if face not in CUBE_FACE_ORDER:
+            raise ValueError(f'face must be one of: {", ".join(CUBE_FACE_ORDER)}')
+        return Derivative(f'{face}{width}', projection, width, face=face), encoder
+
+    height = _render_number(args, 'height', width * 3 // 4, 16, RENDER_MAX_VIEW_SIZE, int)
+    height = _snap(height, RENDER_SIZE_STEP, RENDER_SIZE_STEP, RENDER_MAX_VIEW_SIZE)
+    yaw = _snap((_render_number(args, 'yaw', 0, -360, 360) + 180) % 360 - 180, RENDER_ANGLE_STEP, -180, 180)
+    yaw = -180 if yaw == 180 else yaw
+    pitch = _snap(_render_number(args, 'pitch', 0, -90, 90), RENDER_ANGLE_STEP, -90, 90)
+    fov = _snap(_render_number(args, 'fov', 90, 10, 150), RENDER_FOV_STEP, 10, 150)
+    name = f'view{width}x{height}_y{yaw:g}_p{pitch:g}_f{fov:g}'
+    return Derivative(name, projection, width, height, yaw=yaw, pitch=pitch, fov=fov), encoder
+
+def render_filename(filename, derivative, encoder):
+    return f'{filename}.{derivative.name}-{encoder.name}.{encoder.extension}'
+
+def render_url(filename, derivative, encoder):
+    return f'/panorama/{filename}?{urlencode(dict(derivative.query(), format=encoder.name))}'
+
+def ensure_render(filename, derivative, encoder):
+    """Stored name of the render, rendering it from the panorama on first access; None if the panorama is gone"""
+    output_filename = render_filename(filename, derivative, encoder)
+    if not render_from_master(filename, derivative, output_filename, encoder):
+        return None
+    return output_filename
+
+# ---------------------------------------------------------------------------
+# Remap grids
+# ---------------------------------------------------------------------------
+
+class RemapTable:
+    """
+    Precomputed lookup from every output pixel into a flattened, padded source image.
+    Stores the top-left source index plus the x/y bilinear weights of the right/lower
+    neighbours as uint16 fixed point (0..SAMPLER_WEIGHT_ONE).
+    """
+    def __init__(self, index, weight_x, weight_y, src_shape, mode):
+        self.index = index
+        self.weight_x = weight_x
+        self.weight_y = weight_y
+        self.src_shape = src_shape
+        self.mode = mode
+        for arr in (index, weight_x, weight_y):
+            if arr is not None:
+                arr.setflags(write=False)
+
+    def columns(self, start, stop):
+        """Table for output columns start:stop (views, nothing is copied)"""
+        return RemapTable(self.index[:, start:stop],
+                          None if self.weight_x is None else self.weight_x[:, start:stop],
+                          None if self.weight_y is None else self.weight_y[:, start:stop],
+                          self.src_shape, self.mode)
+
+    @property
+    def shape(self):
+        return self.index.shape
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in (self.index, self.weight_x, self.weight_y) if arr is not None)
+
+class ByteLRUCache:
+    """
+    Thread-safe LRU cache bounded by total bytes rather than entry count, for values with an
+    nbytes attribute (RemapTables, decoded masters). Each key is built by one thread at a time.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._building = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, builder):
+        while True:
+            with self._lock:
+                table = self._entries.get(key)
+                if table is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return table
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Another thread is already building this entry (e.g. batch items of equal size): wait for it
+            building.wait()
+
+        # Build outside the lock so other sizes are not blocked behind a slow 8K grid
+        try:
+            table = builder()
+
+            with self._lock:
+                if table.nbytes > self.max_bytes:
+                    return table
+                self._entries[key] = table
+                self.current_bytes += table.nbytes
+                while self.current_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.current_bytes -= evicted.nbytes
+            return table
+        finally:
+            with self._lock:
+                del self._building[key]
+            building.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def discard_where(self, predicate):
+        """Drop every entry whose key matches predicate"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self.current_bytes -= self._entries.pop(key).nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'maxBytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+remap_cache = ByteLRUCache(REMAP_CACHE_MAX_BYTES)
+
+def _remap_from_coords(face_idx, coor_y, coor_x, src_shape, mode):
+    """
+    Turn padded source coordinates into a RemapTable.
+    src_shape is (faces, padded_height, padded_width) of the flattened source.
+    """
+    _, src_h, src_w = src_shape
+    base = None if face_idx is None else face_idx.astype(np.int32) * (src_h * src_w)
+
+    if mode == 'nearest':
+        y0 = np.clip(np.rint(coor_y), 0, src_h - 1).astype(np.int32)
+        x0 = np.clip(np.rint(coor_x), 0, src_w - 1).astype(np.int32)
+        index = y0 * src_w + x0
+        if base is not None:
+            index += base
+        return RemapTable(index, None, None, src_shape, mode)
+
+    if mode != 'bilinear':
+        raise ValueError(f'Unsupported interpolation mode "{mode}"')
+
+    # Keep the top-left corner one pixel inside so the +1 neighbours stay in bounds
+    y0 = np.clip(np.floor(coor_y), 0, src_h - 2)
+    x0 = np.clip(np.floor(coor_x), 0, src_w - 2)
+    weight_y = np.rint(np.clip(coor_y - y0, 0, 1) * SAMPLER_WEIGHT_ONE).astype(np.uint16)
+    weight_x = np.rint(np.clip(coor_x - x0, 0, 1) * SAMPLER_WEIGHT_ONE).astype(np.uint16)
+    index = y0.astype(np.int32) * src_w + x0.astype(np.int32)
+    if base is not None:
+        index += base
+    return RemapTable(index, weight_x, weight_y, src_shape, mode)
+
+def _build_c2e_remap(face_w, h, w, mode):
+    """Sphere-to-cube-face grid for c2e, same math as py360convert.c2e"""
+    uu, vv = py360convert.utils.equirect_uvgrid(h, w)
+    tp = np.asarray(py360convert.utils.equirect_facetype(h, w))
+    uu = np.asarray(uu, dtype=np.float64).reshape(h, w)
+    vv = np.asarray(vv, dtype=np.float64).reshape(h, w)
+
+    coor_x = np.empty((h, w), dtype=np.float64)
+    coor_y = np.empty((h, w), dtype=np.float64)
+    face_w2 = face_w / 2
+
+    # Middle band (front/right/back/left)
+    mask = tp < 4
+    angles = uu[mask] - (np.pi / 2 * tp[mask])
+    coor_x[mask] = face_w2 * np.tan(angles)
+    coor_y[mask] = -face_w2 * np.tan(vv[mask]) / np.cos(angles)
+
+    # Ceiling
+    mask = tp == 4
+    c = face_w2 * np.tan(np.pi / 2 - vv[mask])
+    coor_x[mask] = c * np.sin(uu[mask])
+    coor_y[mask] = c * np.cos(uu[mask])
+
+    # Floor
+    mask = tp == 5
+    c = face_w2 * np.tan(np.pi / 2 - np.abs(vv[mask]))
+    coor_x[mask] = c * np.sin(uu[mask])
+    coor_y[mask] = -c * np.cos(uu[mask])
+
+    # Renormalize into the 1px padded faces
+    coor_x = np.clip(coor_x + face_w2, 0, face_w) + 1
+    coor_y = np.clip(coor_y + face_w2, 0, face_w) + 1
+
+    return _remap_from_coords(tp, coor_y, coor_x, (6, face_w + 2, face_w + 2), mode)
+
+def _build_e2e_remap(in_h, in_w, h, w, mode):
+    """Equirect-to-equirect grid (no rotation), pixel centres mapped through the sphere"""
+    u = ((np.arange(w, dtype=np.float64) + 0.5) / w - 0.5) * 2 * np.pi
+    v = -((np.arange(h, dtype=np.float64) + 0.5) / h - 0.5) * np.pi
+    coor_x = (u / (2 * np.pi) + 0.5) * in_w - 0.5
+    coor_y = (-v / np.pi + 0.5) * in_h - 0.5
+    coor_x, coor_y = np.meshgrid(coor_x + 1, coor_y + 1)
+    return _remap_from_coords(None, coor_y, coor_x, (1, in_h + 2, in_w + 2), mode)
+
+def _build_e2c_remap(in_h, in_w, face_w, mode):
+    """Cube-face-to-sphere grid for e2c, output laid out as 6 faces side by side [F R B L U D]"""
+    xyz = np.asarray(py360convert.utils.xyzcube(face_w), dtype=np.float64)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    u = np.arctan2(x, z)
+    v = np.arctan2(y, np.hypot(x, z))
+    coor_x = (u / (2 * np.pi) + 0.5) * in_w - 0.5
+    coor_y = (-v / np.pi + 0.5) * in_h - 0.5
+    return _remap_from_coords(None, coor_y + 1, coor_x + 1, (1, in_h + 2, in_w + 2), mode)
+
+def _build_e2p_remap(in_h, in_w, h, w, view, mode):
+    """Perspective grid, same camera as py360convert.e2p; view is (yaw, pitch, horizontal fov) in degrees"""
+    yaw, pitch, fov = view
+    h_fov = math.radians(fov)
+    v_fov = 2 * math.atan(math.tan(h_fov / 2) * h / w)
+    xyz = py360convert.utils.xyzpers(h_fov, v_fov, -math.radians(yaw), math.radians(pitch), (h, w), 0)
+    xyz = np.asarray(xyz, dtype=np.float64)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    u = np.arctan2(x, z)
+    v = np.arctan2(y, np.hypot(x, z))
+    coor_x = (u / (2 * np.pi) + 0.5) * in_w - 0.5
+    coor_y = (-v / np.pi + 0.5) * in_h - 0.5
+    return _remap_from_coords(None, coor_y + 1, coor_x + 1, (1, in_h + 2, in_w + 2), mode)
+
+def _build_f2e_remap(in_h, in_w, h, w, fov, mode):
+    """Equidistant fisheye-to-equirect grid, optical axis at yaw 0, pitch 0; fov in degrees"""
+    u = ((np.arange(w, dtype=np.float64) + 0.5) / w - 0.5) * 2 * np.pi
+    v = -((np.arange(h, dtype=np.float64) + 0.5) / h - 0.5) * np.pi
+    u, v = np.meshgrid(u, v)
+    x = np.cos(v) * np.sin(u)
+    y = np.sin(v)
+    z = np.cos(v) * np.cos(u)
+    # Distance from the centre grows linearly with the angle off the optical axis
+    r = np.arccos(np.clip(z, -1, 1)) / math.radians(fov / 2)
+    phi = np.arctan2(y, x)
+    radius = min(in_w, in_h) / 2
+    coor_x = in_w / 2 + r * radius * np.cos(phi) - 0.5 + 1
+    coor_y = in_h / 2 - r * radius * np.sin(phi) - 0.5 + 1
+    outside = r > 1
+    coor_x[outside] = 0
+    coor_y[outside] = 0
+    return _remap_from_coords(None, coor_y, coor_x, (1, in_h + 2, in_w + 2), mode)
+
+def get_remap_table(operation, src_size, out_w, out_h, mode='bilinear', view=None):
+    """
+    Fetch (or build and cache) the remap grid for a conversion.
+    Key is (operation, input face/image size, output w/h, interpolation mode, e2p view or f2e fov).
+    """
+    key = (operation, src_size, out_w, out_h, mode, view)
+    if operation == 'c2e':
+        return remap_cache.get(key, lambda: _build_c2e_remap(src_size, out_h, out_w, mode))
+    if operation == 'e2e':
+        in_h, in_w = src_size
+        return remap_cache.get(key, lambda: _build_e2e_remap(in_h, in_w, out_h, out_w, mode))
+    if operation == 'e2c':
+        in_h, in_w = src_size
+        return remap_cache.get(key, lambda: _build_e2c_remap(in_h, in_w, out_h, mode))
+    if operation == 'e2p':
+        in_h, in_w = src_size
+        return remap_cache.get(key, lambda: _build_e2p_remap(in_h, in_w, out_h, out_w, view, mode))
+    if operation == 'f2e':
+        in_h, in_w = src_size
+        return remap_cache.get(key, lambda: _build_f2e_remap(in_h, in_w, out_h, out_w, view, mode))
+    raise ValueError(f'Unknown remap operation "{operation}"')
+
+def _sampling_channels(channels):
+    """
+    Channels of a padded sampling buffer: RGB is stored as RGBX so the sampler fetches
+    each pixel as one 32-bit word (the X byte is never read back).
+    """
+    return 4 if channels == 3 else channels
+
+def _pad_cube_faces(cube_faces):
+    """Add 1px of padding to each (6, S, S, C) face using pixels from its neighbours"""
+    n, size, _, channels = cube_faces.shape
+    padded = np.empty((n, size + 2, size + 2, _sampling_channels(channels)), dtype=cube_faces.dtype)
+    padded[:, 1:-1, 1:-1, :channels] = cube_faces
+    return _fill_cube_padding(padded)
+
+def _fill_cube_padding(padded):
+    """Fill the 1px border of a (6, S+2, S+2, C) buffer in place from the neighbouring faces"""
+    F, R, B, L, U, D = range(6)
+
+    # Pad above/below
+    padded[F, 0, :] = padded[U, -2, :]
+    padded[F, -1, :] = padded[D, 1, :]
+    padded[R, 0, :] = padded[U, ::-1, -2]
+    padded[R, -1, :] = padded[D, :, -2]
+    padded[B, 0, :] = padded[U, 1, ::-1]
+    padded[B, -1, :] = padded[D, -2, ::-1]
+    padded[L, 0, :] = padded[U, :, 1]
+    padded[L, -1, :] = padded[D, ::-1, 1]
+    padded[U, 0, :] = padded[B, 1, ::-1]
+    padded[U, -1, :] = padded[F, 1, :]
+    padded[D, 0, :] = padded[F, -2, :]
+    padded[D, -1, :] = padded[B, -2, ::-1]
+
+    # Pad left/right
+    padded[F, :, 0] = padded[L, :, -2]
+    padded[F, :, -1] = padded[R, :, 1]
+    padded[R, :, 0] = padded[F, :, -2]
+    padded[R, :, -1] = padded[B, :, 1]
+    padded[B, :, 0] = padded[R, :, -2]
+    padded[B, :, -1] = padded[L, :, 1]
+    padded[L, :, 0] = padded[B, :, -2]
+    padded[L, :, -1] = padded[F, :, 1]
+    padded[U, :, 0] = padded[L, 1, :]
+    padded[U, :, -1] = padded[R, 1, ::-1]
+    padded[D, :, 0] = padded[L, -2, ::-1]
+    padded[D, :, -1] = padded[R, -2, :]
+
+    return padded
+
+def _pad_equirect(img_array):
+    """Add 1px of padding that wraps horizontally and crosses the poles vertically"""
+    h, w, channels = img_array.shape
+    padded = np.empty((h + 2, w + 2, _sampling_channels(channels)), dtype=img_array.dtype)
+    padded[1:-1, 1:-1, :channels] = img_array
+    padded[0, 1:-1] = np.roll(padded[1, 1:-1], w // 2, axis=0)
+    padded[-1, 1:-1] = np.roll(padded[-2, 1:-1], w // 2, axis=0)
+    padded[:, 0] = padded[:, -2]
+    padded[:, -1] = padded[:, 1]
+    return padded[None]
+
+if numba is not None:
+    @numba.njit(nogil=True, cache=True)
+    def _bilinear_rows_jit(flat, index, weight_x, weight_y, src_w, out):
+        """One pass over the output rows, same fixed-point arithmetic as the NumPy bands"""
+        h, w = index.shape
+        channels = out.shape[2]
+        for row in range(h):
+            for col in range(w):
+                i = index[row, col]
+                wx = np.int32(weight_x[row, col])
+                wy = np.int32(weight_y[row, col])
+                for c in range(channels):
+                    top = (np.int32(flat[i, c]) * (256 - wx) + np.int32(flat[i + 1, c]) * wx + 128) >> 8
+                    bottom = (np.int32(flat[i + src_w, c]) * (256 - wx) +
+                              np.int32(flat[i + src_w + 1, c]) * wx + 128) >> 8
+                    out[row, col, c] = (top * (256 - wy) + bottom * wy + 128) >> 8
+
+def _gather(pixels, index):
+    """Source pixels at index as (..., C) uint8; RGBX sources are fetched as one uint32 per pixel"""
+    if pixels.dtype == np.uint32:
+        return np.take(pixels, index).view(np.uint8).reshape(index.shape + (4,))
+    return pixels[index]
+
+def apply_remap(src, table, out=None, row_start=0, row_stop=None, channels=None):
+    """
+    Gather/interpolate step: sample a padded (faces, H, W, C) uint8 source through a RemapTable,
+    writing the first `channels` channels (default all) straight into the uint8 output.
+    Bilinear blending is 8-bit fixed point on interleaved channels, either JIT-compiled
+    (SAMPLER_BACKEND 'numba') or in NumPy bands of REMAP_BAND_ROWS rows.
+    """
+    h, w = table.shape
+    channels = src.shape[-1] if channels is None else channels
+    row_stop = h if row_stop is None else row_stop
+    if out is None:
+        out = np.empty((row_stop - row_start, w, channels), dtype=np.uint8)
+
+    flat = src.reshape(-1, src.shape[-1])
+    src_w = table.src_shape[2]
+
+    if table.mode == 'bilinear' and SAMPLER_BACKEND == 'numba':
+        _bilinear_rows_jit(flat, table.index[row_start:row_stop], table.weight_x[row_start:row_stop],
+                           table.weight_y[row_start:row_stop], src_w, out)
+        return out
+
+    pixels = flat.view(np.uint32).reshape(-1) if src.shape[-1] == 4 else flat
+    one = SAMPLER_WEIGHT_ONE
+    half = one // 2
+
+    for band_start in range(row_start, row_stop, REMAP_BAND_ROWS):
+        band_stop = min(band_start + REMAP_BAND_ROWS, row_stop)
+        index = table.index[band_start:band_stop]
+        dest = out[band_start - row_start:band_stop - row_start]
+
+        if table.mode == 'nearest':
+            dest[...] = _gather(pixels, index)[..., :channels]
+            continue
+
+        # uint16 never overflows: 255 * 256 + 128 < 65536
+        wx = table.weight_x[band_start:band_stop, :, None]
+        wy = table.weight_y[band_start:band_stop, :, None]
+        wx_inv = one - wx
+        top = _gather(pixels, index).astype(np.uint16)
+        top *= wx_inv
+        top += _gather(pixels, index + 1) * wx
+        top += half
+        top >>= SAMPLER_WEIGHT_BITS
+        bottom = _gather(pixels, index + src_w).astype(np.uint16)
+        bottom *= wx_inv
+        bottom += _gather(pixels, index + src_w + 1) * wx
+        bottom += half
+        bottom >>= SAMPLER_WEIGHT_BITS
+        top *= one - wy
+        bottom *= wy
+        top += bottom
+        top += half
+        top >>= SAMPLER_WEIGHT_BITS
+        dest[...] = top[..., :channels]
+
+    return out
+
+_sampler_pool = None
+_sampler_pool_pid = None
+_sampler_pool_lock = threading.Lock()
+
+def get_sampler_pool():
+    """Shared thread pool for parallel sampling, recreated after a fork (threads don't survive it)"""
+    global _sampler_pool, _sampler_pool_pid
+    with _sampler_pool_lock:
+        if _sampler_pool is None or _sampler_pool_pid != os.getpid():
+            _sampler_pool = ThreadPoolExecutor(max_workers=SAMPLER_THREADS, thread_name_prefix='sampler')
+            _sampler_pool_pid = os.getpid()
+        return _sampler_pool
+
+def parallel_remap(src, table, workers=None, row_start=0, row_stop=None, channels=None):
+    """
+    Sample a RemapTable (or rows row_start:row_stop of it) using row bands spread over the sampler threads.
+    Threads read the same source array and write disjoint rows of one output array,
+    so nothing is copied or pickled; the NumPy gather/blend kernels release the GIL.
+    """
+    workers = SAMPLER_THREADS if workers is None else workers
+    row_stop = table.shape[0] if row_stop is None else row_stop
+    h = row_stop - row_start
+    channels = src.shape[-1] if channels is None else channels
+    out = np.empty((h, table.shape[1], channels), dtype=np.uint8)
+
+    if workers <= 1 or h <= REMAP_BAND_ROWS:
+        return apply_remap(src, table, out, row_start, row_stop, channels)
+
+    # A few bands per worker keeps the load even when bands differ in cost (poles vs. equator)
+    band_rows = max(REMAP_BAND_ROWS, -(-h // (workers * 4)))
+    bands = [(start, min(start + band_rows, row_stop)) for start in range(row_start, row_stop, band_rows)]
+    pool = get_sampler_pool()
+    futures = [
+        pool.submit(charge_cpu(apply_remap), src, table, out[start - row_start:stop - row_start], start, stop, channels)
+        for start, stop in bands
+    ]
+    for future in futures:
+        future.result()
+    return out
+
+def remap_to_image(src, table, strip_rows=LOW_MEMORY_STRIP_ROWS):
+    """
+    Low-memory parallel_remap for an RGB(X) source: samples strip_rows rows at a time and pastes
+    each strip into the PIL image the encoder will read, so the full-size uint8 array
+    (3 bytes per output pixel on top of the image's 4) is never allocated.
+    """
+    h, w = table.shape
+    image = Image.new('RGB', (w, h))
+    for start in range(0, h, strip_rows):
+        stop = min(start + strip_rows, h)
+        strip = parallel_remap(src, table, row_start=start, row_stop=stop, channels=3)
+        image.paste(Image.fromarray(strip), (0, start))
+    return image
+
+def cubemap_to_equirect(cube_faces, h, w, mode='bilinear'):
+    """
+    Cached replacement for py360convert.c2e(cube_format='list').
+    cube_faces: 6 uint8 arrays in py360convert order [F, R, B, L, U, D]
+    """
+    faces = np.stack(cube_faces)
+    if faces.ndim == 3:
+        faces = faces[..., None]
+    if faces.shape[1] != faces.shape[2]:
+        raise ValueError('Cubemap faces must be square')
+
+    table = get_remap_table('c2e', faces.shape[1], w, h, mode)
+    equirect = parallel_remap(_pad_cube_faces(faces), table, channels=faces.shape[-1])
+    return equirect[..., 0] if np.ndim(cube_faces[0]) == 2 else equirect
+
+def padded_cubemap_to_equirect(padded, h, w, mode='bilinear', channels=3):
+    """
+    Like cubemap_to_equirect, but for a (6, S+2, S+2, RGBX) buffer whose interior already holds
+    the faces (see preprocess_cube_faces). The border is filled in place, so no copy is made.
+    """
+    _fill_cube_padding(padded)
+    table = get_remap_table('c2e', padded.shape[1] - 2, w, h, mode)
+    return parallel_remap(padded, table, channels=channels)
+
+def horizontal_cubemap_to_equirect(cube_h, h, w, mode='bilinear'):
+    """Cached replacement for py360convert.c2e(cube_format='horizon')"""
+    if cube_h.shape[0] * 6 != cube_h.shape[1]:
+        raise ValueError("Cubemap's width must be 6x its height")
+    return cubemap_to_equirect(np.split(cube_h, 6, axis=1), h, w, mode)
+
+def _padded_equirect_from_image(image, strip_rows=LOW_MEMORY_STRIP_ROWS):
+    """
+    _pad_equirect for an RGB PIL image (or array view), copied in row strips so the only
+    full-size allocation is the padded buffer itself (np.array(image) would add another).
+    """
+    width, height = image_size(image)
+    padded = np.empty((1, height + 2, width + 2, 4), dtype=np.uint8)
+    if isinstance(image, np.ndarray):
+        padded[0, 1:-1, 1:-1, :3] = image
+    else:
+        for start in range(0, height, strip_rows):
+            stop = min(start + strip_rows, height)
+            padded[0, start + 1:stop + 1, 1:-1, :3] = np.asarray(image.crop((0, start, width, stop)))
+    padded[0, 0, 1:-1] = np.roll(padded[0, 1, 1:-1], width // 2, axis=0)
+    padded[0, -1, 1:-1] = np.roll(padded[0, -2, 1:-1], width // 2, axis=0)
+    padded[0, :, 0] = padded[0, :, -2]
+    padded[0, :, -1] = padded[0, :, 1]
+    return padded
+
+def equirect_to_equirect(img_array, h, w, mode='bilinear'):
+    """Cached equirect resampling used by the e2e branches"""
+    squeeze = img_array.ndim == 2
+    if squeeze:
+        img_array = img_array[..., None]
+
+    table = get_remap_table('e2e', img_array.shape[:2], w, h, mode)
+    equirect = parallel_remap(_pad_equirect(img_array), table, channels=img_array.shape[-1])
+    return equirect[..., 0] if squeeze else equirect
+
+def equirect_to_cube_faces(img_array, face_w, mode='bilinear'):
+    """Cached replacement for py360convert.e2c(cube_format='list'), returns [F, R, B, L, U, D]"""
+    table = get_remap_table('e2c', img_array.shape[:2], face_w * 6, face_w, mode)
+    cube_h = parallel_remap(_pad_equirect(img_array), table, channels=img_array.shape[-1])
+    return np.split(cube_h, 6, axis=1)
+
+def cube_face_table(src_size, face_w, face, mode='bilinear'):
+    """The columns of the cached e2c grid that make up one cube face (a name from CUBE_FACE_ORDER)"""
+    i = CUBE_FACE_ORDER.index(face)
+    return get_remap_table('e2c', src_size, face_w * 6, face_w, mode).columns(i * face_w, (i + 1) * face_w)
+
+def equirect_to_cube_face(img_array, face_w, face, mode='bilinear'):
+    """One cube face, sampling only that slice of the cached e2c grid"""
+    table = cube_face_table(img_array.shape[:2], face_w, face, mode)
+    return parallel_remap(_pad_equirect(img_array), table, channels=img_array.shape[-1])
+
+def equirect_to_perspective(img_array, width, height, yaw=0.0, pitch=0.0, fov=90.0, mode='bilinear'):
+    """Cached replacement for py360convert.e2p(img, fov, yaw, pitch, (height, width))"""
+    table = get_remap_table('e2p', img_array.shape[:2], width, height, mode, view=(yaw, pitch, fov))
+    return parallel_remap(_pad_equirect(img_array), table, channels=img_array.shape[-1])
+
+def open_image(source, min_size=None):
+    """
+    Open an image lazily and, for JPEGs, switch the decoder to DCT scaling (1/2, 1/4, 1/8)
+    so it decodes no more pixels than min_size=(width, height) needs.
+    Pillow's draft() always keeps the result at least min_size in both dimensions.
+    """
+    img = Image.open(source)
+    if min_size and img.format == 'JPEG':
+        img.draft('RGB', (max(int(min_size[0]), 1), max(int(min_size[1]), 1)))
+    return img
+
+def load_rgb(img):
+    """Decode a lazily opened image as RGB (convert() would copy an image that already is RGB)"""
+    with stage('decode'):
+        if img.mode != 'RGB':
+            return img.convert('RGB')
+        img.load()
+        return img
+
+def open_upload_image(source, min_size=None):
+    """open_image + decode to RGB, the form every route works with"""
+    return load_rgb(open_image(source, min_size))
+
+def image_size(image):
+    """(width, height) of a PIL image or an (H, W, 3) uint8 array such as a SharedArray view"""
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+def as_pil_image(image):
+    """PIL image for the conversion functions' PIL-only steps (LANCZOS resizes); arrays are copied"""
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image)
+    return image
+
+def equirect_source_size(output_width):
+    """Smallest source that still fills an output_width x output_width/2 equirect"""
+    return (output_width, output_width // 2)
+
+def stitch_face_source_size(output_width, fov_correction=0.80):
+    """
+    Smallest face that still fills the output: each face spans a quarter of the
+    equirect width, and the walls lose (1 - fov_correction) of their size to the crop.
+    """
+    face = int(math.ceil(output_width / 4 / fov_correction))
+    return (face, face)
+
+def convert_to_equirectangular(image_path, output_path, target_width=4096, encoder=None):
+    """
+    Convert image to equirectangular format using py360convert
+    Supports various input formats (see classify_projection): equirectangular, GPano partial
+    panoramas, horizontal and cross cubemaps; anything else is stretched over the sphere.
+    image_path may also be an already decoded (H, W, 3) uint8 array (e.g. a SharedArray view).
+    encoder is an EncoderPreset (default: the 'jpeg' preset, quality 95 + optimize)
+    """
+    try:
+        # Classify once (GPano metadata, aspect ratio, thumbnail), decoding JPEGs at the
+        # reduced scale that projection needs
+        if isinstance(image_path, np.ndarray):
+            img = image_path
+            projection = classify_projection(img)
+        else:
+            img, projection = open_classified(image_path, target_width)
+            img = load_rgb(img)
+        
+        equirect_img = convert_image_to_equirect(img, target_width, projection)
+        
+        # Save (temp file + rename, so an interrupted run leaves no partial output)
+        save_panorama(equirect_img, output_path, encoder)
+        
+        return True, None
+    
+    except Exception as e:
+        return False, str(e)
+
+def crop_to_center_square(img, target_size=None):
+    """
+    Crop image to center square to remove edges and reduce overlapping artifacts.
+    This helps make stitching appear more flush by using only the central portion.
+    """
+    width, height = img.size
+    min_dim = min(width, height)
+    
+    # Calculate crop box to get center square
+    left = (width - min_dim) // 2
+    top = (height - min_dim) // 2
+    right = left + min_dim
+    bottom = top + min_dim
+    
+    cropped = img.crop((left, top, right, bottom))
+    
+    # If target size specified, resize to it
+    if target_size:
+        cropped = cropped.resize((target_size, target_size), Image.Resampling.LANCZOS)
+    
+    return cropped
+
+def adjust_perspective_distortion(img, fov_correction=0.80):
+    """
+    Apply aggressive center crop to reduce perspective distortion at edges.
+    This creates a more flush appearance by using the less distorted central area.
+    """
+    width, height = img.size
+    
+    # Calculate new dimensions (crop edges by fov_correction factor)
+    new_width = int(width * fov_correction)
+    new_height = int(height * fov_correction)
+    
+    left = (width - new_width) // 2
+    top = (height - new_height) // 2
+    right = left + new_width
+    bottom = top + new_height
+    
+    cropped = img.crop((left, top, right, bottom))
+    # Resize back to original dimensions
+    return cropped.resize((width, height), Image.Resampling.LANCZOS)
+
+def face_source_box(width, height, target_size, fov_correction=None):
+    """
+    Source-pixel box equivalent to crop_to_center_square(img, target_size) followed by
+    adjust_perspective_distortion(fov_correction), so both steps become a single resample.
+    """
+    min_dim = min(width, height)
+    left = (width - min_dim) // 2
+    top = (height - min_dim) // 2
+    if not fov_correction:
+        return (left, top, left + min_dim, top + min_dim)
+
+    # Same integer crop adjust_perspective_distortion would take at target_size, scaled back to source pixels
+    scale = min_dim / target_size
+    new_size = int(target_size * fov_correction)
+    offset = (target_size - new_size) // 2
+    return (
+        left + offset * scale,
+        top + offset * scale,
+        left + (offset + new_size) * scale,
+        top + (offset + new_size) * scale
+    )
+
+def preprocess_cube_faces(faces, target_size, fov_correction=0.80):
+    """
+    Fused crop/scale/FOV correction for the six stitch inputs.
+    Each face is resampled once (LANCZOS over its source box) straight into one stacked
+    (6, S+2, S+2, RGBX) uint8 buffer in [F, R, B, L, U, D] order, leaving a 1px border for
+    padded_cubemap_to_equirect. Walls get the fov_correction crop, ceiling/floor do not.
+
+    Faces are popped from the dict as they are consumed, and may be lazily opened
+    (see open_image), so only one decoded face is alive at a time, or Futures of faces
+    being decoded concurrently (see decode_faces).
+
+    Args:
+        faces: dict of face name -> PIL Image, (H, W, 3) uint8 array or Future of either
+            (emptied by this call)
+        target_size: Output face size S
+    """
+    padded = np.empty((6, target_size + 2, target_size + 2, 4), dtype=np.uint8)
+
+    for i, name in enumerate(CUBE_FACE_ORDER):
+        img = faces.pop(name)
+        if isinstance(img, Future):
+            with stage('decode'):
+                img = img.result()
+        elif not isinstance(img, np.ndarray):
+            img = load_rgb(img)
+        with stage('preprocess'):
+            size = image_size(img)
+            box = face_source_box(size[0], size[1], target_size,
+                                  fov_correction if name in WALL_FACES else None)
+
+            if size == (target_size, target_size) and box == (0, 0, target_size, target_size):
+                # Already the right square, nothing to resample
+                resampled = img
+            else:
+                resampled = as_pil_image(img).resize((target_size, target_size), Image.Resampling.LANCZOS, box=box)
+
+            padded[i, 1:-1, 1:-1, :3] = np.asarray(resampled)
+        del img, resampled
+
+    return padded
+
+# Optional seam blending for stitches (blend=1): per-face gain compensation, then feathering
+# of whatever colour step is left at each edge into a band on both sides of the seam
+SEAM_FEATHER_FRACTION = 1 / 16  # band width as a fraction of the face size
+SEAM_SMOOTH_FRACTION = 1 / 32  # box filter along each edge, so parallax detail doesn't streak into the band
+SEAM_MAX_CORRECTION = 48  # levels; bigger steps are content (not exposure) and are left alone
+GAIN_SIGMA_N = 10.0  # Brown & Lowe: expected intensity noise ...
+GAIN_SIGMA_G = 0.1  # ... and gain spread, which pulls gains towards 1
+GAIN_LIMITS = (0.5, 2.0)
+
+# Neighbour of each face in [F, R, B, L, U, D] order across each of its sides. After
+# _fill_cube_padding the padding row/column on that side holds the neighbour's pixels along
+# the shared edge, aligned with the face's own edge pixels.
+CUBE_NEIGHBOURS = {
+    'top': [4, 4, 4, 4, 2, 0],
+    'bottom': [5, 5, 5, 5, 0, 2],
+    'left': [3, 0, 1, 2, 3, 3],
+    'right': [1, 2, 3, 0, 1, 1]
+}
+
+def _edge_pixels(padded, side):
+    """(own, neighbour) RGB pixels along one side of every face, each (6, S, 3)"""
+    if side == 'top':
+        return padded[:, 1, 1:-1, :3], padded[:, 0, 1:-1, :3]
+    if side == 'bottom':
+        return padded[:, -2, 1:-1, :3], padded[:, -1, 1:-1, :3]
+    if side == 'left':
+        return padded[:, 1:-1, 1, :3], padded[:, 1:-1, 0, :3]
+    return padded[:, 1:-1, -2, :3], padded[:, 1:-1, -1, :3]
+
+def cube_face_gains(padded):
+    """
+    Per-face, per-channel gains that best match the faces along their shared edges
+    (Brown & Lowe gain compensation on the edge means), shape (6, 3).
+    """
+    size = padded.shape[1] - 2
+    a = np.zeros((3, 6, 6))
+    b = np.zeros((3, 6))
+    for side, neighbours in CUBE_NEIGHBOURS.items():
+        own, neighbour = _edge_pixels(padded, side)
+        own_mean = own.mean(axis=1)
+        neighbour_mean = neighbour.mean(axis=1)
+        for i, j in enumerate(neighbours):
+            # size * ((g_i m_i - g_j m_j)^2 / sigma_n^2 + (1 - g_i)^2 / sigma_g^2), summed over edges
+            m_i, m_j = own_mean[i], neighbour_mean[i]
+            a[:, i, i] += size * (m_i * m_i / GAIN_SIGMA_N ** 2 + 1 / GAIN_SIGMA_G ** 2)
+            a[:, j, j] += size * m_j * m_j / GAIN_SIGMA_N ** 2
+            a[:, i, j] -= size * m_i * m_j / GAIN_SIGMA_N ** 2
+            a[:, j, i] -= size * m_i * m_j / GAIN_SIGMA_N ** 2
+            b[:, i] += size / GAIN_SIGMA_G ** 2
+    return np.clip(np.linalg.solve(a, b[..., None])[..., 0].T, *GAIN_LIMITS)
+
+def _smooth_along_edge(values, radius):
+    """Box filter (6, S, C) edge profiles along S, clamping at the ends"""
+    padded = np.pad(values, ((0, 0), (radius + 1, radius), (0, 0)), mode='edge')
+    total = np.cumsum(padded, axis=1, dtype=np.float32)
+    return (total[:, 2 * radius + 1:] - total[:, :-2 * radius - 1]) / (2 * radius + 1)
+
+@lru_cache(maxsize=16)
+def seam_feather_ramp(size):
+    """
+    Weight of the seam correction by distance from the edge for a face size: 0.5 at the edge
+    (each side moves halfway, so they meet) falling linearly to 0 across the band.
+    """
+    band = max(int(size * SEAM_FEATHER_FRACTION), 1)
+    ramp = 0.5 * (1 - (np.arange(band, dtype=np.float32) + 0.5) / band)
+    ramp.setflags(write=False)
+    return ramp
+
+def blend_cube_seams(padded):
+    """
+    Even out exposure between the faces of a (6, S+2, S+2, RGBX) buffer from
+    preprocess_cube_faces, in place: gain-compensate each face, then feather the
+    remaining step along every edge. Past the gains (one table lookup per pixel) only
+    bands of S/16 next to the edges are touched, so it costs a small fraction of a stitch.
+    """
+    size = padded.shape[1] - 2
+    interior = padded[:, 1:-1, 1:-1]
+
+    # Step 1: gains from the edge means, applied per face through Pillow's lookup tables
+    # (point() on the RGBX buffer is several times faster than NumPy indexing per channel).
+    # The face image only reads the buffer; the adjusted copy is written back through NumPy.
+    _fill_cube_padding(padded)
+    levels = np.arange(256, dtype=np.float32)
+    for i, face_gains in enumerate(cube_face_gains(padded)):
+        if np.all(np.abs(face_gains - 1) < 1e-3):
+            continue
+        luts = [np.clip(np.rint(levels * gain), 0, 255).astype(np.uint8) for gain in face_gains]
+        luts.append(np.arange(256, dtype=np.uint8))  # X
+        face = Image.frombuffer('RGBX', padded.shape[2:0:-1], padded[i], 'raw', 'RGBX', 0, 1)
+        padded[i] = np.asarray(face.point(np.concatenate(luts).tolist()))
+
+    # Step 2: the colour step left at each edge, smoothed along it and capped (X gets none, so
+    # the bands below can be updated as whole contiguous RGBX rows)
+    _fill_cube_padding(padded)
+    radius = max(int(size * SEAM_SMOOTH_FRACTION), 1)
+    steps = {}
+    for side in CUBE_NEIGHBOURS:
+        own, neighbour = _edge_pixels(padded, side)
+        step = np.zeros((6, size, 4), dtype=np.float32)
+        step[..., :3] = _smooth_along_edge(neighbour.astype(np.float32) - own, radius)
+        steps[side] = np.clip(step, -SEAM_MAX_CORRECTION, SEAM_MAX_CORRECTION)
+
+    # Step 3: feather each step into its band with the cached ramp
+    ramp = seam_feather_ramp(size)
+    band = len(ramp)
+    bands = {
+        'top': (np.s_[:, :band], ramp[None, :, None, None], lambda step: step[:, None]),
+        'bottom': (np.s_[:, -band:], ramp[::-1][None, :, None, None], lambda step: step[:, None]),
+        'left': (np.s_[:, :, :band], ramp[None, None, :, None], lambda step: step[:, :, None]),
+        'right': (np.s_[:, :, -band:], ramp[::-1][None, None, :, None], lambda step: step[:, :, None])
+    }
+    for side, (region, weights, expand) in bands.items():
+        values = interior[region].astype(np.float32)
+        values += weights * expand(steps[side])
+        values += 0.5
+        np.clip(values, 0, 255, out=values)
+        interior[region] = values
+    return padded
+
+def estimate_blend_memory(target_size):
+    """Float copy of one side's RGBX bands on all six faces, or one face through point()"""
+    return max(6 * target_size * len(seam_feather_ramp(target_size)) * 4 * 4, (target_size + 2) ** 2 * 4)
+
+def stitch_cubemap_to_equirectangular(front, back, left, right, top, bottom, output_width=4096):
+    """
+    Stitch 6 individual photos (cubemap faces) into an equirectangular panorama.
+    Includes preprocessing to reduce overlapping and improve flush appearance.
+    
+    Args:
+        front, back, left, right, top, bottom: PIL Image objects or (H, W, 3) uint8 arrays
+        output_width: Width of output equirectangular image (height will be width/2)
+    
+    Returns:
+        PIL Image object in equirectangular format
+    """
+    faces = {
+        'front': front,
+        'back': back,
+        'left': left,
+        'right': right,
+        'top': top,
+        'bottom': bottom
+    }
+    return stitch_faces(faces, output_width)
+
+def stitch_faces(faces, output_width=4096, low_memory=False, blend=False):
+    """
+    stitch_cubemap_to_equirectangular for a dict of face name -> PIL Image or array view.
+    Faces may be lazily opened and are released as they are consumed (the dict is emptied);
+    outside low_memory mode they are decoded concurrently on the decode pool.
+    With low_memory the output is sampled in strips straight into the returned image,
+    with blend the seams are evened out first (see blend_cube_seams).
+    """
+    # Find the target size based on the smallest dimension
+    target_size = min(image_size(img)[0] for img in faces.values())
+    if not low_memory:
+        decode_faces(faces)
+    
+    # Center-square crop + perspective correction (walls only) + resize, fused into one
+    # resample per face and written straight into the stacked [F, R, B, L, U, D] buffer
+    padded_faces = preprocess_cube_faces(faces, target_size, fov_correction=0.80)
+    if blend:
+        with stage('blend'):
+            blend_cube_seams(padded_faces)
+    
+    # Convert cubemap to equirectangular with smoother interpolation
+    output_height = output_width // 2
+    with stage('convert'):
+        if low_memory:
+            _fill_cube_padding(padded_faces)
+            return remap_to_image(padded_faces, get_remap_table('c2e', target_size, output_width, output_height))
+
+        equirect = padded_cubemap_to_equirect(
+            padded_faces,
+            h=output_height,
+            w=output_width,
+            mode='bilinear'
+        )
+        del padded_faces
+        
+        # Convert back to PIL Image
+        return Image.fromarray(equirect)
+
+def convert_image_to_equirect(image, output_width, projection=None):
+    """
+    Convert an uploaded RGB PIL image (or (H, W, 3) uint8 array view) to an equirectangular
+    PIL image with the converter its projection calls for (classified here when not given).
+    Shared by /convert, /upload-panorama, the background job workers and the CLI.
+    """
+    projection = refine_projection(projection or classify_projection(image), image)
+    projections_total.inc({'kind': projection.kind, 'reason': projection.reason})
+    width, height = image_size(image)
+    output_height = output_width // 2
+
+    if projection.kind == 'equirect':
+        # Already equirectangular, just resize
+        return as_pil_image(image).resize((output_width, output_height), Image.Resampling.LANCZOS)
+    if projection.kind == 'equirect-partial':
+        return partial_equirect_to_equirect(image, projection.crop, output_width)
+
+    img_array = np.asarray(image)
+    if projection.kind == 'cubemap-horizon':
+        size = min(height, width // 6)
+        equirect = horizontal_cubemap_to_equirect(img_array[:size, :size * 6], output_height, output_width)
+    elif projection.kind == 'cubemap-cross':
+        equirect = cross_cubemap_to_equirect(img_array, projection.layout, output_height, output_width)
+    elif projection.kind == 'fisheye':
+        equirect = fisheye_to_equirect(img_array, output_height, output_width)
+    else:
+        # Anything else (full-frame fisheye, perspective, ...) is stretched over the sphere
+        equirect = equirect_to_equirect(
+            img_array,
+            h=output_height,
+            w=output_width,
+            mode='bilinear'
+        )
+    return Image.fromarray(equirect)
+
+def convert_upload_to_equirect(file_bytes, output_width, low_memory=False, projection=None):
+    """
+    Decode an uploaded file (or take an already decoded array view, classified by the caller
+    that still had its metadata) and convert it with convert_image_to_equirect.
+    With low_memory the decoded upload is copied into the padded sampling buffer in strips
+    and dropped before the output is allocated, and the output is sampled in strips.
+    Returns (equirect image, Projection).
+    """
+    if isinstance(file_bytes, np.ndarray):
+        image = file_bytes
+        projection = projection or classify_projection(image)
+    else:
+        image, projection = open_classified(file_bytes, output_width)
+        image = load_rgb(image)
+    with stage('classify'):
+        projection = refine_projection(projection, image)
+    with stage('convert'):
+        width, height = image_size(image)
+        if not low_memory or projection.kind != 'other':
+            return convert_image_to_equirect(image, output_width, projection), projection
+
+        projections_total.inc({'kind': projection.kind, 'reason': projection.reason})
+        padded = _padded_equirect_from_image(image)
+        del image
+        table = get_remap_table('e2e', (height, width), output_width, output_width // 2)
+        return remap_to_image(padded, table), projection
+
+# ---------------------------------------------------------------------------
+# Projection detection
+# ---------------------------------------------------------------------------
+
+# Every input is classified once, before any conversion work: XMP GPano metadata first, then
+# the aspect ratio from the header (which also picks the JPEG draft scale), then for the 4:3 /
+# 3:4 shapes cross cubemaps share with ordinary photos, and the square frame of a circular
+# fisheye, a thumbnail check of the decoded pixels
+PROJECTION_KINDS = ('equirect', 'equirect-partial', 'cubemap-horizon', 'cubemap-cross', 'fisheye', 'other')
+# Recorded for /stitch outputs, which are made from six separate face photos, not one classified input
+STITCH_PROJECTION = 'cubemap-faces'
+ASPECT_TOLERANCE = 0.05  # relative
+# Cell (column, row) of each face in [F, R, B, L, U, D] order; faces listed in 'rotated' are
+# stored upside down (the back face of a vertical cross hangs below the bottom face)
+CROSS_LAYOUTS = {
+    'horizontal': {'grid': (4, 3), 'cells': [(1, 1), (2, 1), (3, 1), (0, 1), (1, 0), (1, 2)], 'rotated': ()},
+    'vertical': {'grid': (3, 4), 'cells': [(1, 1), (2, 1), (1, 3), (0, 1), (1, 0), (1, 2)], 'rotated': (2,)},
+}
+# Thumbnail samples per cell side, the per-channel std (0..255) below which a cell counts as
+# flat, and how far apart the empty cells' colours may be
+CROSS_CELL_SAMPLES = 8
+CROSS_FLAT_STD = 6.0
+# Circular fisheyes: an equidistant lens of this field of view looking at yaw 0, pitch 0; the
+# thumbnail side checked, and the brightness (0..255) the corners outside the circle stay under
+FISHEYE_FOV_DEGREES = float(os.environ.get('PANORAMA_FISHEYE_FOV', 180))
+FISHEYE_SAMPLES = 32
+FISHEYE_DARK_LEVEL = 24
+app.config['FISHEYE_FOV_DEGREES'] = FISHEYE_FOV_DEGREES
+CROSS_BACKGROUND_SPREAD = 24.0
+
+_GPANO_FIELD = re.compile(r'GPano:(\w+)\s*(?:=\s*"([^"]*)"|>([^<]*)<)')
+
+projections_total = Counter('panorama_projections_total', 'Converted inputs by detected projection and how it was decided')
+
+class Projection:
+    """How an input maps onto the sphere (see classify_projection), small enough to send to job workers"""
+    def __init__(self, kind, reason, size, layout=None, crop=None):
+        self.kind = kind  # one of PROJECTION_KINDS
+        self.reason = reason  # 'metadata', 'aspect' or 'thumbnail'
+        self.size = size  # (width, height) of the input as classified
+        self.layout = layout  # CROSS_LAYOUTS key for cubemap-cross
+        self.crop = crop  # GPano (full_w, full_h, left, top, crop_w, crop_h) for equirect-partial
+
+    def source_size(self, output_width):
+        """Smallest decode (open_image min_size) that still fills an output_width equirect"""
+        width, height = self.size
+        face = int(math.ceil(output_width / 4))
+        if self.kind == 'cubemap-horizon':
+            return (face * 6, face)
+        if self.kind == 'cubemap-cross':
+            cols, rows = CROSS_LAYOUTS[self.layout]['grid']
+            return (face * cols, face * rows)
+        if self.kind == 'equirect-partial':
+            full_w, _, _, _, crop_w, _ = self.crop
+            covered = int(math.ceil(output_width * crop_w / full_w))
+            return (covered, int(math.ceil(covered * height / width)))
+        # Also enough for a fisheye (its circle spans at most 360 degrees of the output), which
+        # is decoded before the pixels decide whether it is one or falls back to 'other'
+        return equirect_source_size(output_width)
+
+def _aspect_matches(width, height, aspect):
+    return abs(width / height / aspect - 1) < ASPECT_TOLERANCE
+
+def read_gpano(img):
+    """GPano XMP properties (name -> string) of a lazily opened image, {} when it has none"""
+    xmp = img.info.get('xmp') or img.info.get('XML:com.adobe.xmp') or ''
+    if isinstance(xmp, bytes):
+        xmp = xmp.decode('utf-8', 'ignore')
+    return {name: attribute or element for name, attribute, element in _GPANO_FIELD.findall(xmp)}
+
+def _gpano_crop(gpano, width, height):
+    """(full_w, full_h, left, top, crop_w, crop_h) from GPano properties, None if unusable"""
+    try:
+        full_w = int(float(gpano['FullPanoWidthPixels']))
+        full_h = int(float(gpano.get('FullPanoHeightPixels', full_w // 2)))
+        crop_w = int(float(gpano.get('CroppedAreaImageWidthPixels', width)))
+        crop_h = int(float(gpano.get('CroppedAreaImageHeightPixels', height)))
+        left = int(float(gpano.get('CroppedAreaLeftPixels', 0)))
+        top = int(float(gpano.get('CroppedAreaTopPixels', 0)))
+    except (KeyError, ValueError):
+        return None
+    if min(full_w, full_h, crop_w, crop_h) <= 0 or crop_h > full_h or crop_w > full_w:
+        return None
+    return (full_w, full_h, left, top, crop_w, crop_h)
+
+def classify_projection(img):
+    """
+    Header-only classification of an input (a lazily opened image, or an array, which has no
+    metadata): GPano says equirectangular (full or partial), else the aspect ratio decides.
+    Cross cubemaps and fisheyes are only candidates here, refine_projection checks them on the pixels.
+    """
+    width, height = image_size(img)
+    gpano = {} if isinstance(img, np.ndarray) else read_gpano(img)
+    if gpano.get('ProjectionType', '').lower() == 'equirectangular':
+        crop = _gpano_crop(gpano, width, height)
+        if crop is not None:
+            full_w, full_h, _, _, crop_w, crop_h = crop
+            if crop_w >= full_w and crop_h >= full_h:
+                return Projection('equirect', 'metadata', (width, height))
+            return Projection('equirect-partial', 'metadata', (width, height), crop=crop)
+
+    if _aspect_matches(width, height, 2):
+        return Projection('equirect', 'aspect', (width, height))
+    if _aspect_matches(width, height, 6):
+        return Projection('cubemap-horizon', 'aspect', (width, height))
+    for layout, spec in CROSS_LAYOUTS.items():
+        cols, rows = spec['grid']
+        if _aspect_matches(width, height, cols / rows):
+            return Projection('cubemap-cross', 'aspect', (width, height), layout=layout)
+    if _aspect_matches(width, height, 1):
+        return Projection('fisheye', 'aspect', (width, height))
+    return Projection('other', 'aspect', (width, height))
+
+def open_classified(source, output_width):
+    """Lazily open an upload (path, bytes or stream) with the draft size its projection needs"""
+    projection = classify_projection(Image.open(upload_stream(source)))
+    return open_image(upload_stream(source), projection.source_size(output_width)), projection
+
+def _cross_cells_match(image, layout):
+    """
+    Thumbnail check of a cross cubemap candidate: the grid cells outside the cross must be
+    flat and share one background colour, and most face cells must not be flat.
+    """
+    spec = CROSS_LAYOUTS[layout]
+    cols, rows = spec['grid']
+    n = CROSS_CELL_SAMPLES
+    width, height = image_size(image)
+    if isinstance(image, np.ndarray):
+        ys = ((np.arange(rows * n) + 0.5) * height / (rows * n)).astype(np.intp)
+        xs = ((np.arange(cols * n) + 0.5) * width / (cols * n)).astype(np.intp)
+        thumb = image[ys[:, None], xs]
+    else:
+        thumb = np.asarray(image.resize((cols * n, rows * n), Image.Resampling.NEAREST))
+    cells = thumb.reshape(rows, n, cols, n, -1).swapaxes(1, 2).reshape(rows, cols, n * n, -1).astype(np.float32)
+    flat = cells.std(axis=2).max(axis=-1) < CROSS_FLAT_STD
+    means = cells.mean(axis=2)
+
+    face_cells = set(spec['cells'])
+    empty_cells = [(col, row) for row in range(rows) for col in range(cols) if (col, row) not in face_cells]
+    if not all(flat[row, col] for col, row in empty_cells):
+        return False
+    background = np.array([means[row, col] for col, row in empty_cells])
+    if np.ptp(background, axis=0).max() > CROSS_BACKGROUND_SPREAD:
+        return False
+    return sum(1 for col, row in face_cells if not flat[row, col]) >= len(face_cells) // 2
+
+def _fisheye_circle_matches(image):
+    """
+    Thumbnail check of a fisheye candidate: the corners outside the inscribed circle must be
+    dark, as a circular fisheye leaves them, and the inside of the circle must not be flat.
+    """
+    n = FISHEYE_SAMPLES
+    width, height = image_size(image)
+    if isinstance(image, np.ndarray):
+        ys = ((np.arange(n) + 0.5) * height / n).astype(np.intp)
+        xs = ((np.arange(n) + 0.5) * width / n).astype(np.intp)
+        thumb = image[ys[:, None], xs]
+    else:
+        thumb = np.asarray(image.resize((n, n), Image.Resampling.NEAREST))
+    thumb = thumb.reshape(n, n, -1).astype(np.float32)
+    centres = (np.arange(n) + 0.5) / n * 2 - 1
+    radius = np.hypot(centres[:, None], centres)
+
+    corners = thumb[radius > 1.1]
+    inside = thumb[radius < 0.8]
+    return corners.max() < FISHEYE_DARK_LEVEL and inside.std(axis=0).max() >= CROSS_FLAT_STD
+
+def refine_projection(projection, image):
+    """Confirm a cross cubemap or fisheye candidate on the decoded image, or fall back to 'other'"""
+    if projection.kind not in ('cubemap-cross', 'fisheye') or projection.reason != 'aspect':
+        return projection
+    if projection.kind == 'fisheye':
+        if _fisheye_circle_matches(image):
+            return Projection('fisheye', 'thumbnail', projection.size)
+    elif _cross_cells_match(image, projection.layout):
+        return Projection('cubemap-cross', 'thumbnail', projection.size, layout=projection.layout)
+    return Projection('other', 'thumbnail', projection.size)
+
+def cross_cubemap_to_equirect(cross, layout, h, w, mode='bilinear'):
+    """Cross cubemap (see CROSS_LAYOUTS) to equirect, each face copied once into the padded sampling buffer"""
+    spec = CROSS_LAYOUTS[layout]
+    cols, rows = spec['grid']
+    size = min(cross.shape[1] // cols, cross.shape[0] // rows)
+    channels = cross.shape[-1]
+    padded = np.empty((6, size + 2, size + 2, _sampling_channels(channels)), dtype=np.uint8)
+    for i, (col, row) in enumerate(spec['cells']):
+        face = cross[row * size:(row + 1) * size, col * size:(col + 1) * size]
+        if i in spec['rotated']:
+            face = face[::-1, ::-1]
+        padded[i, 1:-1, 1:-1, :channels] = face
+    return padded_cubemap_to_equirect(padded, h, w, mode, channels)
+
+def fisheye_to_equirect(fisheye, h, w, mode='bilinear'):
+    """
+    Circular fisheye (see FISHEYE_FOV_DEGREES) to equirect: the circle covers the front of the
+    sphere and everything outside its field of view is left black, instead of stretching the
+    photo over the whole sphere
+    """
+    in_h, in_w, channels = fisheye.shape
+    # Black 1px border: directions outside the field of view sample its corner
+    padded = np.zeros((in_h + 2, in_w + 2, _sampling_channels(channels)), dtype=np.uint8)
+    padded[1:-1, 1:-1, :channels] = fisheye
+    table = get_remap_table('f2e', (in_h, in_w), w, h, mode, view=FISHEYE_FOV_DEGREES)
+    return parallel_remap(padded, table, channels=channels)
+
+def partial_equirect_to_equirect(image, crop, output_width):
+    """
+    Place a GPano cropped-area panorama (e.g. a phone's 360 x 100 degree sweep) where it
+    belongs on a black full-sphere canvas, instead of stretching it over the whole sphere.
+    """
+    full_w, full_h, left, top, crop_w, crop_h = crop
+    output_height = output_width // 2
+    scale_x = output_width / full_w
+    scale_y = output_height / full_h
+    size = (max(round(crop_w * scale_x), 1), max(round(crop_h * scale_y), 1))
+    placed = as_pil_image(image).resize(size, Image.Resampling.LANCZOS)
+
+    canvas = Image.new('RGB', (output_width, output_height))
+    x = round(left * scale_x) % output_width
+    y = round(top * scale_y)
+    canvas.paste(placed, (x, y))
+    if x + size[0] > output_width:
+        # Crosses the 180 degree meridian, the rest wraps round to the left edge
+        canvas.paste(placed, (x - output_width, y))
+    return canvas
+
+# ---------------------------------------------------------------------------
+# Decoded masters
+# ---------------------------------------------------------------------------
+
+# Stored panoramas kept decoded (as padded RGBX sampling buffers) for face / perspective renders,
+# so share cards and hotspot views of the same panorama don't each decode a 20 MB JPEG
+MASTER_CACHE_MAX_BYTES = int(os.environ.get('PANORAMA_MASTER_CACHE_MB', 512)) * 1024 * 1024
+app.config['MASTER_CACHE_MAX_BYTES'] = MASTER_CACHE_MAX_BYTES
+master_cache = ByteLRUCache(MASTER_CACHE_MAX_BYTES)
+
+def master_level_width(full_width, min_width):
+    """
+    Width of the power-of-two reduction of a master (full, 1/2, 1/4, ...) that views needing
+    min_width sample from: the smallest level still at least min_width wide, so views are
+    never sampled from more than 2x their pixel density (bilinear would alias).
+    """
+    width = full_width
+    while width // 2 >= max(min_width, 1):
+        width //= 2
+    return width
+
+def _build_master_level(source_path, width):
+    """Decode (JPEGs at DCT scale) and reduce a master to width x width/2, padded for sampling"""
+    image = load_rgb(open_image(source_path, (width, width // 2)))
+    if image.width != width:
+        image = image.resize((width, max(width // 2, 1)), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    return _padded_equirect_from_image(image)
+
+def get_master_level(filename, source_path, min_width):
+    """Padded RGBX buffer of a stored panorama at master_level_width, from master_cache when it is hot"""
+    with Image.open(source_path) as probe:  # Header only
+        full_width = probe.width
+    width = master_level_width(full_width, min_width)
+    return master_cache.get((filename, width), lambda: _build_master_level(source_path, width))
+
+# ---------------------------------------------------------------------------
+# Tile pyramids
+# ---------------------------------------------------------------------------
+
+def tiles_dir_for(output_filename):
+    return shard_path(TILES_FOLDER, os.path.splitext(output_filename)[0])
+
+def existing_tiles_dir(name):
+    """Tiles dir for a panorama name (no extension), falling back to the flat layout from before sharding"""
+    name = secure_filename(name)
+    for tiles_dir in (tiles_dir_for(name), os.path.join(TILES_FOLDER, name)):
+        if os.path.isdir(tiles_dir):
+            return tiles_dir
+    return None
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, filename))
+               for dirpath, _, filenames in os.walk(path) for filename in filenames)
+
+def tiles_url_for(output_filename):
+    return f"/panorama/{os.path.splitext(output_filename)[0]}/tiles/config.json"
+
+def pyramid_levels(cube_size, tile_size=TILE_SIZE):
+    """Number of zoom levels so the smallest level fits in a single tile (same rule as Pannellum's generate.py)"""
+    levels = int(math.ceil(math.log(float(cube_size) / tile_size, 2))) + 1
+    if levels > 1 and round(cube_size / 2 ** (levels - 2)) == tile_size:
+        levels -= 1
+    return max(levels, 1)
+
+def generate_tile_pyramid(equirect_image, tiles_dir, tile_size=TILE_SIZE):
+    """
+    Cut an equirectangular PIL image into multi-resolution cube-face tiles.
+    Layout is Pannellum's multires format: <level>/<face><row>_<col>.jpg plus config.json,
+    where level 1 is the coarsest and maxLevel holds the full cubeResolution faces.
+    """
+    # Cube face size that matches the equirect's angular resolution
+    cube_size = max(8 * int(equirect_image.width / math.pi / 8), 8)
+    max_level = pyramid_levels(cube_size, tile_size)
+
+    # Same as equirect_to_cube_faces, but padded straight from the image without a full array copy
+    table = get_remap_table('e2c', (equirect_image.height, equirect_image.width), cube_size * 6, cube_size)
+    faces = np.split(parallel_remap(_padded_equirect_from_image(equirect_image), table, channels=3), 6, axis=1)
+
+    # Build in a temp dir and rename so viewers never see a half-written pyramid
+    tmp_dir = f"{tiles_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        for letter, face in zip(CUBE_FACE_LETTERS, faces):
+            face_img = Image.fromarray(face)
+            for level in range(max_level, 0, -1):
+                size = int(cube_size / 2 ** (max_level - level))
+                level_img = face_img if size == cube_size else face_img.resize((size, size), Image.Resampling.LANCZOS)
+                level_dir = os.path.join(tmp_dir, str(level))
+                os.makedirs(level_dir, exist_ok=True)
+
+                tiles = int(math.ceil(size / tile_size))
+                for row in range(tiles):
+                    for col in range(tiles):
+                        box = (col * tile_size, row * tile_size,
+                               min((col + 1) * tile_size, size), min((row + 1) * tile_size, size))
+                        level_img.crop(box).save(
+                            os.path.join(level_dir, f'{letter}{row}_{col}.jpg'),
+                            'JPEG', quality=TILE_QUALITY
+                        )
+
+        manifest = {
+            'type': 'multires',
+            'multiRes': {
+                'path': '/%l/%s%y_%x',
+                'extension': 'jpg',
+                'tileResolution': tile_size,
+                'maxLevel': max_level,
+                'cubeResolution': cube_size
+            }
+        }
+        with open(os.path.join(tmp_dir, 'config.json'), 'w') as f:
+            json.dump(manifest, f)
+
+        try:
+            os.rename(tmp_dir, tiles_dir)
+        except OSError:
+            # Another request finished the same pyramid first
+            pass
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return manifest
+
+def ensure_tiles(output_filename, equirect_image=None):
+    """Generate the tile pyramid for a stored panorama unless it already exists; returns the manifest URL"""
+    tiles_dir = tiles_dir_for(output_filename)
+    if not os.path.isfile(os.path.join(tiles_dir, 'config.json')):
+        store = get_output_store()
+        if equirect_image is None:
+            equirect_image = open_upload_image(store.locate(output_filename))
+        with stage('tiles'):
+            generate_tile_pyramid(equirect_image, tiles_dir)
+        # Tiles count toward the output quota and are evicted with the panorama
+        store.set_tiles_size(output_filename, directory_size(tiles_dir))
+    return tiles_url_for(output_filename)
+
+# ---------------------------------------------------------------------------
+# Memory budget
+# ---------------------------------------------------------------------------
+
+# Temporaries of one bilinear band in the NumPy sampler, per output pixel: the gathered RGBX
+# pixels and their uint16 blends (~34 bytes measured). The numba kernel allocates none.
+SAMPLER_BYTES_PER_PIXEL = 36
+# Upper bound for encoded size; JPEG q95 of a real photo is well under this
+ENCODED_BYTES_PER_PIXEL = 1
+
+class MemoryBudgetExceeded(Exception):
+    """A request's estimated footprint cannot be reserved: 413 if it never fits, 503 if the wait timed out"""
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+class MemoryBudget:
+    """
+    Process-wide budget of estimated bytes held by in-flight conversions.
+    Requests that do not fit right now queue (up to MEMORY_WAIT_SECONDS) until others finish.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, timeout=None):
+        """Reserve nbytes (blocking while the budget is full) and return the amount to release()"""
+        if self.max_bytes <= 0:
+            return 0
+        if nbytes > self.max_bytes:
+            with self._cond:
+                self.rejected += 1
+            raise MemoryBudgetExceeded(
+                f'Request needs ~{nbytes // (1024 * 1024)} MB, more than the '
+                f'{self.max_bytes // (1024 * 1024)} MB memory budget; try a smaller width', 413
+            )
+
+        deadline = time.monotonic() + (MEMORY_WAIT_SECONDS if timeout is None else timeout)
+        with self._cond:
+            if self.reserved + nbytes > self.max_bytes:
+                self.waiting += 1
+                try:
+                    with stage('memory-wait'):
+                        while self.reserved + nbytes > self.max_bytes:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                self.rejected += 1
+                                raise MemoryBudgetExceeded('Server is busy with other large panoramas, retry shortly', 503)
+                            self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.reserved += nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        if not nbytes:
+            return
+        with self._cond:
+            self.reserved -= nbytes
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        reserved = self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(reserved)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'maxBytes': self.max_bytes,
+                'reservedBytes': self.reserved,
+                'waiting': self.waiting,
+                'rejected': self.rejected
+            }
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES)
+
+def use_low_memory(output_width):
+    return output_width >= LOW_MEMORY_WIDTH
+
+def estimate_sampler_memory(output_width, rows):
+    """
+    Rough peak temporaries of parallel_remap over rows x output_width pixels: one
+    REMAP_BAND_ROWS band per sampler thread, and no more threads than there are bands
+    """
+    if SAMPLER_BACKEND == 'numba':
+        return 0
+    bands = -(-rows // REMAP_BAND_ROWS)
+    threads = max(min(SAMPLER_THREADS, bands), 1)
+    return min(REMAP_BAND_ROWS, rows) * output_width * SAMPLER_BYTES_PER_PIXEL * threads
+
+def estimate_output_memory(output_width, low_memory=False, encoded_in_memory=True):
+    """Rough peak bytes from sampling through encoding an output_width x output_width/2 RGB result"""
+    height = output_width // 2
+    pixels = output_width * height
+    rows = min(LOW_MEMORY_STRIP_ROWS, height) if low_memory else height
+    total = pixels * 4  # PIL keeps RGB at 4 bytes per pixel
+    total += rows * output_width * 3  # uint8 sampling output (one strip in low-memory mode)
+    total += estimate_sampler_memory(output_width, rows)
+    if encoded_in_memory:
+        encoded = pixels * ENCODED_BYTES_PER_PIXEL
+        total += min(encoded, LOW_MEMORY_SPOOL_BYTES) if low_memory else encoded
+    return total
+
+def estimate_tiles_memory(output_width):
+    """Rough extra peak bytes of generate_tile_pyramid: padded RGBX equirect copy + six cube faces"""
+    cube_size = max(8 * int(output_width / math.pi / 8), 8)
+    return (output_width + 2) * (output_width // 2 + 2) * 4 + cube_size * cube_size * (6 * 3 + 4)
+
+def estimate_convert_memory(source_size, output_width, low_memory=False, tiles=False):
+    """Rough peak bytes of convert_upload_to_equirect + save (the encoder writes straight to disk)"""
+    width, height = source_size
+    decoded = width * height * 4
+    padded = (width + 2) * (height + 2) * 4  # RGBX sampling buffer
+    output = estimate_output_memory(output_width, low_memory, encoded_in_memory=False)
+    if low_memory:
+        # The decoded upload is dropped once it has been copied into the padded buffer
+        total = padded + max(decoded, output)
+    else:
+        total = decoded + padded + output
+    if tiles:
+        total += estimate_tiles_memory(output_width)
+    return total
+
+def estimate_stitch_memory(face_sizes, output_width, low_memory=False, encoded_in_memory=True, blend=False):
+    """
+    Rough peak bytes of stitch_faces + encode; faces are resampled one at a time, and decoded
+    one at a time too in low_memory mode (otherwise all at once, see decode_faces)
+    """
+    target_size = min(width for width, _ in face_sizes)
+    padded = 6 * (target_size + 2) ** 2 * 4
+    decoded = [width * height * 4 for width, height in face_sizes]
+    concurrent = DECODE_THREADS > 1 and not low_memory
+    face = (sum(decoded) if concurrent else max(decoded)) + target_size * target_size * 7
+    if blend:
+        face = max(face, estimate_blend_memory(target_size))
+    return padded + max(face, estimate_output_memory(output_width, low_memory, encoded_in_memory))
+
+def release_when_done(response, nbytes):
+    """
+    Hold a streaming response's memory reservation until its last chunk is sent, or until the
+    server closes it (a disconnect, even before the body was first read), whichever comes first
+    """
+    pending = [nbytes]
+
+    def release():
+        try:
+            memory_budget.release(pending.pop())
+        except IndexError:
+            pass  # Already released
+
+    def body(chunks):
+        try:
+            yield from chunks
+        finally:
+            release()
+
+    response.response = body(response.response)
+    response.call_on_close(release)
+    return response
+
+def memory_budget_response(error):
+    response = jsonify({'error': str(error)})
+    response.status_code = error.status_code
+    if error.status_code == 503:
+        response.headers['Retry-After'] = str(max(int(MEMORY_WAIT_SECONDS), 1))
+    return response
+
+def output_result(output_filename, width, height, projection, cached, tiles_url=None):
+    """
+    Response fields for a stored output, shared by the routes, /batch items and cache hits
+    so a cached answer has the same shape as a fresh one
+    """
+    result = {
+        'success': True,
+        'filename': output_filename,
+        'url': f'/panorama/{output_filename}',
+        'width': width,
+        'height': height,
+        'projection': projection,
+        'previews': preview_urls(output_filename),
+        'cached': cached
+    }
+    if tiles_url is not None:
+        result['tilesUrl'] = tiles_url
+    return result
+
+def cached_output_result(output_filename, output_width, tiles=False, projection=None):
+    """output_result for an output already in the store (projection: used if none was recorded)"""
+    recorded = get_output_store().projection_of(output_filename)
+    tiles_url = ensure_tiles(output_filename) if tiles else None
+    return output_result(output_filename, output_width, output_width // 2, recorded or projection, True, tiles_url)
+
+def convert_and_store(file_bytes, output_filename, output_width, encoder, tiles=False):
+    """
+    Synchronous /convert work for one upload (bytes or stream): reserve memory, convert, save
+    and optionally tile. Shared by /convert, /upload-panorama and /batch; returns width,
+    height, projection (and tilesUrl).
+    """
+    # Reserve the estimated footprint first (only the header is read to get the size)
+    source_size = open_classified(file_bytes, output_width)[0].size
+    low_memory = use_low_memory(output_width)
+    with memory_budget.reserve(estimate_convert_memory(source_size, output_width, low_memory, tiles)):
+        # Read and convert image
+        equirect_image, projection = convert_upload_to_equirect(file_bytes, output_width, low_memory)
+        
+        # Save with high quality, plus the previews from the same in-memory image
+        save_output(equirect_image, output_filename, encoder, projection.kind)
+        save_derivatives(equirect_image, output_filename)
+        
+        result = {'width': equirect_image.width, 'height': equirect_image.height,
+                  'projection': projection.kind}
+        if tiles:
+            result['tilesUrl'] = ensure_tiles(output_filename, equirect_image)
+    return result
+
+# ---------------------------------------------------------------------------
+# Uploads
+# ---------------------------------------------------------------------------
+
+# Multipart parts up to this size stay in memory, larger ones spill to a temp file
+UPLOAD_SPOOL_BYTES = int(os.environ.get('PANORAMA_UPLOAD_SPOOL_MB', 8)) * 1024 * 1024
+# Uploads are checked from their headers alone before anything is decoded
+UPLOAD_FORMATS = {'JPEG', 'MPO', 'PNG'}  # MPO: multi-picture JPEGs from dual-lens cameras
+UPLOAD_MODES = {'1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA', 'RGBX', 'CMYK', 'YCbCr'}  # 8-bit only
+UPLOAD_MIN_SIZE = 16
+UPLOAD_MAX_PIXELS = int(float(os.environ.get('PANORAMA_UPLOAD_MAX_MP', 150)) * 1000 * 1000)
+# Longest side / shortest side; faces are center-cropped, panoramas go up to 6:1 strips
+FACE_MAX_ASPECT = 2.0
+PANORAMA_MAX_ASPECT = 8.0
+# Threads decoding the six stitch faces at once (1 = one at a time, as the stitcher needs them)
+DECODE_THREADS = int(os.environ.get('PANORAMA_DECODE_THREADS', min(len(CUBEMAP_FACES), os.cpu_count() or 1)))
+
+app.config['UPLOAD_SPOOL_BYTES'] = UPLOAD_SPOOL_BYTES
+app.config['UPLOAD_MAX_PIXELS'] = UPLOAD_MAX_PIXELS
+app.config['DECODE_THREADS'] = DECODE_THREADS
+
+class SpooledRequest(Request):
+    """Request whose file parts are SpooledTemporaryFiles (Werkzeug sends every part of a large body to disk)"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode='rb+')
+
+    def detach_files(self):
+        """
+        Hand the file parts over to the caller, who closes them: the request closes its files when
+        the view returns, before a streamed body (see /batch) has finished reading them
+        """
+        files = self.files
+        self.__dict__['files'] = ImmutableMultiDict()
+        return files
+
+app.request_class = SpooledRequest
+
+class UploadError(Exception):
+    """An upload rejected from its header: 400 for unusable images, 413 for oversized ones"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def upload_stream(upload):
+    """Rewound binary stream for an upload given as bytes or a (spooled) file object; paths pass through"""
+    if isinstance(upload, (str, os.PathLike)):
+        return upload
+    if isinstance(upload, (bytes, bytearray, memoryview)):
+        return io.BytesIO(upload)
+    upload.seek(0)
+    return upload
+
+def probe_upload(upload, kind='panorama'):
+    """
+    Validate one upload from its header alone: a supported format and mode, a sane size and,
+    per kind ('panorama' or 'face'), aspect ratio. Returns (width, height) or raises UploadError.
+    """
+    stream = upload_stream(upload)
+    try:
+        img = Image.open(stream)
+    except Image.DecompressionBombError:
+        raise UploadError('Image has too many pixels', 413)
+    except (Image.UnidentifiedImageError, OSError):
+        raise UploadError('Not a readable PNG or JPEG image')
+    finally:
+        stream.seek(0)
+
+    width, height = img.size
+    if img.format not in UPLOAD_FORMATS:
+        raise UploadError(f'Unsupported image format {img.format}')
+    if img.mode not in UPLOAD_MODES:
+        raise UploadError(f'Unsupported color mode {img.mode} (8 bits per channel only)')
+    if min(width, height) < UPLOAD_MIN_SIZE:
+        raise UploadError(f'Image is too small ({width}x{height})')
+    if width * height > UPLOAD_MAX_PIXELS:
+        raise UploadError(f'Image is too large ({width}x{height}, max {UPLOAD_MAX_PIXELS // 1000000} MP)', 413)
+    max_aspect = FACE_MAX_ASPECT if kind == 'face' else PANORAMA_MAX_ASPECT
+    if max(width, height) / min(width, height) > max_aspect:
+        raise UploadError(f'Aspect ratio {width}x{height} is out of range for a {kind} (max {max_aspect:g}:1)')
+    return width, height
+
+def validate_uploads(files, kind='panorama'):
+    """probe_upload every part of name -> FileStorage/bytes; the error names the failing part"""
+    sizes = {}
+    for name, upload in files.items():
+        try:
+            sizes[name] = probe_upload(getattr(upload, 'stream', upload), kind)
+        except UploadError as e:
+            raise UploadError(f'{name}: {e}', e.status_code)
+    return sizes
+
+_decode_pool = None
+_decode_pool_pid = None
+_decode_pool_lock = threading.Lock()
+
+def get_decode_pool():
+    """Created on first use, and again after a fork (threads don't survive it)"""
+    global _decode_pool, _decode_pool_pid
+    with _decode_pool_lock:
+        if _decode_pool is None or _decode_pool_pid != os.getpid():
+            _decode_pool = ThreadPoolExecutor(max_workers=DECODE_THREADS, thread_name_prefix='decode')
+            _decode_pool_pid = os.getpid()
+        return _decode_pool
+
+def decode_faces(faces):
+    """
+    Start decoding the lazily opened faces of a stitch on the decode pool (Pillow releases the
+    GIL while decoding), replacing them in the dict with Futures. No-op with DECODE_THREADS=1.
+    """
+    if DECODE_THREADS <= 1:
+        return faces
+    pool = get_decode_pool()
+    for name, img in faces.items():
+        if isinstance(img, Image.Image):
+            faces[name] = pool.submit(charge_cpu(load_rgb, 'decode'), img)
+    return faces
+
+# ---------------------------------------------------------------------------
+# Shared arrays
+# ---------------------------------------------------------------------------
+
+# Job uploads are decoded on the request thread straight into memory-mapped files here and the
+# worker processes get only (path, shape) descriptors, so no decoded (or encoded) image is
+# pickled through the process pool. /dev/shm keeps them in RAM; blocks that do not fit there
+# fall back to the temp dir.
+SHARED_ARRAY_DIR = os.environ.get('PANORAMA_SHARED_DIR') or (
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+)
+
+app.config['SHARED_ARRAY_DIR'] = SHARED_ARRAY_DIR
+
+_shared_arrays = set()
+_shared_arrays_lock = threading.Lock()
+
+class SharedArray:
+    """
+    uint8 array in a memory-mapped file that other processes attach to by descriptor.
+    The creating process owns the file and unlink()s it; attach() maps it read-only.
+    """
+    def __init__(self, path, shape, array):
+        self.path = path
+        self.shape = tuple(shape)
+        self.array = array
+
+    @classmethod
+    def create(cls, shape):
+        nbytes = int(np.prod(shape))
+        for directory in dict.fromkeys((SHARED_ARRAY_DIR, tempfile.gettempdir())):
+            fd, path = tempfile.mkstemp(prefix='panorama-shared-', suffix='.u8', dir=directory)
+            try:
+                # Allocate up front: a sparse file on a full tmpfs would SIGBUS on first write
+                os.posix_fallocate(fd, 0, max(nbytes, 1))
+                break
+            except OSError:
+                os.remove(path)
+                if directory == tempfile.gettempdir():
+                    raise
+            finally:
+                os.close(fd)
+        with _shared_arrays_lock:
+            _shared_arrays.add(path)
+        return cls(path, shape, np.memmap(path, dtype=np.uint8, mode='r+', shape=tuple(shape)))
+
+    @classmethod
+    def attach(cls, descriptor):
+        path, shape = descriptor
+        return cls(path, shape, np.memmap(path, dtype=np.uint8, mode='r', shape=tuple(shape)))
+
+    @property
+    def descriptor(self):
+        return (self.path, self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape))
+
+    def close(self):
+        """Drop this process's mapping (views taken from .array keep it alive until they go)"""
+        self.array = None
+
+    def unlink(self):
+        self.close()
+        with _shared_arrays_lock:
+            _shared_arrays.discard(self.path)
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+@atexit.register
+def _unlink_shared_arrays():
+    """Blocks of jobs still queued at shutdown would otherwise outlive the process in /dev/shm"""
+    with _shared_arrays_lock:
+        paths = list(_shared_arrays)
+        _shared_arrays.clear()
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def decode_to_shared(file_bytes, min_size=None, strip_rows=LOW_MEMORY_STRIP_ROWS):
+    """
+    Decode an upload into a new (H, W, 3) SharedArray, copied in row strips so the only
+    full-size allocations are the decoder's own buffer and the shared block.
+    """
+    image = open_upload_image(upload_stream(file_bytes), min_size)
+    width, height = image.size
+    shared = SharedArray.create((height, width, 3))
+    try:
+        with stage('decode'):
+            for start in range(0, height, strip_rows):
+                stop = min(start + strip_rows, height)
+                shared.array[start:stop] = np.asarray(image.crop((0, start, width, stop)))
+    except BaseException:
+        shared.unlink()
+        raise
+    shared.close()
+    return shared
+
+def share_uploads(uploads, min_size=None):
+    """
+    Decode job uploads (name -> bytes or stream) into SharedArrays, several at once on the
+    decode pool. The shared blocks are reserved from the memory budget until
+    release_shared_uploads(); returns (name -> SharedArray, reserved bytes).
+    """
+    sizes = [open_image(upload_stream(data), min_size).size for data in uploads.values()]
+    shared_bytes = sum(width * height * 3 for width, height in sizes)
+    decoded = [width * height * 4 for width, height in sizes]
+    concurrent = DECODE_THREADS > 1 and len(uploads) > 1
+    decode_bytes = sum(decoded) if concurrent else max(decoded)
+    reserved = memory_budget.acquire(shared_bytes + decode_bytes)
+    shared = {}
+    try:
+        if concurrent:
+            futures = {name: get_decode_pool().submit(charge_cpu(decode_to_shared, 'decode'), data, min_size)
+                       for name, data in uploads.items()}
+            try:
+                for name, future in futures.items():
+                    shared[name] = future.result()
+            finally:
+                # Collect blocks that finished after an earlier one failed, so they get unlinked too
+                for name, future in futures.items():
+                    if name not in shared and not future.cancel() and future.exception() is None:
+                        shared[name] = future.result()
+        else:
+            for name, data in uploads.items():
+                shared[name] = decode_to_shared(data, min_size)
+    except BaseException:
+        release_shared_uploads(shared, reserved)
+        raise
+    # Keep only the shared blocks reserved, the decoders' buffers are gone
+    decoded = min(decode_bytes, reserved)
+    memory_budget.release(decoded)
+    return shared, reserved - decoded
 
-UPLOAD_FOLDER = 'uploads/panoramas'
-OUTPUT_FOLDER = 'outputs'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+def release_shared_uploads(shared, reserved):
+    for block in shared.values():
+        block.unlink()
+    memory_budget.release(reserved)
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+# ---------------------------------------------------------------------------
+# Background jobs
+# ---------------------------------------------------------------------------
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max for panoramas
+JOB_WORKERS = int(os.environ.get('PANORAMA_JOB_WORKERS', os.cpu_count() or 1))
+MAX_PENDING_JOBS = int(os.environ.get('PANORAMA_MAX_PENDING_JOBS', JOB_WORKERS * 4))
+JOB_HISTORY_LIMIT = 1000
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+app.config['JOB_WORKERS'] = JOB_WORKERS
+app.config['MAX_PENDING_JOBS'] = MAX_PENDING_JOBS
+
+_job_executor = None
+_job_executor_pid = None
+_job_executor_lock = threading.Lock()
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
 
-def convert_to_equirectangular(image_path, output_path, target_width=4096):
+def job_process_context():
     """
-    Convert image to equirectangular format using py360convert
-    Supports various input formats: fisheye, cubemap, perspective, etc.
+    Start method for job processes. Forking a server process whose other threads (request,
+    decode and sampler pools) may hold locks can deadlock the child, so workers come from a
+    forkserver that has already imported this module (and with it NumPy and Pillow), or are
+    spawned where there is no forkserver.
     """
-    try:
-        # Load image
-        img = Image.open(image_path)
-        img_array = np.array(img)
-        
-        # Determine input format based on aspect ratio
-        height, width = img_array.shape[:2]
-        aspect_ratio = width / height
-        
-        # If already close to 2:1, just resize
-        if 1.9 <= aspect_ratio <= 2.1:
-            target_height = target_width // 2
-            equirect_img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-            equirect_array = np.array(equirect_img)
-        
-        # If it's a fisheye image (roughly square)
-        elif 0.9 <= aspect_ratio <= 1.1:
-            # Convert fisheye to equirectangular
-            target_height = target_width // 2
-            equirect_array = py360convert.e2e(
-                img_array,
-                h=target_height,
-                w=target_width,
-                mode='bilinear'
-            )
-        
-        # If it's a cubemap (6:1 or 3:4 ratio)
-        elif aspect_ratio > 5.5:  # Horizontal cubemap
-            target_height = target_width // 2
-            equirect_array = py360convert.c2e(
-                img_array,
-                h=target_height,
-                w=target_width,
-                mode='bilinear'
-            )
-        
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__])
+    return context
+
+def get_job_executor():
+    """
+    Create the worker process pool on first use so importing the module stays cheap
+    (and again in a forked server worker, which cannot use its parent's pool)
+    """
+    global _job_executor, _job_executor_pid
+    with _job_executor_lock:
+        if _job_executor is None or _job_executor_pid != os.getpid():
+            settings = {name: globals()[name] for name in APP_SETTINGS}
+            _job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=job_process_context(),
+                                                initializer=_init_job_worker, initargs=(settings,))
+            _job_executor_pid = os.getpid()
+        return _job_executor
+
+def request_flag(name):
+    """True when a boolean option is set in the query string or form (e.g. ?async=1, tiles=true)"""
+    value = request.args.get(name, request.form.get(name, ''))
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def _init_job_worker(settings=None):
+    """
+    Runs once in each job process: take the server's settings (a new process starts from the
+    environment's), then avoid workers x threads oversubscription
+    """
+    global SAMPLER_THREADS, DECODE_THREADS
+    if settings:
+        configure(settings)
+    SAMPLER_THREADS = JOB_SAMPLER_THREADS
+    DECODE_THREADS = 1
+
+def wants_async():
+    """True when the client asked for job-submission mode (?async=1 or form field async=1)"""
+    return request_flag('async')
+
+def run_convert_job(uploads, output_width, tiles, encoder_name, projection, output_filename):
+    """
+    Worker-process entry point for /convert and /upload-panorama jobs (uploads: {'file': descriptor},
+    projection: classified by the route, which still had the upload's metadata)
+    """
+    image = SharedArray.attach(uploads['file']).array
+    equirect_image, projection = convert_upload_to_equirect(image, output_width, use_low_memory(output_width), projection)
+    del image
+    save_output(equirect_image, output_filename, get_encoder(encoder_name), projection.kind)
+    save_derivatives(equirect_image, output_filename)
+    result = {'width': equirect_image.width, 'height': equirect_image.height,
+              'projection': projection.kind, 'previews': preview_urls(output_filename)}
+    if tiles:
+        result['tilesUrl'] = ensure_tiles(output_filename, equirect_image)
+    return result
+
+def run_stitch_job(uploads, output_width, encoder_name, blend, output_filename):
+    """Worker-process entry point for /stitch jobs (uploads: face name -> descriptor)"""
+    faces = {face: SharedArray.attach(uploads[face]).array for face in CUBEMAP_FACES}
+    equirect_image = stitch_faces(faces, output_width, use_low_memory(output_width), blend)
+    save_output(equirect_image, output_filename, get_encoder(encoder_name), STITCH_PROJECTION)
+    save_derivatives(equirect_image, output_filename)
+    return {'width': equirect_image.width, 'height': equirect_image.height,
+            'projection': STITCH_PROJECTION, 'previews': preview_urls(output_filename)}
+
+def _finish_job(job_id, future, shared, reserved):
+    release_shared_uploads(shared, reserved)
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None:
+            return
+        job['finishedAt'] = time.time()
+        if future.cancelled():
+            job['status'] = 'failed'
+            job['error'] = 'Cancelled, the server shut down before the job ran'
+        elif future.exception() is not None:
+            job['status'] = 'failed'
+            job['error'] = str(future.exception())
         else:
-            # For other formats, use perspective conversion
-            target_height = target_width // 2
-            equirect_array = py360convert.e2e(
-                img_array,
-                h=target_height,
-                w=target_width,
-                mode='bilinear'
-            )
-        
-        # Convert back to PIL Image and save
-        equirect_img = Image.fromarray(equirect_array.astype('uint8'))
-        equirect_img.save(output_path, 'JPEG', quality=95, optimize=True)
-        
-        return True, None
-    
-    except Exception as e:
-        return False, str(e)
+            job['status'] = 'done'
+            job['result'] = future.result()
+        job = dict(job)
+    get_output_store().save_job(job_id, job)
 
-def crop_to_center_square(img, target_size=None):
+def pending_job_count():
+    with _jobs_lock:
+        return sum(1 for job in _jobs.values() if job['status'] == 'queued')
+
+def submit_job(kind, func, *args, filename=None, shared=None, reserved=0):
     """
-    Crop image to center square to remove edges and reduce overlapping artifacts.
-    This helps make stitching appear more flush by using only the central portion.
+    Queue work on the process pool and register it in the job table.
+    shared (name -> SharedArray) and reserved bytes are released when the job finishes.
+    Returns the job id, or None when the queue is full.
     """
-    width, height = img.size
-    min_dim = min(width, height)
-    
-    # Calculate crop box to get center square
-    left = (width - min_dim) // 2
-    top = (height - min_dim) // 2
-    right = left + min_dim
-    bottom = top + min_dim
-    
-    cropped = img.crop((left, top, right, bottom))
-    
-    # If target size specified, resize to it
-    if target_size:
-        cropped = cropped.resize((target_size, target_size), Image.Resampling.LANCZOS)
-    
-    return cropped
+    executor = get_job_executor()
+    job_id = str(uuid.uuid4())
 
-def adjust_perspective_distortion(img, fov_correction=0.80):
+    with _jobs_lock:
+        pending = sum(1 for job in _jobs.values() if job['status'] == 'queued')
+        if pending >= MAX_PENDING_JOBS:
+            return None
+
+        _jobs[job_id] = {
+            'type': kind,
+            'status': 'queued',
+            'createdAt': time.time(),
+            'finishedAt': None,
+            'filename': filename,
+            'future': None,
+            'result': None,
+            'error': None
+        }
+        # Forget the oldest finished jobs once the history is full
+        while len(_jobs) > JOB_HISTORY_LIMIT:
+            oldest_id = next((jid for jid, job in _jobs.items() if job['status'] != 'queued'), None)
+            if oldest_id is None:
+                break
+            del _jobs[oldest_id]
+
+    future = executor.submit(func, *args)
+    with _jobs_lock:
+        _jobs[job_id]['future'] = future
+        job = dict(_jobs[job_id])
+    get_output_store().save_job(job_id, job)
+    future.add_done_callback(lambda f: _finish_job(job_id, f, shared or {}, reserved))
+    return job_id
+
+def submit_output_job(kind, func, output_filename, uploads, min_size, *args):
     """
-    Apply aggressive center crop to reduce perspective distortion at edges.
-    This creates a more flush appearance by using the less distorted central area.
+    Submit a job that writes a panorama to the output store and build the 202 response.
+    uploads (name -> bytes) are decoded here into SharedArrays; func gets name -> descriptor.
     """
-    width, height = img.size
-    
-    # Calculate new dimensions (crop edges by fov_correction factor)
-    new_width = int(width * fov_correction)
-    new_height = int(height * fov_correction)
-    
-    left = (width - new_width) // 2
-    top = (height - new_height) // 2
-    right = left + new_width
-    bottom = top + new_height
-    
-    cropped = img.crop((left, top, right, bottom))
-    # Resize back to original dimensions
-    return cropped.resize((width, height), Image.Resampling.LANCZOS)
+    # Identical upload already in flight (e.g. a retrying client), hand back the same job
+    with _jobs_lock:
+        job_id = next((jid for jid, job in _jobs.items()
+                       if job['filename'] == output_filename and job['status'] == 'queued'), None)
 
-def stitch_cubemap_to_equirectangular(front, back, left, right, top, bottom, output_width=4096):
+    if job_id is None and pending_job_count() < MAX_PENDING_JOBS:
+        shared, reserved = share_uploads(uploads, min_size)
+        descriptors = {name: block.descriptor for name, block in shared.items()}
+        try:
+            job_id = submit_job(kind, func, descriptors, *args, output_filename,
+                                filename=output_filename, shared=shared, reserved=reserved)
+        except BaseException:
+            release_shared_uploads(shared, reserved)
+            raise
+        if job_id is None:
+            release_shared_uploads(shared, reserved)
+    if job_id is None:
+        return jsonify({'error': 'Job queue is full, try again later'}), 503
+
+    return jsonify({
+        'success': True,
+        'jobId': job_id,
+        'status': 'queued',
+        'statusUrl': f'/jobs/{job_id}'
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Report status of a background conversion job"""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job = dict(job)
+    if job is None:
+        # Submitted through another server worker process (they share the store index)
+        job = get_output_store().load_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+
+    status = job['status']
+    if status == 'queued' and job['future'] is not None and job['future'].running():
+        status = 'running'
+
+    response = {
+        'jobId': job_id,
+        'type': job['type'],
+        'status': status,
+        'createdAt': job['createdAt'],
+        'finishedAt': job['finishedAt']
+    }
+    if status == 'done':
+        response['filename'] = job['filename']
+        response['url'] = f"/panorama/{job['filename']}"
+        response.update(job['result'])
+    elif status == 'failed':
+        response['error'] = job['error']
+
+    return jsonify(response), 200
+
+# ---------------------------------------------------------------------------
+# Batch conversion
+# ---------------------------------------------------------------------------
+
+# Items converted at once; they share the sampler threads and the remap cache
+BATCH_WORKERS = int(os.environ.get('PANORAMA_BATCH_WORKERS', os.cpu_count() or 1))
+MAX_BATCH_ITEMS = int(os.environ.get('PANORAMA_MAX_BATCH_ITEMS', 100))
+# Upload limit for /batch alone (needs Flask 3.1+, older versions keep MAX_CONTENT_LENGTH)
+BATCH_MAX_CONTENT_LENGTH = int(os.environ.get('PANORAMA_BATCH_MAX_MB', 500)) * 1024 * 1024
+
+app.config['BATCH_WORKERS'] = BATCH_WORKERS
+app.config['MAX_BATCH_ITEMS'] = MAX_BATCH_ITEMS
+
+_batch_executor = None
+_batch_executor_pid = None
+_batch_executor_lock = threading.Lock()
+
+def get_batch_executor():
+    """Created on first use, and again after a fork (threads don't survive it)"""
+    global _batch_executor, _batch_executor_pid
+    with _batch_executor_lock:
+        if _batch_executor is None or _batch_executor_pid != os.getpid():
+            _batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+            _batch_executor_pid = os.getpid()
+        return _batch_executor
+
+def read_batch_uploads():
     """
-    Stitch 6 individual photos (cubemap faces) into an equirectangular panorama.
-    Includes preprocessing to reduce overlapping and improve flush appearance.
-    
-    Args:
-        front, back, left, right, top, bottom: PIL Image objects
-        output_width: Width of output equirectangular image (height will be width/2)
-    
-    Returns:
-        PIL Image object in equirectangular format
+    Collect (name, source) pairs from the multipart files fields and any zip archives, in upload order,
+    without reading image data: source is the spooled upload stream, a (ZipFile, ZipInfo) pair that
+    convert_batch_item extracts when the item runs, or None for a member over the size limit.
+    Returns (items, resources): the uploads and archives are detached from the request, so the
+    caller closes the resources once the items are done.
+    Raises ValueError for unreadable archives or batches over MAX_BATCH_ITEMS.
     """
-    # Find the target size based on the smallest dimension
-    sizes = [img.size[0] for img in [front, back, left, right, top, bottom]]
-    target_size = min(sizes)
-    
-    # Preprocess all images to improve stitching quality
-    images = [front, back, left, right, top, bottom]
-    processed_images = []
-    
-    for img in images:
-        # Step 1: Crop to center square to remove edge distortion
-        img_square = crop_to_center_square(img, target_size)
-        
-        # Step 2: Apply aggressive perspective correction to wall images only (not ceiling/floor)
-        if img in [front, back, left, right]:
-            img_corrected = adjust_perspective_distortion(img_square, fov_correction=0.80)
+    uploads = request.detach_files()
+    resources = [file for _, file in uploads.items(multi=True)]
+    items = [(file.filename, file.stream) for file in uploads.getlist('files') + uploads.getlist('file')]
+
+    for archive in uploads.getlist('archive'):
+        try:
+            zf = zipfile.ZipFile(archive.stream)
+        except zipfile.BadZipFile:
+            close_all(resources)
+            raise ValueError(f'{archive.filename or "archive"} is not a valid zip file')
+        resources.insert(0, zf)
+        for info in zf.infolist():
+            name = info.filename
+            base = os.path.basename(name)
+            # Skip folders and OS metadata such as __MACOSX/ and .DS_Store
+            if info.is_dir() or name.startswith('__MACOSX/') or not base or base.startswith('.'):
+                continue
+            if info.file_size > app.config['MAX_CONTENT_LENGTH']:
+                items.append((name, None))
+                continue
+            items.append((name, (zf, info)))
+
+    if len(items) > MAX_BATCH_ITEMS:
+        close_all(resources)
+        raise ValueError(f'Too many images in one batch (max {MAX_BATCH_ITEMS})')
+    return items, resources
+
+def close_all(resources):
+    for resource in resources:
+        resource.close()
+
+def open_batch_source(source):
+    """Seekable stream for a read_batch_uploads source; zip members are extracted into a spooled file"""
+    if not isinstance(source, tuple):
+        return source
+    zf, info = source
+    spooled = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+    try:
+        with zf.open(info) as member:
+            shutil.copyfileobj(member, spooled)
+    except zipfile.BadZipFile as e:
+        spooled.close()
+        raise UploadError(f'Unreadable zip member: {e}')
+    return spooled
+
+def convert_batch_item(index, name, source, output_width, encoder, tiles):
+    """
+    Convert one batch entry like /convert; always returns a result line, failures included.
+    The source is only opened here, so in-flight items (not the whole batch) hold upload data.
+    """
+    result = {'index': index, 'name': name}
+    if not allowed_file(name or ''):
+        result.update({'success': False, 'error': 'Invalid file'})
+        return result
+    if source is None:
+        result.update({'success': False, 'error': 'File too large'})
+        return result
+
+    start = time.perf_counter()
+    file_bytes = None
+    try:
+        file_bytes = open_batch_source(source)
+        probe_upload(file_bytes)
+        output_filename = content_filename([file_bytes], output_width, encoder, mode='convert')
+        result.update({
+            'filename': output_filename,
+            'url': f'/panorama/{output_filename}',
+            'previews': preview_urls(output_filename)
+        })
+
+        if output_exists(output_filename):
+            result.update(cached_output_result(output_filename, output_width, tiles))
         else:
-            img_corrected = img_square
-        
-        processed_images.append(img_corrected)
-    
-    front, back, left, right, top, bottom = processed_images
-    
-    # Convert PIL images to numpy arrays as a list (not stacked)
-    # py360convert expects cubemap in specific order: [F, R, B, L, U, D]
-    cube_faces = [
-        np.array(front),   # Front
-        np.array(right),   # Right
-        np.array(back),    # Back
-        np.array(left),    # Left
-        np.array(top),     # Up (ceiling)
-        np.array(bottom)   # Down (floor)
+            stored = convert_and_store(file_bytes, output_filename, output_width, encoder, tiles)
+            result.update(output_result(output_filename, stored['width'], stored['height'],
+                                        stored['projection'], False, stored.get('tilesUrl')))
+    except (MemoryBudgetExceeded, UploadError) as e:
+        result.update({'success': False, 'error': str(e), 'status': e.status_code})
+    except Exception as e:
+        result.update({'success': False, 'error': str(e)})
+    finally:
+        if isinstance(source, tuple) and file_bytes is not None:
+            file_bytes.close()
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+def stream_batch_results(futures, total, resources=()):
+    """NDJSON body: one line per item as it finishes, then a summary line"""
+    start = time.perf_counter()
+    succeeded = 0
+    try:
+        for future in as_completed(futures):
+            result = future.result()
+            succeeded += bool(result['success'])
+            yield json.dumps(result) + '\n'
+
+        yield json.dumps({
+            'done': True,
+            'total': total,
+            'succeeded': succeeded,
+            'failed': total - succeeded,
+            'seconds': round(time.perf_counter() - start, 3)
+        }) + '\n'
+    finally:
+        # Client went away: drop the items that have not started yet
+        for future in futures:
+            future.cancel()
+        # Running items finish first, they are still reading from the uploads
+        wait(futures)
+        close_all(resources)
+
+@app.route('/batch', methods=['POST'])
+def batch_convert():
+    """
+    Convert many panoramas in one request: multipart files=... (repeatable) and/or archive=<zip>.
+    Items run in parallel and results stream back as NDJSON in completion order.
+    """
+    try:
+        # Flask 3.1+ lets a view raise the upload limit for its own request
+        request.max_content_length = BATCH_MAX_CONTENT_LENGTH
+    except AttributeError:
+        pass
+
+    try:
+        encoder = choose_encoder()
+        output_width = min(int(request.form.get('width', 4096)), 8192)  # Max 8K
+        items, resources = read_batch_uploads()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if not items:
+        close_all(resources)
+        return jsonify({'error': 'No files provided (use files=... or archive=<zip>)'}), 400
+
+    tiles = request_flag('tiles')
+    executor = get_batch_executor()
+    futures = [
+        executor.submit(convert_batch_item, index, name, source, output_width, encoder, tiles)
+        for index, (name, source) in enumerate(items)
     ]
-    
-    # Convert cubemap to equirectangular with smoother interpolation
-    output_height = output_width // 2
-    equirect = py360convert.c2e(
-        cubemap=cube_faces,
-        h=output_height,
-        w=output_width,
-        mode='bilinear',
-        cube_format='list'
+
+    # Items read their uploads as they run; the body closes them after the last one
+    return Response(
+        stream_batch_results(futures, len(futures), resources),
+        mimetype='application/x-ndjson',
+        headers={'X-Batch-Items': str(len(futures)), 'Access-Control-Expose-Headers': 'X-Batch-Items'}
     )
-    
-    # Convert back to PIL Image
-    return Image.fromarray(equirect.astype('uint8'))
+
+@app.route('/encoders', methods=['GET'])
+def list_encoders():
+    """Available output presets (preset=<name> or format=<name>) and their encode time/size stats"""
+    return jsonify({
+        'default': DEFAULT_ENCODER,
+        'presets': {
+            name: {
+                'mimeType': preset.mimetype,
+                'extension': preset.extension,
+                'available': preset.available,
+                'options': preset.options
+            }
+            for name, preset in ENCODER_PRESETS.items()
+        },
+        'stats': encoder_stats.snapshot()
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of request/stage histograms, caches, jobs and encoders"""
+    lines = []
+    for metric in (request_seconds, stage_seconds, stage_cpu_seconds, projections_total):
+        lines.extend(metric.render())
+    if TRACE_MEMORY:
+        lines.extend(stage_allocated_bytes.render())
+
+    cache = remap_cache.stats()
+    masters = master_cache.stats()
+    with _shared_arrays_lock:
+        shared_arrays = len(_shared_arrays)
+    lines.extend([
+        '# HELP panorama_remap_cache_bytes Bytes held by cached remap grids',
+        '# TYPE panorama_remap_cache_bytes gauge',
+        f'panorama_remap_cache_bytes {cache["bytes"]}',
+        '# HELP panorama_remap_cache_entries Cached remap grids',
+        '# TYPE panorama_remap_cache_entries gauge',
+        f'panorama_remap_cache_entries {cache["entries"]}',
+        '# HELP panorama_remap_cache_lookups_total Remap grid lookups by result',
+        '# TYPE panorama_remap_cache_lookups_total counter',
+        f'panorama_remap_cache_lookups_total{{result="hit"}} {cache["hits"]}',
+        f'panorama_remap_cache_lookups_total{{result="miss"}} {cache["misses"]}',
+        '# HELP panorama_master_cache_bytes Bytes held by decoded masters',
+        '# TYPE panorama_master_cache_bytes gauge',
+        f'panorama_master_cache_bytes {masters["bytes"]}',
+        '# HELP panorama_master_cache_lookups_total Decoded master lookups by result',
+        '# TYPE panorama_master_cache_lookups_total counter',
+        f'panorama_master_cache_lookups_total{{result="hit"}} {masters["hits"]}',
+        f'panorama_master_cache_lookups_total{{result="miss"}} {masters["misses"]}',
+        '# HELP panorama_shared_arrays Decoded uploads waiting in shared memory for job workers',
+        '# TYPE panorama_shared_arrays gauge',
+        f'panorama_shared_arrays {shared_arrays}',
+        '# HELP panorama_sampler_info Remap sampler implementation in use',
+        '# TYPE panorama_sampler_info gauge',
+        f'panorama_sampler_info{{backend="{SAMPLER_BACKEND}"}} 1'
+    ])
+
+    store = get_output_store().stats()
+    hot = hot_cache.stats()
+    lines.extend([
+        '# HELP panorama_output_store_bytes Bytes of stored panoramas and tiles',
+        '# TYPE panorama_output_store_bytes gauge',
+        f'panorama_output_store_bytes {store["bytes"]}',
+        '# HELP panorama_output_store_entries Stored panoramas',
+        '# TYPE panorama_output_store_entries gauge',
+        f'panorama_output_store_entries {store["entries"]}',
+        '# HELP panorama_output_store_quota_bytes Output store quota (0 = unlimited)',
+        '# TYPE panorama_output_store_quota_bytes gauge',
+        f'panorama_output_store_quota_bytes {store["maxBytes"]}',
+        '# HELP panorama_output_store_evictions_total Outputs evicted by this process',
+        '# TYPE panorama_output_store_evictions_total counter',
+        f'panorama_output_store_evictions_total {store["evictions"]}',
+        '# HELP panorama_hot_cache_bytes Bytes of panoramas served from memory',
+        '# TYPE panorama_hot_cache_bytes gauge',
+        f'panorama_hot_cache_bytes {hot["bytes"]}',
+        '# HELP panorama_hot_cache_lookups_total Hot cache lookups by result',
+        '# TYPE panorama_hot_cache_lookups_total counter',
+        f'panorama_hot_cache_lookups_total{{result="hit"}} {hot["hits"]}',
+        f'panorama_hot_cache_lookups_total{{result="miss"}} {hot["misses"]}'
+    ])
+
+    budget = memory_budget.stats()
+    lines.extend([
+        '# HELP panorama_memory_budget_bytes Estimated-bytes budget for in-flight conversions',
+        '# TYPE panorama_memory_budget_bytes gauge',
+        f'panorama_memory_budget_bytes {budget["maxBytes"]}',
+        '# HELP panorama_memory_reserved_bytes Estimated bytes reserved by in-flight conversions',
+        '# TYPE panorama_memory_reserved_bytes gauge',
+        f'panorama_memory_reserved_bytes {budget["reservedBytes"]}',
+        '# HELP panorama_memory_waiting Requests queued for memory budget',
+        '# TYPE panorama_memory_waiting gauge',
+        f'panorama_memory_waiting {budget["waiting"]}',
+        '# HELP panorama_memory_rejected_total Requests turned away by the memory budget',
+        '# TYPE panorama_memory_rejected_total counter',
+        f'panorama_memory_rejected_total {budget["rejected"]}'
+    ])
+
+    with _jobs_lock:
+        job_counts = {'queued': 0, 'done': 0, 'failed': 0}
+        for job in _jobs.values():
+            job_counts[job['status']] = job_counts.get(job['status'], 0) + 1
+    lines.extend(['# HELP panorama_jobs Background jobs in the job table by status', '# TYPE panorama_jobs gauge'])
+    lines.extend(f'panorama_jobs{{status="{status}"}} {count}' for status, count in job_counts.items())
+
+    encoders = encoder_stats.snapshot()
+    lines.extend(['# HELP panorama_encoded_bytes_total Encoded output bytes by preset',
+                  '# TYPE panorama_encoded_bytes_total counter'])
+    lines.extend(f'panorama_encoded_bytes_total{{preset="{name}"}} {stats["totalBytes"]}'
+                 for name, stats in encoders.items())
+    lines.extend(['# HELP panorama_encode_seconds_total Encode time by preset',
+                  '# TYPE panorama_encode_seconds_total counter'])
+    lines.extend(f'panorama_encode_seconds_total{{preset="{name}"}} {stats["totalSeconds"]}'
+                 for name, stats in encoders.items())
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -207,8 +3504,15 @@ def health_check():
         'endpoints': {
             '/convert': 'Convert single panorama image',
             '/upload-panorama': 'Upload and convert panorama (alias for /convert)',
-            '/stitch': 'Stitch 6 photos (cubemap) into panorama',
-            '/panorama/<filename>': 'Get converted panorama'
+            '/batch': 'Convert many panoramas (files=... or archive=<zip>), streams NDJSON results',
+            '/stitch': 'Stitch 6 photos (cubemap) into panorama, returns the image (stream=1 for chunked, blend=1 to even out seams)',
+            '/panorama/<filename>': 'Get converted panorama (size=<preview>, or width/projection/format to render)',
+            '/panorama/<filename>/views': 'Render several perspective views of a panorama in one call (JSON)',
+            '/jobs/<job_id>': 'Status of a background job (submit with async=1)',
+            '/encoders': 'Output presets (preset=...) and encode stats',
+            '/metrics': 'Prometheus metrics (add ?timing=1 to any request for Server-Timing)',
+            '/ready': 'Readiness probe: 503 while warming up or draining (/health is liveness)',
+            '/panorama/<name>/tiles/config.json': 'Multires tile manifest (convert with tiles=1)'
         }
     }), 200
 
@@ -225,47 +3529,44 @@ def convert_panorama():
         return jsonify({'error': 'Invalid file'}), 400
     
     try:
-        # Read image
-        image = Image.open(file.stream).convert('RGB')
-        
+        probe_upload(file.stream)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    
+    try:
+        encoder = choose_encoder()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
         # Get custom width from request or use default
         output_width = int(request.form.get('width', 4096))
         output_width = min(output_width, 8192)  # Max 8K
         
-        # Check if already equirectangular (2:1 ratio)
-        img_array = np.array(image)
-        height, width = img_array.shape[:2]
+        # Same bytes + settings always map to the same output, so skip the work if it exists
+        upload = file.stream  # spooled part, hashed and decoded without reading it whole
+        output_filename = content_filename([upload], output_width, encoder, mode='convert')
         
-        if abs(width / height - 2.0) < 0.1:
-            # Already equirectangular, just resize
-            output_height = output_width // 2
-            equirect_image = image.resize((output_width, output_height), Image.Resampling.LANCZOS)
-        else:
-            # Convert to equirectangular
-            output_height = output_width // 2
-            equirect = py360convert.e2e(
-                img_array,
-                h=output_height,
-                w=output_width,
-                mode='bilinear'
-            )
-            equirect_image = Image.fromarray(equirect.astype('uint8'))
+        tiles = request_flag('tiles')
         
-        # Generate unique filename
-        output_filename = f"{uuid.uuid4()}.jpg"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+        if output_exists(output_filename):
+            return jsonify(cached_output_result(output_filename, output_width, tiles)), 200
         
-        # Save with high quality
-        equirect_image.save(output_path, 'JPEG', quality=95, optimize=True)
+        if wants_async():
+            projection = open_classified(upload, output_width)[1]
+            return submit_output_job('convert', run_convert_job, output_filename,
+                                     {'file': upload}, projection.source_size(output_width),
+                                     output_width, tiles, encoder.name, projection)
         
-        return jsonify({
-            'success': True,
-            'filename': output_filename,
-            'url': f'/panorama/{output_filename}',
-            'width': equirect_image.width,
-            'height': equirect_image.height
-        }), 200
+        # Read, convert and save image
+        result = convert_and_store(upload, output_filename, output_width, encoder, tiles)
+        
+        response = output_result(output_filename, result['width'], result['height'], result['projection'],
+                                 False, result.get('tilesUrl'))
+        return jsonify(response), 200
         
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -280,38 +3581,87 @@ def stitch_panorama():
         if face not in request.files:
             return jsonify({'error': f'Missing {face} image'}), 400
     
+    # Reject unusable faces from their headers before decoding any of them
     try:
-        # Load all 6 images
-        front = Image.open(request.files['front'].stream).convert('RGB')
-        back = Image.open(request.files['back'].stream).convert('RGB')
-        left = Image.open(request.files['left'].stream).convert('RGB')
-        right = Image.open(request.files['right'].stream).convert('RGB')
-        top = Image.open(request.files['top'].stream).convert('RGB')
-        bottom = Image.open(request.files['bottom'].stream).convert('RGB')
+        validate_uploads({face: request.files[face] for face in required_faces}, 'face')
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    
+    try:
+        encoder = choose_encoder(negotiate=True)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        # Optional seam blending (gain compensation + feathered edges), part of the output name
+        blend = request_flag('blend')
+        
+        if wants_async():
+            output_width = min(int(request.form.get('width', 4096)), 8192)
+            face_uploads = {face: request.files[face].stream for face in required_faces}
+            output_filename = content_filename(
+                [face_uploads[face] for face in CUBEMAP_FACES], output_width, encoder,
+                mode='stitch-blend' if blend else 'stitch'
+            )
+            if output_exists(output_filename):
+                response = cached_output_result(output_filename, output_width, projection=STITCH_PROJECTION)
+                response['status'] = 'done'
+                return jsonify(response), 200
+            return submit_output_job('stitch', run_stitch_job, output_filename,
+                                     face_uploads, stitch_face_source_size(output_width),
+                                     output_width, encoder.name, blend)
         
         # Get custom width from request or use default
         output_width = int(request.form.get('width', 4096))
         output_width = min(output_width, 8192)  # Max 8K
         
-        # Stitch into equirectangular
-        equirect_image = stitch_cubemap_to_equirectangular(
-            front, back, left, right, top, bottom, output_width
+        # Open all 6 images lazily (headers only); the stitcher decodes them, with no more
+        # pixels than the output needs, on the decode pool
+        min_size = stitch_face_source_size(output_width)
+        faces = {face: open_image(request.files[face].stream, min_size) for face in required_faces}
+        low_memory = use_low_memory(output_width)
+        reserved = memory_budget.acquire(
+            estimate_stitch_memory([img.size for img in faces.values()], output_width, low_memory, blend=blend)
         )
+        try:
+            # Stitch into equirectangular
+            equirect_image = stitch_faces(faces, output_width, low_memory, blend)
+            
+            headers = {
+                'X-Panorama-Width': str(equirect_image.width),
+                'X-Panorama-Height': str(equirect_image.height),
+                'X-Panorama-Preset': encoder.name,
+                'Access-Control-Expose-Headers': 'X-Panorama-Width, X-Panorama-Height, X-Panorama-Preset, Content-Length',
+                'Vary': 'Accept'
+            }
+            
+            if request_flag('stream'):
+                # Chunked transfer: bytes go out while the encoder is still running,
+                # and the reservation is held until the last chunk has been sent
+                response = Response(stream_encoded_image(equirect_image, encoder),
+                                    mimetype=encoder.mimetype, headers=headers)
+                release_when_done(response, reserved)
+                reserved = 0
+                return response
+            
+            # Encode once and send the buffer as-is; in low-memory mode large outputs spill to a temp file
+            if low_memory:
+                img_buffer = tempfile.SpooledTemporaryFile(max_size=LOW_MEMORY_SPOOL_BYTES)
+            else:
+                img_buffer = io.BytesIO()
+            nbytes = encode_image(equirect_image, img_buffer, encoder)
+            del equirect_image
+            img_buffer.seek(0)
+            
+            response = send_file(img_buffer, mimetype=encoder.mimetype)
+            response.headers.update(headers)
+            response.content_length = nbytes
+            return response
+        finally:
+            memory_budget.release(reserved)
         
-        # Convert image to bytes buffer
-        img_buffer = io.BytesIO()
-        equirect_image.save(img_buffer, 'JPEG', quality=95, optimize=True)
-        img_buffer.seek(0)
-        
-        # Return the image data directly
-        return jsonify({
-            'success': True,
-            'width': equirect_image.width,
-            'height': equirect_image.height,
-            'message': 'Successfully stitched 6 photos into panorama',
-            'imageData': 'binary'  # Placeholder - actual binary will be handled differently
-        }), 200
-        
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -326,40 +3676,56 @@ def stitch_panorama_base64():
         if face not in request.files:
             return jsonify({'error': f'Missing {face} image'}), 400
     
+    # Reject unusable faces from their headers before decoding any of them
+    try:
+        validate_uploads({face: request.files[face] for face in required_faces}, 'face')
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    
+    try:
+        encoder = choose_encoder()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
     try:
         import base64
         
-        # Load all 6 images
-        front = Image.open(request.files['front'].stream).convert('RGB')
-        back = Image.open(request.files['back'].stream).convert('RGB')
-        left = Image.open(request.files['left'].stream).convert('RGB')
-        right = Image.open(request.files['right'].stream).convert('RGB')
-        top = Image.open(request.files['top'].stream).convert('RGB')
-        bottom = Image.open(request.files['bottom'].stream).convert('RGB')
-        
         # Get custom width from request or use default
         output_width = int(request.form.get('width', 4096))
         output_width = min(output_width, 8192)  # Max 8K
         
-        # Stitch into equirectangular
-        equirect_image = stitch_cubemap_to_equirectangular(
-            front, back, left, right, top, bottom, output_width
-        )
-        
-        # Convert image to base64
-        img_buffer = io.BytesIO()
-        equirect_image.save(img_buffer, 'JPEG', quality=95, optimize=True)
-        img_buffer.seek(0)
-        img_base64 = base64.b64encode(img_buffer.read()).decode('utf-8')
+        # Open all 6 images lazily; the stitcher decodes them on the decode pool
+        min_size = stitch_face_source_size(output_width)
+        faces = {face: open_image(request.files[face].stream, min_size) for face in required_faces}
+        low_memory = use_low_memory(output_width)
+        # The base64 text (4/3 of the encoded size) lives in memory alongside the encoded bytes
+        blend = request_flag('blend')
+        estimate = estimate_stitch_memory([img.size for img in faces.values()], output_width, low_memory, blend=blend)
+        estimate += output_width * (output_width // 2) * ENCODED_BYTES_PER_PIXEL * 4 // 3
+        with memory_budget.reserve(estimate):
+            # Stitch into equirectangular
+            equirect_image = stitch_faces(faces, output_width, low_memory, blend)
+            width, height = equirect_image.size
+            
+            # Convert image to base64
+            img_buffer = io.BytesIO()
+            encode_image(equirect_image, img_buffer, encoder)
+            del equirect_image
+            with stage('base64'):
+                img_base64 = base64.b64encode(img_buffer.getbuffer()).decode('utf-8')
+            del img_buffer
         
         return jsonify({
             'success': True,
-            'width': equirect_image.width,
-            'height': equirect_image.height,
+            'width': width,
+            'height': height,
             'message': 'Successfully stitched 6 photos into panorama',
+            'mimeType': encoder.mimetype,
             'imageBase64': img_base64
         }), 200
         
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -376,58 +3742,246 @@ def upload_panorama():
         return jsonify({'error': 'Invalid file'}), 400
     
     try:
-        # Read image
-        image = Image.open(file.stream).convert('RGB')
-        
+        probe_upload(file.stream)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    
+    try:
+        encoder = choose_encoder()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
         # Get custom width from request or use default
         output_width = int(request.form.get('width', 4096))
         output_width = min(output_width, 8192)  # Max 8K
         
-        # Check if already equirectangular (2:1 ratio)
-        img_array = np.array(image)
-        height, width = img_array.shape[:2]
+        # Same bytes + settings always map to the same output, so skip the work if it exists
+        upload = file.stream
+        output_filename = content_filename([upload], output_width, encoder, mode='convert')
         
-        if abs(width / height - 2.0) < 0.1:
-            # Already equirectangular, just resize
-            output_height = output_width // 2
-            equirect_image = image.resize((output_width, output_height), Image.Resampling.LANCZOS)
-        else:
-            # Convert to equirectangular
-            output_height = output_width // 2
-            equirect = py360convert.e2e(
-                img_array,
-                h=output_height,
-                w=output_width,
-                mode='bilinear'
-            )
-            equirect_image = Image.fromarray(equirect.astype('uint8'))
+        tiles = request_flag('tiles')
+        
+        if output_exists(output_filename):
+            response = {
+                'success': True,
+                'filename': output_filename,
+                'url': f'/panorama/{output_filename}',
+                'dimensions': {
+                    'width': output_width,
+                    'height': output_width // 2
+                },
+                'projection': get_output_store().projection_of(output_filename),
+                'cached': True
+            }
+            response['previews'] = preview_urls(output_filename)
+            if tiles:
+                response['tilesUrl'] = ensure_tiles(output_filename)
+            return jsonify(response), 200
         
-        # Generate unique filename
-        output_filename = f"{uuid.uuid4()}.jpg"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+        if wants_async():
+            projection = open_classified(upload, output_width)[1]
+            return submit_output_job('convert', run_convert_job, output_filename,
+                                     {'file': upload}, projection.source_size(output_width),
+                                     output_width, tiles, encoder.name, projection)
         
-        # Save with high quality
-        equirect_image.save(output_path, 'JPEG', quality=95, optimize=True)
+        # Read, convert and save image
+        result = convert_and_store(upload, output_filename, output_width, encoder, tiles)
         
-        return jsonify({
+        response = {
             'success': True,
             'filename': output_filename,
             'url': f'/panorama/{output_filename}',
             'dimensions': {
-                'width': equirect_image.width,
-                'height': equirect_image.height
-            }
-        }), 200
+                'width': result['width'],
+                'height': result['height']
+            },
+            'projection': result['projection'],
+            'cached': False
+        }
+        response['previews'] = preview_urls(output_filename)
+        if tiles:
+            response['tilesUrl'] = result['tilesUrl']
+        
+        return jsonify(response), 200
         
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/panorama/<filename>', methods=['GET'])
 def get_panorama(filename):
-    """Serve the converted panorama image with CORS headers"""
+    """
+    Serve the converted panorama image with CORS headers (the most-served ones from memory),
+    a stored preview (?size=) or an on-demand render (?width=&projection=&format=, see parse_render_request).
+    Output names are content hashes, so the name doubles as a strong ETag: If-None-Match gets a 304,
+    and Range requests get 206 partial content so dropped downloads can resume.
+    """
+    try:
+        filename = secure_filename(filename)
+        extension = filename.rsplit('.', 1)[-1].lower()
+        mimetype = MIMETYPES_BY_EXTENSION.get(extension, 'image/jpeg')
+        etag = os.path.splitext(filename)[0]
+        store = get_output_store()
+        
+        served = filename
+        size = request.args.get('size')
+        render = any(name in request.args for name in RENDER_PARAMS)
+        if size:
+            # Small preview rendered alongside the panorama (size=thumb, placeholder, face, ...)
+            if size not in DERIVATIVES:
+                return jsonify({'error': f'Unknown size "{size}", expected one of: {", ".join(DERIVATIVES)}'}), 400
+            if not ensure_derivative(filename, size):
+                return jsonify({'error': 'File not found'}), 404
+            served = derivative_filename(filename, size)
+            mimetype = DERIVATIVE_ENCODER.mimetype
+            etag = f'{etag}-{size}'
+        elif render:
+            # Any other width / projection / format, rendered on first access and then stored
+            try:
+                derivative, encoder = parse_render_request(request.args)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            served = ensure_render(filename, derivative, encoder)
+            if served is None:
+                return jsonify({'error': 'File not found'}), 404
+            mimetype = encoder.mimetype
+            etag = f'{etag}-{derivative.name}-{encoder.name}'
+        else:
+            # Serve a smaller stored encoding (e.g. AVIF/WebP) when the client accepts it
+            variant = negotiate_variant(filename)
+            if variant is not None:
+                served, encoder = variant
+                mimetype = encoder.mimetype
+                etag = f'{etag}-{encoder.name}'
+        
+        entry = hot_cache.get(served)
+        if entry is None:
+            output_path = store.locate(served)
+            if output_path is None:
+                return jsonify({'error': 'File not found'}), 404
+            entry = hot_cache.admit(served, output_path)
+        store.touch(filename)
+        if served != filename:
+            store.touch(served)
+        
+        # conditional=True answers If-None-Match / If-Modified-Since / Range / If-Range
+        if entry is not None:
+            data, mtime = entry
+            response = send_file(io.BytesIO(data), mimetype=mimetype, etag=etag,
+                                 last_modified=mtime, conditional=True)
+        else:
+            response = send_file(os.path.abspath(output_path), mimetype=mimetype, etag=etag, conditional=True)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Range, If-None-Match, If-Range'
+        response.headers['Access-Control-Expose-Headers'] = 'ETag, Content-Range, Accept-Ranges, Content-Length'
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        if VARIANT_ENCODERS and not size and not render:
+            response.headers['Vary'] = 'Accept'
+        return response
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
+    except FileNotFoundError:
+        # Evicted between the store lookup and the read
+        return jsonify({'error': 'File not found'}), 404
+    except Exception as e:
+        app.logger.exception('Serving %s failed', filename)
+        return jsonify({'error': str(e)}), 500
+
+MAX_VIEWS_PER_REQUEST = int(os.environ.get('PANORAMA_MAX_VIEWS', 32))
+
+@app.route('/panorama/<filename>/views', methods=['POST'])
+def render_views(filename):
+    """
+    Render several views of one stored panorama in one call, e.g. share cards and hotspots.
+    JSON body: {"views": [{"yaw": 30, "pitch": -10, "fov": 75, "width": 1200, "height": 630}, ...],
+    "format": "jpeg", "inline": false}. Views default to projection=perspective and take the same
+    parameters as /panorama/<filename>?projection=...; they share one decoded master and are
+    stored, so each returned url is served (and cached) like any other render.
+    With inline=true the image bytes are also returned as base64.
+    """
+    import base64
+    
+    filename = secure_filename(filename)
+    body = request.get_json(silent=True) or {}
+    views = body.get('views')
+    if not isinstance(views, list) or not views:
+        return jsonify({'error': 'Provide a non-empty "views" list'}), 400
+    if len(views) > MAX_VIEWS_PER_REQUEST:
+        return jsonify({'error': f'At most {MAX_VIEWS_PER_REQUEST} views per request'}), 400
+    
+    # Validate every view before rendering any
+    parsed = []
+    for i, view in enumerate(views):
+        if not isinstance(view, dict):
+            return jsonify({'error': f'View {i} must be an object'}), 400
+        args = {'projection': 'perspective', 'format': body.get('format', DEFAULT_ENCODER)}
+        args.update({key: str(value) for key, value in view.items()})
+        try:
+            parsed.append(parse_render_request(args))
+        except ValueError as e:
+            return jsonify({'error': f'View {i}: {e}'}), 400
+    
+    try:
+        store = get_output_store()
+        if not store.exists(filename):
+            return jsonify({'error': 'File not found'}), 404
+        
+        results = []
+        for derivative, encoder in parsed:
+            served = ensure_render(filename, derivative, encoder)
+            if served is None:
+                return jsonify({'error': 'File not found'}), 404
+            result = {
+                'url': render_url(filename, derivative, encoder),
+                'width': derivative.width,
+                'height': derivative.height,
+                'mimeType': encoder.mimetype
+            }
+            result.update(derivative.query())
+            if body.get('inline'):
+                with open(store.locate(served), 'rb') as f:
+                    with stage('base64'):
+                        result['imageBase64'] = base64.b64encode(f.read()).decode('utf-8')
+            results.append(result)
+        
+        response = jsonify({'success': True, 'filename': filename, 'views': results})
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response, 200
+    
+    except MemoryBudgetExceeded as e:
+        return memory_budget_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/panorama/<name>/tiles/config.json', methods=['GET'])
+def get_tile_manifest(name):
+    """Serve the multires manifest, with basePath filled in so viewers can use it as-is"""
+    tiles_dir = existing_tiles_dir(name)
+    manifest_path = os.path.join(tiles_dir or '', 'config.json')
+    if tiles_dir is None or not os.path.isfile(manifest_path):
+        return jsonify({'error': 'Tiles not found'}), 404
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    manifest['multiRes']['basePath'] = f'/panorama/{name}/tiles'
+
+    response = jsonify(manifest)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Cache-Control'] = 'public, max-age=31536000'
+    return response, 200
+
+@app.route('/panorama/<name>/tiles/<int:level>/<tile>', methods=['GET'])
+def get_tile(name, level, tile):
+    """Serve a single cube-face tile"""
     try:
+        tiles_dir = existing_tiles_dir(name)
+        if tiles_dir is None:
+            return jsonify({'error': 'Tile not found'}), 404
         response = send_file(
-            os.path.join(OUTPUT_FOLDER, filename),
+            os.path.abspath(os.path.join(tiles_dir, str(level), secure_filename(tile))),
             mimetype='image/jpeg'
         )
         response.headers['Access-Control-Allow-Origin'] = '*'
@@ -436,14 +3990,130 @@ def get_panorama(filename):
         response.headers['Cache-Control'] = 'public, max-age=31536000'
         return response
     except Exception as e:
-        return jsonify({'error': 'File not found'}), 404
+        return jsonify({'error': 'Tile not found'}), 404
+
+# ---------------------------------------------------------------------------
+# Serving
+# ---------------------------------------------------------------------------
+
+# Module settings create_app() may override; the PANORAMA_* environment sets their defaults
+APP_SETTINGS = (
+    'UPLOAD_FOLDER', 'OUTPUT_FOLDER', 'TILES_FOLDER', 'SAMPLER_THREADS', 'DECODE_THREADS', 'JOB_WORKERS',
+    'MAX_PENDING_JOBS', 'BATCH_WORKERS', 'MEMORY_BUDGET_BYTES', 'REMAP_CACHE_MAX_BYTES',
+    'MASTER_CACHE_MAX_BYTES', 'HOT_CACHE_MAX_BYTES'
+)
+# Endpoints that keep answering while the process drains (probes, metrics, job polling)
+DRAIN_EXEMPT_ENDPOINTS = {'health_check', 'readiness_check', 'metrics', 'get_job'}
+
+_warmed_up = threading.Event()
+_draining = threading.Event()
+
+def create_app(config=None):
+    """
+    App factory for WSGI servers (see panorama_wsgi.py): applies overrides of APP_SETTINGS on
+    top of the environment, creates the storage folders and warms the process up.
+    The routes live on the module-level app, so every call configures and returns that app.
+    """
+    configure(config or {})
+    for folder in (UPLOAD_FOLDER, OUTPUT_FOLDER, TILES_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+
+    warm_up()
+    return app
+
+def configure(config):
+    """Apply overrides of APP_SETTINGS to the module, app.config and the caches sized from them"""
+    config = dict(config)
+    unknown = sorted(set(config) - set(APP_SETTINGS))
+    if unknown:
+        raise ValueError(f'Unknown settings: {", ".join(unknown)}')
+    if 'OUTPUT_FOLDER' in config and 'TILES_FOLDER' not in config:
+        config['TILES_FOLDER'] = os.path.join(config['OUTPUT_FOLDER'], 'tiles')
+
+    globals().update(config)
+    app.config.update(config)
+    memory_budget.max_bytes = MEMORY_BUDGET_BYTES
+    remap_cache.max_bytes = REMAP_CACHE_MAX_BYTES
+    master_cache.max_bytes = MASTER_CACHE_MAX_BYTES
+    hot_cache.max_bytes = HOT_CACHE_MAX_BYTES
+
+def warm_up():
+    """
+    Pay the one-off startup costs before serving (with a preloading server, before the fork, so
+    every worker inherits them): Pillow's codec registry, the sampler (JIT-compiled when numba
+    is in use) and one tiny conversion and encode. Runs serially, so no threads predate a fork.
+    """
+    if _warmed_up.is_set():
+        return
+    Image.init()
+    get_output_store()
+    faces = np.zeros((6, 8, 8, 3), dtype=np.uint8)
+    equirect = apply_remap(_pad_cube_faces(faces), get_remap_table('c2e', 8, 16, 8), channels=3)
+    Image.fromarray(equirect).save(io.BytesIO(), 'JPEG')
+    _warmed_up.set()
+
+def begin_draining():
+    """Stop taking work: /ready answers 503 and new requests (see DRAIN_EXEMPT_ENDPOINTS) get 503"""
+    _draining.set()
+
+def drain(timeout=None):
+    """
+    begin_draining(), then wait up to timeout seconds for this process's background jobs and
+    shut the job and thread pools down; jobs still queued after that are cancelled (and
+    recorded as failed). Returns True when every job finished.
+    """
+    begin_draining()
+    with _jobs_lock:
+        futures = [job['future'] for job in _jobs.values()
+                   if job['status'] == 'queued' and job['future'] is not None]
+    unfinished = wait(futures, timeout).not_done if futures else set()
+    if _job_executor is not None and _job_executor_pid == os.getpid():
+        _job_executor.shutdown(wait=not unfinished, cancel_futures=True)
+    for executor in (_batch_executor, _decode_pool, _variant_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    return not unfinished
+
+@app.before_request
+def reject_while_draining():
+    if _draining.is_set() and request.endpoint not in DRAIN_EXEMPT_ENDPOINTS:
+        response = jsonify({'error': 'Server is shutting down, retry shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 200 once this process is warmed up and can take work, 503 while starting or draining"""
+    checks = {
+        'warmedUp': _warmed_up.is_set(),
+        'draining': _draining.is_set(),
+        'storageWritable': os.access(OUTPUT_FOLDER, os.W_OK)
+    }
+    ready = checks['warmedUp'] and not checks['draining'] and checks['storageWritable']
+    return jsonify({
+        'ready': ready,
+        'checks': checks,
+        'pid': os.getpid(),
+        'pendingJobs': pending_job_count(),
+        'memory': memory_budget.stats()
+    }), 200 if ready else 503
 
 if __name__ == '__main__':
     print("Panorama Conversion Service Starting...")
     print("Endpoints:")
     print("   - POST /convert - Convert single panorama")
     print("   - POST /upload-panorama - Upload and convert panorama")
+    print("   - POST /batch - Convert many panoramas, NDJSON results")
     print("   - POST /stitch - Stitch 6 photos into panorama")
-    print("   - GET /panorama/<filename> - Get panorama")
+    print("   - GET /panorama/<filename> - Get panorama (?size=<preview>, or ?width/projection/format to render)")
+    print("   - POST /panorama/<filename>/views - Render several perspective views")
+    print("   - GET /jobs/<job_id> - Background job status")
+    print("   - GET /encoders - Output presets and encode stats")
+    print("   - GET /metrics - Prometheus metrics")
+    print("   - GET /panorama/<name>/tiles/config.json - Multires tile manifest")
+    print("   - GET /panorama/<name>/tiles/<level>/<tile> - Single tile")
     print("   - GET /health - Health check")
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    print("   - GET /ready - Readiness check")
+    print("Development server; for production run panorama_wsgi.py")
+    create_app().run(debug=True, host='0.0.0.0', port=5001)
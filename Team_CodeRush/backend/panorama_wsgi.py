@@ -0,0 +1,160 @@
+"""
+Production serving for panorama_service.
+
+Builds the app with panorama_service.create_app() and sizes the server from the
+machine (or container) it runs on:
+  - worker processes: one per CPU, fewer when memory can't hold that many workers'
+    caches plus one typical conversion each
+  - threads per worker: from each worker's memory share, so requests waiting on
+    uploads or disk don't leave a CPU idle
+  - sampler, decode, job and batch pools: the CPUs split across the workers, and
+    each worker's memory budget is its share of the memory
+Any PANORAMA_* setting set in the environment wins over the derived value.
+
+The app (NumPy, Pillow, py360convert and a warm-up conversion) is loaded in the
+master before forking, so workers start ready. On SIGTERM a worker stops taking
+new work (/ready and new requests answer 503), finishes in-flight requests and
+waits for its background jobs within the graceful timeout.
+
+Usage:
+    python panorama_wsgi.py
+    python panorama_wsgi.py --print-config
+    PANORAMA_WORKERS=4 PANORAMA_BIND=127.0.0.1:8000 python panorama_wsgi.py
+    gunicorn -c panorama_wsgi.py panorama_wsgi:application
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+
+import panorama_service as ps
+
+MEMORY_HEADROOM = 0.8  # Share of memory the workers plan to use; the rest is for the OS and page cache
+MIN_THREADS = 2
+MAX_THREADS = 8
+
+def read_cgroup(path):
+    try:
+        with open(path) as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+def available_cpus():
+    """CPUs this process may run on, capped by a cgroup v2 CPU quota (e.g. docker --cpus)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = read_cgroup('/sys/fs/cgroup/cpu.max')
+    if quota and quota[0] != 'max':
+        cpus = min(cpus, max(1, int(quota[0]) // int(quota[1])))
+    return cpus
+
+def available_memory():
+    """Physical memory in bytes, capped by a cgroup (v2 or v1) memory limit"""
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        limit = read_cgroup(path)
+        if limit and limit[0] != 'max':
+            memory = min(memory, int(limit[0]))
+    return memory
+
+def tune(cpus, memory, typical_width):
+    """
+    Worker processes, threads and panorama_service settings for this machine.
+    One worker per CPU while memory holds each worker's caches plus one typical conversion;
+    threads fill what is left of a worker's memory share with more conversions.
+    """
+    per_request = ps.estimate_convert_memory((typical_width, typical_width // 2), typical_width)
+    per_worker = ps.REMAP_CACHE_MAX_BYTES + ps.MASTER_CACHE_MAX_BYTES + ps.HOT_CACHE_MAX_BYTES
+    usable = int(memory * MEMORY_HEADROOM)
+
+    workers = int(os.environ.get('PANORAMA_WORKERS', 0)) or max(1, min(cpus, usable // (per_worker + per_request)))
+    share = usable // workers
+    threads = int(os.environ.get('PANORAMA_THREADS', 0)) or max(
+        MIN_THREADS, min(MAX_THREADS, (share - per_worker) // per_request))
+
+    cpus_per_worker = max(1, cpus // workers)
+    derived = {
+        'SAMPLER_THREADS': ('PANORAMA_SAMPLER_THREADS', cpus_per_worker),
+        'DECODE_THREADS': ('PANORAMA_DECODE_THREADS', min(len(ps.CUBEMAP_FACES), cpus_per_worker)),
+        'JOB_WORKERS': ('PANORAMA_JOB_WORKERS', cpus_per_worker),
+        'MAX_PENDING_JOBS': ('PANORAMA_MAX_PENDING_JOBS', cpus_per_worker * 4),
+        'BATCH_WORKERS': ('PANORAMA_BATCH_WORKERS', cpus_per_worker),
+        'MEMORY_BUDGET_BYTES': ('PANORAMA_MEMORY_BUDGET_MB', max(share - per_worker, per_request))
+    }
+    settings = {name: value for name, (env, value) in derived.items() if env not in os.environ}
+
+    return {
+        'cpus': cpus,
+        'memoryBytes': memory,
+        'typicalWidth': typical_width,
+        'perRequestBytes': per_request,
+        'perWorkerCacheBytes': per_worker,
+        'workers': workers,
+        'threads': threads,
+        'settings': settings
+    }
+
+# ---------------------------------------------------------------------------
+# Gunicorn configuration (gunicorn -c panorama_wsgi.py panorama_wsgi:application)
+# ---------------------------------------------------------------------------
+
+tuning = tune(available_cpus(), available_memory(), int(os.environ.get('PANORAMA_TYPICAL_WIDTH', 4096)))
+
+bind = os.environ.get('PANORAMA_BIND', '0.0.0.0:5001')
+workers = tuning['workers']
+threads = tuning['threads']
+worker_class = 'gthread'
+preload_app = True  # Import and warm up once in the master, workers fork ready
+timeout = int(os.environ.get('PANORAMA_TIMEOUT', 300))  # An 8K stitch on a busy worker can take minutes
+graceful_timeout = int(os.environ.get('PANORAMA_GRACEFUL_TIMEOUT', 60))
+
+application = ps.create_app(tuning['settings'])
+
+def post_worker_init(worker):
+    """Flip the worker to draining as soon as SIGTERM arrives, before gunicorn stops its loop"""
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def drain_then_exit(signum, frame):
+        ps.begin_draining()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, drain_then_exit)
+
+def worker_exit(server, worker):
+    """In-flight requests are done; give this worker's background jobs the rest of the grace period"""
+    if not ps.drain(graceful_timeout):
+        server.log.warning('Worker %s exited with background jobs unfinished', worker.pid)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve panorama_service with gunicorn, tuned for this machine')
+    parser.add_argument('--print-config', action='store_true', help='Print the derived tuning as JSON and exit')
+    args = parser.parse_args(argv)
+
+    if args.print_config:
+        print(json.dumps(dict(tuning, bind=bind, timeout=timeout, gracefulTimeout=graceful_timeout), indent=2))
+        return 0
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print('gunicorn is required for production serving (pip install gunicorn)', file=sys.stderr)
+        return 1
+
+    class PanoramaServer(BaseApplication):
+        def load_config(self):
+            for name in ('bind', 'workers', 'threads', 'worker_class', 'preload_app',
+                         'timeout', 'graceful_timeout', 'post_worker_init', 'worker_exit'):
+                self.cfg.set(name, globals()[name])
+
+        def load(self):
+            return application
+
+    PanoramaServer().run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
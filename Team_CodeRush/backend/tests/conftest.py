@@ -0,0 +1,50 @@
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import panorama_service as ps  # noqa: E402
+
+
+def smooth_image(width, height, seed=0):
+    """Random colours upscaled smoothly, so JPEG round trips and resampling stay close to the source"""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(height // 16, 2), max(width // 16, 2), 3), dtype=np.uint8)
+    return Image.fromarray(small).resize((width, height), Image.Resampling.BILINEAR)
+
+
+def jpeg_bytes(width, height, seed=0):
+    buffer = io.BytesIO()
+    smooth_image(width, height, seed).save(buffer, 'JPEG', quality=92)
+    return buffer.getvalue()
+
+
+def cube_face_files(size=128):
+    """Multipart fields for a /stitch upload, one distinct face per field"""
+    return {face: (io.BytesIO(jpeg_bytes(size, size, seed)), f'{face}.jpg')
+            for seed, face in enumerate(ps.CUBEMAP_FACES)}
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    """panorama_service writing to a temporary output store"""
+    monkeypatch.setattr(ps, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(ps, 'OUTPUT_FOLDER', str(tmp_path / 'outputs'))
+    monkeypatch.setattr(ps, 'TILES_FOLDER', str(tmp_path / 'outputs' / 'tiles'))
+    for folder in (ps.UPLOAD_FOLDER, ps.OUTPUT_FOLDER, ps.TILES_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+    yield ps
+    # Job processes took this test's settings when they started
+    if ps._job_executor is not None:
+        ps._job_executor.shutdown(wait=True)
+        ps._job_executor = None
+
+
+@pytest.fixture
+def client(service):
+    return service.app.test_client()
@@ -0,0 +1,84 @@
+import io
+import json
+import zipfile
+
+import pytest
+
+from conftest import jpeg_bytes
+
+WIDTH = 256
+
+
+def post_batch(client, images):
+    data = {'files': [(io.BytesIO(image), f'{i}.jpg') for i, image in enumerate(images)], 'width': str(WIDTH)}
+    response = client.post('/batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return lines[:-1], lines[-1]
+
+
+@pytest.fixture
+def images():
+    return [jpeg_bytes(512, 256, seed) for seed in range(4)]
+
+
+@pytest.fixture
+def item_bytes(service, images):
+    """Memory one item reserves while it converts"""
+    size = service.open_classified(io.BytesIO(images[0]), WIDTH)[0].size
+    return service.estimate_convert_memory(size, WIDTH, service.use_low_memory(WIDTH))
+
+
+def test_items_over_budget_fail_alone(client, service, images, item_bytes, monkeypatch):
+    monkeypatch.setattr(service.memory_budget, 'max_bytes', item_bytes - 1)
+
+    results, summary = post_batch(client, images)
+    assert summary['failed'] == len(images)
+    assert all(result['status'] == 413 for result in results)
+
+
+def test_budget_reserved_one_item_at_a_time(client, service, images, item_bytes, monkeypatch):
+    # Room for one item: the others wait for it rather than the whole batch reserving up front
+    monkeypatch.setattr(service.memory_budget, 'max_bytes', item_bytes * 3 // 2)
+    rejected = service.memory_budget.rejected
+
+    results, summary = post_batch(client, images)
+    assert summary['succeeded'] == len(images), [result.get('error') for result in results]
+    assert service.memory_budget.rejected == rejected
+    assert service.memory_budget.reserved == 0
+
+
+def test_zip_members_and_bad_items(client, service):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('shoot/a.jpg', jpeg_bytes(512, 256, 7))
+        zf.writestr('shoot/broken.jpg', b'not an image')
+        zf.writestr('__MACOSX/shoot/._a.jpg', b'')
+    data = {'archive': (io.BytesIO(archive.getvalue()), 'shoot.zip'), 'width': str(WIDTH)}
+    response = client.post('/batch', data=data, content_type='multipart/form-data')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    by_name = {line['name']: line for line in lines[:-1]}
+    assert set(by_name) == {'shoot/a.jpg', 'shoot/broken.jpg'}
+    assert by_name['shoot/a.jpg']['success']
+    assert not by_name['shoot/broken.jpg']['success']
+
+
+def test_too_many_files(client, service, images, monkeypatch):
+    monkeypatch.setattr(service, 'MAX_BATCH_ITEMS', 3)
+    data = {'files': [(io.BytesIO(image), f'{i}.jpg') for i, image in enumerate(images)], 'width': str(WIDTH)}
+    response = client.post('/batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'max 3' in response.get_json()['error']
+
+
+def test_too_many_zip_members(client, service, images, monkeypatch):
+    monkeypatch.setattr(service, 'MAX_BATCH_ITEMS', 3)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zf:
+        for i, image in enumerate(images):
+            zf.writestr(f'{i}.jpg', image)
+    data = {'archive': (io.BytesIO(archive.getvalue()), 'shoot.zip'), 'width': str(WIDTH)}
+    response = client.post('/batch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'max 3' in response.get_json()['error']
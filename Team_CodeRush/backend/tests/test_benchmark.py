@@ -0,0 +1,51 @@
+import json
+
+import pytest
+
+import panorama_benchmark as bench
+
+
+@pytest.fixture
+def run(service, tmp_path):
+    """Run the harness on tiny inputs"""
+    def run(name, *args):
+        output = tmp_path / f'{name}.json'
+        code = bench.main(['--widths', '256', '--repeat', '2', '--presets', 'jpeg-fast', '--routes', '/convert',
+                           '--concurrency', '2', '--requests', '2', '--output', str(output), *args])
+        with open(output) as f:
+            return code, json.load(f)
+    return run
+
+
+def test_results_cover_stages_and_routes(run):
+    code, results = run('results', '--scenarios', 'equirect,cubemap')
+    assert code == 0
+
+    stages = {result['scenario']: result for result in results['stages']}
+    assert set(stages) == {'equirect', 'cubemap'}
+    assert {'decode', 'preprocess', 'convert', 'encode:jpeg-fast'} <= set(stages['cubemap']['stages'])
+    assert stages['equirect']['stages']['convert']['min'] <= stages['equirect']['stages']['convert']['max']
+
+    route, = results['routes']
+    assert (route['route'], route['errors'], route['requests']) == ('/convert', 0, 2)
+    assert stages['cubemap']['maxRssBytes'] >= stages['cubemap']['peakTracedBytes'] > 0
+
+
+def test_work_directory_removed(run, service, monkeypatch, tmp_path):
+    monkeypatch.setattr(bench.tempfile, 'tempdir', str(tmp_path))
+    folder = service.OUTPUT_FOLDER
+    run('results', '--scenarios', 'equirect')
+    assert service.OUTPUT_FOLDER == folder
+    assert not list(tmp_path.glob('panorama-bench-*'))
+
+
+def test_compare_flags_regressions(run, tmp_path):
+    _, baseline = run('baseline', '--scenarios', 'equirect', '--routes', '')
+    for stage in baseline['stages'][0]['stages'].values():
+        stage['median'] /= 100
+    path = tmp_path / 'baseline.json'
+    path.write_text(json.dumps(baseline))
+
+    code, results = run('current', '--scenarios', 'equirect', '--routes', '', '--compare', str(path))
+    assert code == 1
+    assert any('convert median' in regression['metric'] for regression in results['regressions'])
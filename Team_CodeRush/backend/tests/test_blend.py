@@ -0,0 +1,36 @@
+import numpy as np
+
+import panorama_service as ps
+
+
+def seam_steps(padded):
+    """Largest colour step across any cube edge"""
+    ps._fill_cube_padding(padded)
+    steps = []
+    for side in ps.CUBE_NEIGHBOURS:
+        own, neighbour = ps._edge_pixels(padded, side)
+        steps.append(np.abs(neighbour.astype(np.int32) - own).max())
+    return max(steps)
+
+
+def test_blend_evens_out_an_overexposed_face():
+    faces = np.full((6, 64, 64, 3), 120, dtype=np.uint8)
+    faces[0] = 160
+    padded = ps._pad_cube_faces(faces)
+    assert seam_steps(padded) == 40
+
+    ps.blend_cube_seams(padded)
+    means = padded[:, 1:-1, 1:-1, :3].mean(axis=(1, 2, 3))
+    assert means[0] - means[1:].max() < 10
+    # A few levels of rounding are left where two edges' bands overlap in the corners
+    assert seam_steps(padded) <= 4
+
+
+def test_blend_leaves_matching_faces_alone():
+    faces = np.empty((6, 64, 64, 3), dtype=np.uint8)
+    faces[...] = (90, 120, 150)
+    padded = ps._pad_cube_faces(faces)
+    before = padded[:, 1:-1, 1:-1].copy()
+
+    ps.blend_cube_seams(padded)
+    assert np.array_equal(padded[:, 1:-1, 1:-1], before)
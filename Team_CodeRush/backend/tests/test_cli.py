@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+from PIL import Image
+
+import panorama_cli as cli
+from conftest import jpeg_bytes
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """One panorama at the top, a cubemap shoot in a sub directory and a file that is not an image"""
+    root = tmp_path / 'in'
+    write(str(root / 'pano.jpg'), jpeg_bytes(512, 256))
+    for seed, face in enumerate(cli.ps.CUBEMAP_FACES):
+        write(str(root / 'shoot' / f'{face}.jpg'), jpeg_bytes(96, 96, seed))
+    write(str(root / 'notes.txt'), b'not a panorama')
+    return root
+
+
+def run(capsys, *args):
+    code = cli.main([*map(str, args), '--width', '256', '--workers', '1', '--json'])
+    return code, json.loads(capsys.readouterr().out)
+
+
+def test_discover(tree, tmp_path):
+    items = {item['key']: item for item in cli.discover(str(tree), str(tmp_path / 'out'), 'jpg')}
+    assert set(items) == {'pano.jpg', os.path.join('shoot', '')}
+    assert items['pano.jpg']['output'] == 'pano.jpg'
+    assert items[os.path.join('shoot', '')]['kind'] == 'stitch'
+    assert items[os.path.join('shoot', '')]['output'] == 'shoot.jpg'
+
+
+def test_converts_tree_and_resumes(tree, tmp_path, capsys):
+    out = tmp_path / 'out'
+    code, stats = run(capsys, tree, out)
+    assert code == 0
+    assert (stats['converted'], stats['failed'], stats['skipped']) == (2, 0, 0)
+    for name in ('pano.jpg', 'shoot.jpg'):
+        assert Image.open(out / name).size == (256, 128)
+
+    # Nothing changed: everything is up to date
+    code, stats = run(capsys, tree, out)
+    assert (stats['converted'], stats['skipped']) == (0, 2)
+
+    # A changed input is rendered again, the rest is skipped
+    write(str(tree / 'pano.jpg'), jpeg_bytes(512, 256, seed=9))
+    code, stats = run(capsys, tree, out)
+    assert (stats['converted'], stats['skipped']) == (1, 1)
+
+
+def test_failed_items_are_reported(tree, tmp_path, capsys):
+    write(str(tree / 'broken.jpg'), b'not a jpeg')
+    code, stats = run(capsys, tree, tmp_path / 'out')
+    assert code == 1
+    assert (stats['converted'], stats['failed']) == (2, 1)
+
+    state = cli.load_state(str(tmp_path / 'out' / cli.STATE_FILENAME))
+    assert state['broken.jpg']['status'] == 'failed'
+    assert state['pano.jpg']['status'] == 'done'
+
+
+def test_colliding_outputs_fail(tree, tmp_path, capsys):
+    Image.open(tree / 'pano.jpg').save(tree / 'pano.png')
+    write(str(tree / 'shoot.jpg'), jpeg_bytes(512, 256))
+    out = tmp_path / 'out'
+    code, stats = run(capsys, tree, out)
+    assert code == 1
+    assert (stats['converted'], stats['failed']) == (0, 4)
+    assert not (out / 'pano.jpg').exists()
+
+    state = cli.load_state(str(out / cli.STATE_FILENAME))
+    assert state['pano.png']['error'] == 'Output pano.jpg is also written by pano.jpg'
+    assert state['shoot.jpg']['status'] == 'failed'
+
+    # Renaming one of them lets both render, the shoot still collides
+    os.rename(tree / 'pano.png', tree / 'pano-2.png')
+    code, stats = run(capsys, tree, out)
+    assert (stats['converted'], stats['failed']) == (2, 2)
+    assert (out / 'pano.jpg').exists() and (out / 'pano-2.jpg').exists()
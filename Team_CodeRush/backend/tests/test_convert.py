@@ -0,0 +1,62 @@
+import io
+
+import pytest
+from PIL import JpegImagePlugin
+
+from conftest import jpeg_bytes, smooth_image
+
+
+def post_convert(client, image, width=512, **fields):
+    data = {'file': (io.BytesIO(image), 'pano.jpg'), 'width': str(width), **fields}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+@pytest.fixture
+def image():
+    return jpeg_bytes(512, 256)
+
+
+def test_repeated_upload_is_served_from_store(client, service, image):
+    first = post_convert(client, image)
+    assert first['cached'] is False
+
+    second = post_convert(client, image)
+    assert second['cached'] is True
+    assert second['filename'] == first['filename']
+    assert service.get_output_store().exists(first['filename'])
+
+
+def test_names_follow_content_and_settings(service, image):
+    name = service.content_filename([image], 512)
+    assert service.content_filename([io.BytesIO(image)], 512) == name
+    assert service.content_filename([image], 1024) != name
+    assert service.content_filename([image], 512, mode='stitch') != name
+    assert service.content_filename([jpeg_bytes(512, 256, seed=1)], 512) != name
+    # The order of the parts matters (stitch faces are hashed in a fixed order)
+    assert service.content_filename([b'a', b'b'], 512) != service.content_filename([b'b', b'a'], 512)
+
+
+def test_jpeg_decode_is_scaled_to_the_output(service):
+    large = jpeg_bytes(2048, 1024)
+    assert service.open_upload_image(io.BytesIO(large), (512, 256)).size == (512, 256)
+    # DCT scaling is in powers of two and never goes below the size asked for
+    assert service.open_upload_image(io.BytesIO(large), (600, 300)).size == (1024, 512)
+    assert service.open_upload_image(io.BytesIO(large)).size == (2048, 1024)
+
+    png = io.BytesIO()
+    smooth_image(2048, 1024).save(png, 'PNG')
+    png.seek(0)
+    assert service.open_upload_image(png, (512, 256)).size == (2048, 1024)
+
+
+def test_oversized_upload_converts_at_requested_width(client, monkeypatch):
+    requested = []
+    draft = JpegImagePlugin.JpegImageFile.draft
+    monkeypatch.setattr(JpegImagePlugin.JpegImageFile, 'draft',
+                        lambda img, mode, size, *args: requested.append(size) or draft(img, mode, size, *args))
+
+    converted = post_convert(client, jpeg_bytes(2048, 1024), width=512)
+    assert (converted['width'], converted['height']) == (512, 256)
+    assert requested and max(requested) <= (1024, 512)
@@ -0,0 +1,58 @@
+import io
+
+import pytest
+from PIL import Image
+
+import panorama_service as ps
+from conftest import cube_face_files, jpeg_bytes
+
+
+def available(name):
+    return pytest.mark.skipif(not ps.ENCODER_PRESETS[name].available, reason=f'Pillow cannot write {name}')
+
+
+def post_stitch(client, headers=None, **fields):
+    data = cube_face_files()
+    data.update(width='256', **fields)
+    return client.post('/stitch', data=data, content_type='multipart/form-data', headers=headers)
+
+
+def test_presets_and_aliases():
+    assert ps.get_encoder('JPG') is ps.ENCODER_PRESETS['jpeg']
+    assert ps.get_encoder('fast') is ps.ENCODER_PRESETS['jpeg-fast']
+    with pytest.raises(ValueError):
+        ps.get_encoder('gif')
+
+
+def test_explicit_preset_names_the_output(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '256', 'preset': 'png'}
+    converted = client.post('/convert', data=data, content_type='multipart/form-data').get_json()
+    assert converted['filename'].endswith('.png')
+
+    response = client.get(converted['url'])
+    assert response.mimetype == 'image/png'
+    assert Image.open(io.BytesIO(response.data)).format == 'PNG'
+
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'preset': 'gif'}
+    assert client.post('/convert', data=data, content_type='multipart/form-data').status_code == 400
+
+
+@available('webp')
+def test_stitch_negotiates_from_accept(client):
+    response = post_stitch(client, headers={'Accept': 'image/webp,image/*;q=0.8'})
+    assert response.mimetype == 'image/webp'
+    assert response.headers['X-Panorama-Preset'] == 'webp'
+    assert 'Accept' in response.headers['Vary']
+
+    # A wildcard doesn't count as asking for a newer format
+    assert post_stitch(client, headers={'Accept': '*/*'}).mimetype == 'image/jpeg'
+    # An explicit preset wins over the Accept header
+    response = post_stitch(client, headers={'Accept': 'image/webp'}, preset='jpeg-fast')
+    assert response.mimetype == 'image/jpeg'
+
+
+def test_encode_stats(client):
+    post_stitch(client, preset='jpeg-fast')
+    stats = client.get('/encoders').get_json()['stats']['jpeg-fast']
+    assert stats['count'] >= 1
+    assert stats['totalBytes'] > 0
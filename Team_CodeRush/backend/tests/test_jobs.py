@@ -0,0 +1,73 @@
+import io
+import time
+
+import pytest
+
+from conftest import cube_face_files, jpeg_bytes
+
+
+def wait_for_job(client, job_id, timeout=120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{job_id}').get_json()
+        if job['status'] in ('done', 'failed'):
+            return job
+        time.sleep(0.1)
+    pytest.fail(f'job {job_id} still {job["status"]} after {timeout}s')
+
+
+def test_async_convert(client, service):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '512'}
+    response = client.post('/convert?async=1', data=data, content_type='multipart/form-data')
+    assert response.status_code == 202
+    assert response.get_json()['statusUrl'] == f"/jobs/{response.get_json()['jobId']}"
+
+    job = wait_for_job(client, response.get_json()['jobId'])
+    assert job['status'] == 'done', job.get('error')
+    assert (job['width'], job['height']) == (512, 256)
+    assert service.get_output_store().exists(job['filename'])
+    assert client.get(job['url']).status_code == 200
+    # The decoded upload's shared block went with the job
+    assert not service._shared_arrays
+    assert service.memory_budget.reserved == 0
+
+
+@pytest.mark.parametrize('blend', ['0', '1'])
+def test_async_stitch(client, service, blend):
+    data = cube_face_files()
+    data.update(width='512', blend=blend)
+    response = client.post('/stitch?async=1', data=data, content_type='multipart/form-data')
+    assert response.status_code == 202
+
+    job = wait_for_job(client, response.get_json()['jobId'])
+    assert job['status'] == 'done', job.get('error')
+    assert (job['width'], job['height']) == (512, 256)
+    assert service.get_output_store().exists(job['filename'])
+
+
+def test_cached_async_stitch_matches_job_result(client):
+    data = cube_face_files()
+    data.update(width='512')
+    job_id = client.post('/stitch?async=1', data=data, content_type='multipart/form-data').get_json()['jobId']
+    job = wait_for_job(client, job_id)
+
+    data = cube_face_files()
+    data.update(width='512')
+    response = client.post('/stitch?async=1', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    cached = response.get_json()
+    assert cached['cached'] is True
+    for field in ('filename', 'url', 'width', 'height', 'projection', 'previews'):
+        assert cached[field] == job[field]
+    assert job['projection'] == 'cubemap-faces'
+
+
+def test_full_queue_is_rejected(client, service, monkeypatch):
+    monkeypatch.setattr(service, 'MAX_PENDING_JOBS', 0)
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256, seed=5)), 'pano.jpg'), 'width': '256'}
+    response = client.post('/convert?async=1', data=data, content_type='multipart/form-data')
+    assert response.status_code == 503
+
+
+def test_unknown_job(client):
+    assert client.get('/jobs/unknown').status_code == 404
@@ -0,0 +1,79 @@
+import io
+import threading
+
+import pytest
+
+from conftest import jpeg_bytes
+from test_jobs import wait_for_job
+
+
+@pytest.fixture
+def draining(service, monkeypatch):
+    """A fresh drain flag and pools, so draining doesn't outlive the test"""
+    monkeypatch.setattr(service, '_draining', threading.Event())
+    for name in ('_batch_executor', '_decode_pool', '_variant_executor'):
+        monkeypatch.setattr(service, name, None)
+    return service
+
+
+@pytest.fixture
+def settings(service, monkeypatch):
+    """Restore whatever configure() changes"""
+    for name in service.APP_SETTINGS:
+        monkeypatch.setattr(service, name, getattr(service, name))
+        monkeypatch.setitem(service.app.config, name, service.app.config.get(name))
+    for cache in (service.memory_budget, service.remap_cache, service.master_cache, service.hot_cache):
+        monkeypatch.setattr(cache, 'max_bytes', cache.max_bytes)
+    return service
+
+
+def test_ready_once_warmed_up(client, service):
+    service.warm_up()
+    response = client.get('/ready')
+    assert response.status_code == 200
+    assert response.get_json()['checks'] == {'warmedUp': True, 'draining': False, 'storageWritable': True}
+
+
+def test_draining_rejects_new_work(client, draining):
+    draining.begin_draining()
+    assert client.get('/ready').status_code == 503
+    assert client.get('/health').status_code == 200
+    assert client.get('/metrics').status_code == 200
+
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '256'}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_drain_waits_for_jobs(client, draining):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '256'}
+    job_id = client.post('/convert?async=1', data=data, content_type='multipart/form-data').get_json()['jobId']
+
+    assert draining.drain(timeout=120)
+    # Job polling stays open while draining
+    assert wait_for_job(client, job_id)['status'] == 'done'
+
+
+def test_job_status_survives_in_store(client, service):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256, seed=3)), 'pano.jpg'), 'width': '256'}
+    job_id = client.post('/convert?async=1', data=data, content_type='multipart/form-data').get_json()['jobId']
+    wait_for_job(client, job_id)
+
+    # Another worker process only has the store's copy
+    with service._jobs_lock:
+        service._jobs.clear()
+    job = client.get(f'/jobs/{job_id}').get_json()
+    assert (job['status'], job['width']) == ('done', 256)
+    assert client.get('/jobs/unknown').status_code == 404
+
+
+def test_create_app_applies_settings(settings, tmp_path):
+    app = settings.create_app({'OUTPUT_FOLDER': str(tmp_path / 'served'), 'MEMORY_BUDGET_BYTES': 64 * 1024 * 1024})
+    assert app is settings.app
+    assert settings.TILES_FOLDER == str(tmp_path / 'served' / 'tiles')
+    assert app.config['MEMORY_BUDGET_BYTES'] == settings.memory_budget.max_bytes == 64 * 1024 * 1024
+    assert (tmp_path / 'served' / 'tiles').is_dir()
+
+    with pytest.raises(ValueError):
+        settings.configure({'THREADS': 4})
@@ -0,0 +1,104 @@
+import io
+import tracemalloc
+
+import numpy as np
+import pytest
+from werkzeug.test import EnvironBuilder
+
+import panorama_service as ps
+from conftest import cube_face_files, jpeg_bytes, smooth_image
+
+
+def post_convert(client, width=512):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': str(width)}
+    return client.post('/convert', data=data, content_type='multipart/form-data')
+
+
+def test_budget_rejects_and_queues():
+    budget = ps.MemoryBudget(100)
+    with pytest.raises(ps.MemoryBudgetExceeded) as error:
+        budget.acquire(101)
+    assert error.value.status_code == 413
+
+    reserved = budget.acquire(60)
+    with pytest.raises(ps.MemoryBudgetExceeded) as error:
+        budget.acquire(60, timeout=0)
+    assert error.value.status_code == 503
+    assert budget.stats()['rejected'] == 2
+
+    budget.release(reserved)
+    with budget.reserve(100):
+        assert budget.reserved == 100
+    assert budget.reserved == 0
+
+
+def test_routes_answer_budget_errors(client, service, monkeypatch):
+    monkeypatch.setattr(service.memory_budget, 'max_bytes', 1024)
+    response = post_convert(client)
+    assert response.status_code == 413
+    assert 'memory budget' in response.get_json()['error']
+
+    monkeypatch.setattr(service.memory_budget, 'max_bytes', 1 << 40)
+    monkeypatch.setattr(service.memory_budget, 'reserved', (1 << 40) - 1024)
+    monkeypatch.setattr(service, 'MEMORY_WAIT_SECONDS', 0)
+    response = post_convert(client)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_strip_sampling_matches_full_frame():
+    padded = ps._pad_equirect(np.asarray(smooth_image(256, 128)))
+    table = ps.get_remap_table('e2e', (128, 256), 256, 128)
+    strips = ps.remap_to_image(padded, table, strip_rows=24)
+    assert np.array_equal(np.asarray(strips), ps.parallel_remap(padded, table, channels=3))
+
+
+def test_sampler_estimate_covers_one_band(monkeypatch):
+    monkeypatch.setattr(ps, 'SAMPLER_BACKEND', 'numpy')
+    padded = ps._pad_equirect(np.asarray(smooth_image(1024, 512)))
+    table = ps.get_remap_table('e2e', (512, 1024), 1024, 512)
+    out = np.empty((ps.REMAP_BAND_ROWS, 1024, 3), dtype=np.uint8)
+
+    tracemalloc.start()
+    ps.apply_remap(padded, table, out, 0, ps.REMAP_BAND_ROWS, channels=3)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak <= ps.estimate_sampler_memory(1024, ps.REMAP_BAND_ROWS)
+
+
+def test_8k_estimate_fits_the_default_budget(monkeypatch):
+    monkeypatch.setattr(ps, 'SAMPLER_BACKEND', 'numpy')
+    monkeypatch.setattr(ps, 'SAMPLER_THREADS', 64)
+    # A low-memory strip is two bands, so no more than two threads sample at once
+    band = ps.REMAP_BAND_ROWS * 8192 * ps.SAMPLER_BYTES_PER_PIXEL
+    assert ps.estimate_sampler_memory(8192, ps.LOW_MEMORY_STRIP_ROWS) == 2 * band
+    assert ps.estimate_convert_memory((8192, 4096), 8192, low_memory=True) < 2048 * 1024 * 1024
+
+    monkeypatch.setattr(ps, 'SAMPLER_BACKEND', 'numba')
+    assert ps.estimate_sampler_memory(8192, 4096) == 0
+
+
+def test_low_memory_conversion(client, service, monkeypatch):
+    monkeypatch.setattr(service, 'LOW_MEMORY_WIDTH', 0)
+    response = post_convert(client)
+    assert response.status_code == 200
+    assert (response.get_json()['width'], response.get_json()['height']) == (512, 256)
+    assert service.memory_budget.reserved == 0
+
+    # Estimates shrink when the output is sampled in strips
+    assert service.estimate_output_memory(8192, low_memory=True) < service.estimate_output_memory(8192)
+
+
+def test_streamed_stitch_releases_on_close(service):
+    # A server closes the body unread when the client is gone before the first chunk
+    # (the test client would start reading it), and mid-body when it goes later
+    for chunks_read in (0, 1):
+        data = cube_face_files()
+        data.update(width='512', preset='png')
+        environ = EnvironBuilder('/stitch?stream=1', method='POST', data=data).get_environ()
+        body = service.app.wsgi_app(environ, lambda status, headers: None)
+        assert service.memory_budget.reserved > 0
+        for _, chunk in zip(range(chunks_read), body):
+            assert chunk
+        body.close()
+        assert service.memory_budget.reserved == 0
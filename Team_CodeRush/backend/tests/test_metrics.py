@@ -0,0 +1,58 @@
+import io
+import re
+import time
+
+from conftest import cube_face_files, jpeg_bytes
+
+
+def metric_value(text, name, **labels):
+    """Value of one sample in Prometheus text output, or None"""
+    for line in text.splitlines():
+        match = re.match(rf'{name}(?:{{(.*)}})? (\S+)$', line)
+        if match and all(f'{key}="{value}"' in (match.group(1) or '') for key, value in labels.items()):
+            return float(match.group(2))
+    return None
+
+
+def test_server_timing_on_request(client):
+    data = cube_face_files()
+    data['width'] = '256'
+    response = client.post('/stitch?timing=1', data=data, content_type='multipart/form-data')
+    timing = dict(part.split(';dur=') for part in response.headers['Server-Timing'].split(', '))
+    assert {'decode', 'preprocess', 'convert', 'encode', 'total'} <= set(timing)
+    assert all(float(value) >= 0 for value in timing.values())
+
+    # Only when asked for (or with PANORAMA_SERVER_TIMING=1)
+    assert 'Server-Timing' not in client.get('/health').headers
+
+
+def test_metrics_exposition(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '256'}
+    client.post('/convert', data=data, content_type='multipart/form-data')
+
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert metric_value(text, 'panorama_request_duration_seconds_count', route='/convert', status='200') >= 1
+    assert metric_value(text, 'panorama_stage_duration_seconds_count', route='/convert', stage='convert') >= 1
+    assert metric_value(text, 'panorama_remap_cache_entries') >= 1
+    assert metric_value(text, 'panorama_memory_reserved_bytes') == 0
+
+
+def test_pool_cpu_is_charged_to_the_stage(service):
+    def busy():
+        deadline = time.thread_time() + 0.05
+        while time.thread_time() < deadline:
+            pass
+
+    with service.app.test_request_context('/convert'):
+        service.start_request_metrics()
+        with service.stage('convert'):
+            service.get_sampler_pool().submit(service.charge_cpu(busy)).result()
+        service.get_decode_pool().submit(service.charge_cpu(busy, 'decode')).result()
+        pool_cpu = dict(service.g.pool_cpu)
+
+    assert pool_cpu['convert'] >= 0.05
+    assert pool_cpu['decode'] >= 0.05
+    # Outside a request there is nothing to charge
+    assert service.charge_cpu(busy) is busy
@@ -0,0 +1,104 @@
+import os
+import time
+
+import pytest
+
+import panorama_service as ps
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(ps, 'TILES_FOLDER', str(tmp_path / 'tiles'))
+    return ps.OutputStore(str(tmp_path), max_bytes=1000, derived_max_bytes=300)
+
+
+def put(store, filename, size, last_access):
+    path = store.path_for(filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    conn = store._connection()
+    with conn:
+        conn.execute('INSERT INTO outputs (filename, size, created, last_access, derived) VALUES (?, ?, ?, ?, ?)',
+                     (filename, size, last_access, last_access, ps.is_derived(filename)))
+
+
+def stored(store):
+    return {row[0] for row in store._connection().execute('SELECT filename FROM outputs')}
+
+
+def test_quota_evicts_least_recently_used(store):
+    put(store, 'old.jpg', 400, 1)
+    put(store, 'mid.jpg', 400, 2)
+    put(store, 'new.jpg', 400, 3)
+
+    store.evict()
+    assert stored(store) == {'mid.jpg', 'new.jpg'}
+    assert not store.exists('old.jpg')
+    assert store.stats()['bytes'] <= store.max_bytes
+
+
+def test_derived_outputs_evicted_before_panoramas(store):
+    put(store, 'a.jpg', 450, 1)
+    put(store, 'b.jpg', 450, 2)
+    put(store, 'b.jpg.w1024-jpeg.jpg', 150, 3)
+
+    store.evict()
+    # The render is newer, but it can be rebuilt from its panorama
+    assert stored(store) == {'a.jpg', 'b.jpg'}
+
+
+def test_derived_quota(store):
+    put(store, 'a.jpg', 200, 1)
+    for i in range(5):
+        put(store, f'a.jpg.view{i}-jpeg.jpg', 100, 10 + i)
+
+    store.evict()
+    assert store.stats()['derivedBytes'] <= store.derived_max_bytes * ps.OUTPUT_LOW_WATER
+    assert 'a.jpg' in stored(store)
+    assert 'a.jpg.view4-jpeg.jpg' in stored(store)
+
+
+def test_ttl_drops_idle_outputs(store):
+    store.ttl_seconds = 60
+    put(store, 'idle.jpg', 10, time.time() - 120)
+    put(store, 'recent.jpg', 10, time.time())
+
+    assert store.evict() == 1
+    assert stored(store) == {'recent.jpg'}
+
+
+def test_tiles_go_with_their_panorama(store):
+    put(store, 'a.jpg', 100, 1)
+    tiles_dir = ps.tiles_dir_for('a.jpg')
+    os.makedirs(os.path.join(tiles_dir, '1'))
+    store.set_tiles_size('a.jpg', 950)
+
+    # The tiles push a.jpg over the quota on their own
+    store.evict()
+    assert stored(store) == set()
+    assert not os.path.exists(tiles_dir)
+
+
+def test_index_is_rebuilt_from_disk(store, tmp_path):
+    put(store, 'a.jpg', 100, 1)
+    os.remove(store.index_path)
+
+    rebuilt = ps.OutputStore(str(tmp_path), max_bytes=1000)
+    assert stored(rebuilt) == {'a.jpg'}
+    assert rebuilt.stats()['bytes'] == 100
+
+
+def test_hot_cache_admits_on_second_request(tmp_path):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(b'x' * 100)
+    cache = ps.HotObjectCache(max_bytes=150, max_object_bytes=120, min_hits=2)
+
+    assert cache.admit('a.jpg', str(path)) is None
+    assert cache.admit('a.jpg', str(path))[0] == b'x' * 100
+    assert cache.get('a.jpg')[0] == b'x' * 100
+
+    large = tmp_path / 'large.jpg'
+    large.write_bytes(b'x' * 130)
+    cache.admit('large.jpg', str(large))
+    assert cache.admit('large.jpg', str(large)) is None
@@ -0,0 +1,52 @@
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import jpeg_bytes
+
+PREVIEW_SIZES = {'thumb': (480, 240), 'placeholder': (64, 32), 'face': (256, 256)}
+
+
+@pytest.fixture
+def converted(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(1024, 512)), 'pano.jpg'), 'width': '1024'}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_previews_are_stored_with_the_panorama(client, service, converted):
+    assert set(converted['previews']) == set(PREVIEW_SIZES)
+    store = service.get_output_store()
+    for name, size in PREVIEW_SIZES.items():
+        assert store.exists(service.derivative_filename(converted['filename'], name))
+        response = client.get(converted['previews'][name])
+        assert response.status_code == 200
+        assert response.mimetype == 'image/jpeg'
+        assert Image.open(io.BytesIO(response.data)).size == size
+        assert response.headers['ETag'].strip('"').endswith(f'-{name}')
+
+
+def test_missing_preview_is_rendered_from_the_panorama(client, service, converted):
+    store = service.get_output_store()
+    thumb = service.derivative_filename(converted['filename'], 'thumb')
+    store.remove(thumb)
+
+    response = client.get(converted['previews']['thumb'])
+    assert response.status_code == 200
+    assert Image.open(io.BytesIO(response.data)).size == PREVIEW_SIZES['thumb']
+    assert store.exists(thumb)
+
+
+def test_previews_go_with_their_panorama(client, service, converted):
+    store = service.get_output_store()
+    store.remove(converted['filename'])
+    for name in PREVIEW_SIZES:
+        assert not store.exists(service.derivative_filename(converted['filename'], name))
+    assert client.get(converted['previews']['thumb']).status_code == 404
+
+
+def test_unknown_preview_size(client, converted):
+    response = client.get(f"{converted['url']}?size=huge")
+    assert response.status_code == 400
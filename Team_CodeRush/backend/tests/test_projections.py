@@ -0,0 +1,126 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import jpeg_bytes, smooth_image
+from test_jobs import wait_for_job
+
+GPANO = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+         '<rdf:Description xmlns:GPano="http://ns.google.com/photos/1.0/panorama/" '
+         'GPano:ProjectionType="equirectangular" GPano:FullPanoWidthPixels="2000" GPano:FullPanoHeightPixels="1000" '
+         'GPano:CroppedAreaImageWidthPixels="2000" GPano:CroppedAreaImageHeightPixels="{crop_h}" '
+         'GPano:CroppedAreaLeftPixels="0" GPano:CroppedAreaTopPixels="{top}"/></rdf:RDF></x:xmpmeta>')
+
+
+def gpano_jpeg(width, height, crop_h, top):
+    buffer = io.BytesIO()
+    xmp = GPANO.format(crop_h=crop_h, top=top).encode()
+    smooth_image(width, height).save(buffer, 'JPEG', quality=92, xmp=xmp)
+    return buffer.getvalue()
+
+
+def cross_image(face=64, layout='horizontal'):
+    """Cross cubemap with textured faces on a flat background"""
+    cols, rows = (4, 3) if layout == 'horizontal' else (3, 4)
+    cross = Image.new('RGB', (cols * face, rows * face), (20, 20, 20))
+    cells = [(1, 0), (0, 1), (1, 1), (2, 1), (3, 1), (1, 2)] if layout == 'horizontal' else \
+        [(1, 0), (0, 1), (1, 1), (2, 1), (1, 2), (1, 3)]
+    for seed, (col, row) in enumerate(cells):
+        cross.paste(smooth_image(face, face, seed), (col * face, row * face))
+    return cross
+
+
+def classify(service, data):
+    return service.classify_projection(Image.open(io.BytesIO(data)))
+
+
+@pytest.mark.parametrize('size, kind', [
+    ((512, 256), 'equirect'),
+    ((600, 100), 'cubemap-horizon'),
+    ((256, 192), 'cubemap-cross'),
+    ((192, 256), 'cubemap-cross'),
+    ((300, 300), 'fisheye'),
+    ((500, 300), 'other'),
+])
+def test_classified_by_aspect(service, size, kind):
+    projection = classify(service, jpeg_bytes(*size))
+    assert (projection.kind, projection.reason) == (kind, 'aspect')
+
+
+def test_gpano_metadata_wins_over_aspect(service):
+    projection = classify(service, gpano_jpeg(400, 200, 1000, 0))
+    assert (projection.kind, projection.reason) == ('equirect', 'metadata')
+
+    projection = classify(service, gpano_jpeg(400, 60, 300, 350))
+    assert (projection.kind, projection.reason) == ('equirect-partial', 'metadata')
+    assert projection.crop == (2000, 1000, 0, 350, 2000, 300)
+
+
+def test_cross_confirmed_on_pixels(service):
+    for layout in ('horizontal', 'vertical'):
+        image = cross_image(layout=layout)
+        projection = service.refine_projection(service.classify_projection(image), image)
+        assert (projection.kind, projection.layout, projection.reason) == ('cubemap-cross', layout, 'thumbnail')
+
+    # A 4:3 photo has the aspect but no empty cells
+    photo = smooth_image(256, 192)
+    assert service.refine_projection(service.classify_projection(photo), photo).kind == 'other'
+
+
+def fisheye_image(size=256):
+    """Circular fisheye: red sky above green ground inside the circle, black corners"""
+    y, x = np.mgrid[0:size, 0:size] + 0.5 - size / 2
+    image = np.zeros((size, size, 3), dtype=np.uint8)
+    inside = np.hypot(x, y) < size / 2
+    image[inside & (y < 0)] = (200, 40, 40)
+    image[inside & (y >= 0)] = (40, 200, 40)
+    return Image.fromarray(image)
+
+
+def test_fisheye_confirmed_on_pixels(service):
+    image = fisheye_image()
+    projection = service.refine_projection(service.classify_projection(image), image)
+    assert (projection.kind, projection.reason) == ('fisheye', 'thumbnail')
+
+    # A square photo has the aspect but no dark corners
+    photo = smooth_image(256, 256)
+    assert service.refine_projection(service.classify_projection(photo), photo).kind == 'other'
+
+
+def test_fisheye_covers_the_front_hemisphere(service):
+    equirect = np.asarray(service.convert_image_to_equirect(fisheye_image(), 512))
+    assert equirect.shape == (256, 512, 3)
+    # 180 degrees around yaw 0: sky above the horizon, ground below, nothing behind
+    assert tuple(equirect[64, 256]) == (200, 40, 40)
+    assert tuple(equirect[192, 200]) == (40, 200, 40)
+    assert not equirect[:, :120].any() and not equirect[:, -120:].any()
+
+
+def test_partial_panorama_placed_on_canvas(service):
+    image = Image.open(io.BytesIO(gpano_jpeg(400, 60, 300, 350)))
+    equirect = np.asarray(service.convert_image_to_equirect(image, 512))
+    assert equirect.shape == (256, 512, 3)
+    # Rows 350..650 of 1000 scale to 90..166 of 256, everything else is left black
+    assert not equirect[:85].any() and not equirect[170:].any()
+    assert equirect[95:160].mean() > 20
+
+
+def test_cached_conversion_has_same_shape(client):
+    data = {'file': (io.BytesIO(gpano_jpeg(400, 60, 300, 350)), 'pano.jpg'), 'width': '512'}
+    fresh = client.post('/convert', data=data, content_type='multipart/form-data').get_json()
+    data = {'file': (io.BytesIO(gpano_jpeg(400, 60, 300, 350)), 'pano.jpg'), 'width': '512'}
+    cached = client.post('/convert', data=data, content_type='multipart/form-data').get_json()
+    assert fresh['projection'] == 'equirect-partial'
+    assert cached['cached'] is True
+    assert set(cached) == set(fresh) | {'cached'}
+    assert cached['projection'] == fresh['projection']
+
+
+def test_async_convert_reports_projection(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(600, 100)), 'faces.jpg'), 'width': '256'}
+    job_id = client.post('/convert?async=1', data=data, content_type='multipart/form-data').get_json()['jobId']
+    job = wait_for_job(client, job_id)
+    assert job['status'] == 'done', job.get('error')
+    assert job['projection'] == 'cubemap-horizon'
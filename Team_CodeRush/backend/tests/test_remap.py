@@ -0,0 +1,100 @@
+import numpy as np
+import py360convert
+import pytest
+
+import panorama_service as ps
+from conftest import smooth_image
+
+BACKENDS = ['numpy'] + (['numba'] if ps.numba is not None else [])
+
+
+class Entry:
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+
+def test_remap_tables_are_cached():
+    first = ps.get_remap_table('c2e', 16, 64, 32)
+    assert ps.get_remap_table('c2e', 16, 64, 32) is first
+    assert ps.get_remap_table('c2e', 16, 128, 64) is not first
+    assert not first.index.flags.writeable
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = ps.ByteLRUCache(100)
+    cache.get('a', lambda: Entry(40))
+    cache.get('b', lambda: Entry(40))
+    cache.get('a', lambda: Entry(40))  # a is now the most recent
+    cache.get('c', lambda: Entry(40))
+
+    stats = cache.stats()
+    assert (stats['entries'], stats['bytes']) == (2, 80)
+    assert (stats['hits'], stats['misses']) == (1, 3)
+    assert cache.get('b', lambda: Entry(1)).nbytes == 1  # b was evicted and rebuilt
+
+    # Too big to cache at all, but still returned
+    assert cache.get('huge', lambda: Entry(1000)).nbytes == 1000
+    assert cache.stats()['bytes'] <= 100
+
+
+def reference_bilinear(src, table, channels):
+    """Float bilinear sampling of a padded source through a RemapTable, one output pixel at a time"""
+    flat = src.reshape(-1, src.shape[-1]).astype(np.float64)
+    src_w = table.src_shape[2]
+    index = table.index.astype(np.int64)
+    wx = table.weight_x[..., None] / ps.SAMPLER_WEIGHT_ONE
+    wy = table.weight_y[..., None] / ps.SAMPLER_WEIGHT_ONE
+    top = flat[index] * (1 - wx) + flat[index + 1] * wx
+    bottom = flat[index + src_w] * (1 - wx) + flat[index + src_w + 1] * wx
+    return np.rint(top * (1 - wy) + bottom * wy)[..., :channels]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    monkeypatch.setattr(ps, 'SAMPLER_BACKEND', request.param)
+    return request.param
+
+
+def test_sampler_matches_reference(backend):
+    rng = np.random.default_rng(1)
+    faces = rng.integers(0, 256, (6, 32, 32, 3), dtype=np.uint8)
+    padded = ps._pad_cube_faces(faces)
+    table = ps.get_remap_table('c2e', 32, 128, 64)
+
+    out = ps.apply_remap(padded, table, channels=3)
+    expected = reference_bilinear(padded, table, 3)
+    assert out.shape == (64, 128, 3)
+    assert np.abs(out.astype(np.int32) - expected).max() <= 1
+
+
+def test_cubemap_to_equirect_matches_py360convert(backend):
+    faces = np.stack([np.asarray(smooth_image(64, 64, seed)) for seed in range(6)])
+    ours = ps.padded_cubemap_to_equirect(ps._pad_cube_faces(faces), 128, 256)
+    reference = py360convert.c2e(list(faces), 128, 256, mode='bilinear', cube_format='list')
+
+    diff = np.abs(ours.astype(np.int32) - np.asarray(reference).astype(np.int32))
+    assert diff.max() <= 2
+    assert diff.mean() < 0.5
+
+
+def test_equirect_to_cube_faces_matches_py360convert(backend):
+    equirect = np.asarray(smooth_image(512, 256))
+    ours = np.concatenate(ps.equirect_to_cube_faces(equirect, 64), axis=1)
+    reference = py360convert.e2c(equirect, 64, mode='bilinear', cube_format='horizon')
+
+    diff = np.abs(ours.astype(np.int32) - np.asarray(reference).astype(np.int32))
+    assert diff.max() <= 2
+    assert diff.mean() < 0.5
+
+
+def test_parallel_remap_matches_serial(backend, monkeypatch):
+    # Small bands so a small table is still split across the threads
+    monkeypatch.setattr(ps, 'REMAP_BAND_ROWS', 8)
+    equirect = np.asarray(smooth_image(256, 128))
+    padded = ps._pad_equirect(equirect)
+    table = ps.get_remap_table('e2e', (128, 256), 256, 128)
+    serial = ps.apply_remap(padded, table, channels=3)
+
+    assert np.array_equal(ps.parallel_remap(padded, table, workers=4, channels=3), serial)
+    window = ps.parallel_remap(padded, table, workers=4, row_start=20, row_stop=100, channels=3)
+    assert np.array_equal(window, serial[20:100])
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+from PIL import Image
+
+from conftest import jpeg_bytes
+
+
+@pytest.fixture
+def stored(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(1024, 512)), 'pano.jpg'), 'width': '1024'}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def get_image(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, response.get_json()
+    return response, Image.open(io.BytesIO(response.data))
+
+
+def test_renders_on_first_access_then_stored(client, service, stored):
+    response, image = get_image(client, f"{stored['url']}?width=512")
+    assert image.size == (512, 256)
+    derivative, encoder = service.parse_render_request({'width': '512'})
+    assert service.get_output_store().exists(service.render_filename(stored['filename'], derivative, encoder))
+
+    response, image = get_image(client, f"{stored['url']}?projection=face&face=right&width=128&format=png")
+    assert (image.size, image.format) == ((128, 128), 'PNG')
+
+    response, image = get_image(client, f"{stored['url']}?projection=perspective&yaw=30&fov=75&width=256&height=192")
+    assert image.size == (256, 192)
+    assert response.headers['ETag'].strip('"').endswith('-jpeg')
+
+
+def test_render_parameters_are_quantized(service):
+    first, _ = service.parse_render_request({'projection': 'perspective', 'width': '820', 'yaw': '30.2', 'fov': '73'})
+    second, _ = service.parse_render_request({'projection': 'perspective', 'width': '810', 'yaw': '29.9', 'fov': '76'})
+    assert first.name == second.name
+    # Angles wrap, so the seam has one name
+    assert service.parse_render_request({'projection': 'perspective', 'yaw': '180'})[0].name == \
+        service.parse_render_request({'projection': 'perspective', 'yaw': '-180'})[0].name
+
+
+@pytest.mark.parametrize('query', ['width=0', 'width=wide', 'projection=cylinder', 'projection=face&face=inside',
+                                   'projection=perspective&fov=179', 'format=gif'])
+def test_invalid_render_parameters(client, stored, query):
+    assert client.get(f"{stored['url']}?{query}").status_code == 400
+
+
+def test_render_of_missing_panorama(client):
+    assert client.get('/panorama/missing.jpg?width=512').status_code == 404
+
+
+def test_render_failure_is_a_server_error(client, service, stored, monkeypatch):
+    def broken_render(*args):
+        raise RuntimeError('sampler crashed')
+
+    monkeypatch.setattr(service, 'ensure_render', broken_render)
+    response = client.get(f"{stored['url']}?width=512")
+    assert response.status_code == 500
+    assert response.get_json()['error'] == 'sampler crashed'
+
+
+def test_evicted_while_serving(client, service, stored, monkeypatch):
+    def evicted(*args):
+        raise FileNotFoundError(stored['filename'])
+
+    monkeypatch.setattr(service.hot_cache, 'admit', evicted)
+    monkeypatch.setattr(service.hot_cache, 'get', lambda name: None)
+    assert client.get(stored['url']).status_code == 404
@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+from conftest import jpeg_bytes
+
+
+@pytest.fixture
+def stored(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '512'}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_etag_and_not_modified(client, stored):
+    response = client.get(stored['url'])
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert etag.strip('"') == stored['filename'].rsplit('.', 1)[0]
+
+    response = client.get(stored['url'], headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_range_request(client, stored):
+    full = client.get(stored['url']).data
+
+    response = client.get(stored['url'], headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 0-99/{len(full)}'
+    assert response.data == full[:100]
+
+    response = client.get(stored['url'], headers={'Range': f'bytes={len(full) - 10}-'})
+    assert response.status_code == 206
+    assert response.data == full[-10:]
+
+    # A range against an old ETag gets the whole (new) file instead
+    response = client.get(stored['url'], headers={'Range': 'bytes=0-99', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert response.data == full
+
+
+def test_served_from_memory_once_hot(client, service, stored):
+    first = client.get(stored['url']).data
+    client.get(stored['url'])
+    hits = service.hot_cache.stats()['hits']
+
+    response = client.get(stored['url'], headers={'Range': 'bytes=0-9'})
+    assert service.hot_cache.stats()['hits'] == hits + 1
+    assert response.status_code == 206
+    assert response.data == first[:10]
+
+
+def test_negotiated_variant(client, service, stored, monkeypatch):
+    if not service.ENCODER_PRESETS['webp'].available:
+        pytest.skip('Pillow cannot write webp')
+    monkeypatch.setattr(service, 'VARIANT_ENCODERS', ['webp'])
+    accept = {'Accept': 'image/webp,*/*'}
+
+    # The first request gets the original while the variant is encoded in the background
+    response = client.get(stored['url'], headers=accept)
+    assert response.mimetype == 'image/jpeg'
+    assert response.headers['Vary'] == 'Accept'
+    service._variant_executor.submit(lambda: None).result()
+
+    response = client.get(stored['url'], headers=accept)
+    assert response.mimetype == 'image/webp'
+    assert response.headers['ETag'].strip('"').endswith('-webp')
+    assert client.get(stored['url']).mimetype == 'image/jpeg'
@@ -0,0 +1,46 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import jpeg_bytes
+
+
+def test_attach_by_descriptor(service):
+    block = service.SharedArray.create((4, 5, 3))
+    block.array[:] = 7
+    attached = service.SharedArray.attach(block.descriptor)
+    assert np.array_equal(attached.array, np.full((4, 5, 3), 7))
+    assert not attached.array.flags.writeable
+
+    block.unlink()
+    assert not os.path.exists(block.path)
+    assert block.path not in service._shared_arrays
+
+
+def test_uploads_decode_into_shared_blocks(service):
+    uploads = {'front': jpeg_bytes(96, 64, 1), 'back': io.BytesIO(jpeg_bytes(96, 64, 2))}
+    shared, reserved = service.share_uploads(uploads)
+    try:
+        assert reserved == 2 * 96 * 64 * 3
+        assert service.memory_budget.reserved == reserved
+        expected = np.asarray(Image.open(io.BytesIO(jpeg_bytes(96, 64, 1))).convert('RGB'))
+        assert np.array_equal(service.SharedArray.attach(shared['front'].descriptor).array, expected)
+    finally:
+        service.release_shared_uploads(shared, reserved)
+    assert service.memory_budget.reserved == 0
+    assert not any(os.path.exists(block.path) for block in shared.values())
+
+
+def test_failed_decode_releases_everything(service):
+    uploads = {'front': jpeg_bytes(96, 64), 'back': jpeg_bytes(96, 64)[:200]}
+    with pytest.raises(OSError):
+        service.share_uploads(uploads)
+    assert service.memory_budget.reserved == 0
+    assert not service._shared_arrays
+
+
+def test_job_processes_are_not_forked(service):
+    assert service.job_process_context().get_start_method() in ('forkserver', 'spawn')
@@ -0,0 +1,92 @@
+import io
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import cube_face_files, smooth_image
+
+
+def post_stitch(client, query='', **fields):
+    data = cube_face_files()
+    data.update(width='512', **fields)
+    return client.post(f'/stitch{query}', data=data, content_type='multipart/form-data')
+
+
+def test_stitch_returns_the_image(client):
+    response = post_stitch(client)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert (response.headers['X-Panorama-Width'], response.headers['X-Panorama-Height']) == ('512', '256')
+    assert response.content_length == len(response.data)
+    assert Image.open(io.BytesIO(response.data)).size == (512, 256)
+
+
+def test_streamed_stitch_matches_buffered(client, service):
+    # jpeg-fast encodes with the same options whether or not it streams
+    buffered = post_stitch(client, preset='jpeg-fast').data
+
+    response = post_stitch(client, '?stream=1', preset='jpeg-fast')
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert 'Content-Length' not in response.headers
+    assert response.get_data() == buffered
+    assert service.memory_budget.reserved == 0
+
+
+def test_closing_the_stream_stops_the_encoder(service):
+    # Noise doesn't compress, so the encoder fills the chunk queue and blocks on it
+    noise = np.random.default_rng(0).integers(0, 256, (1024, 2048, 3), dtype=np.uint8)
+    threads = threading.active_count()
+    chunks = service.stream_encoded_image(Image.fromarray(noise), service.ENCODER_PRESETS['png'])
+    assert next(chunks)
+    chunks.close()
+
+    deadline = time.monotonic() + 10
+    while threading.active_count() > threads and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert threading.active_count() == threads
+
+
+def test_encoder_failure_raised_after_sent_chunks(service, monkeypatch):
+    def failing_encode(image, f, encoder, streaming=False):
+        f.write(b'partial')
+        raise OSError('encoder ran out of space')
+
+    monkeypatch.setattr(service, 'encode_image', failing_encode)
+    chunks = service.stream_encoded_image(smooth_image(64, 32), service.ENCODER_PRESETS['png'])
+    assert next(chunks) == b'partial'
+    with pytest.raises(OSError, match='out of space'):
+        next(chunks)
+
+
+def test_missing_face(client):
+    data = cube_face_files()
+    del data['top']
+    response = client.post('/stitch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert 'top' in response.get_json()['error']
+
+
+def test_fused_preprocessing_matches_two_step(service):
+    faces = {face: smooth_image(160, 128, seed) for seed, face in enumerate(service.CUBEMAP_FACES)}
+    expected = {}
+    for face, img in faces.items():
+        square = service.crop_to_center_square(img, 96)
+        if face in service.WALL_FACES:
+            square = service.adjust_perspective_distortion(square, 0.80)
+        expected[face] = np.asarray(square).astype(np.int32)
+
+    # Arrays (shared-memory uploads) take the same path as PIL images
+    faces['top'] = np.asarray(faces['top'])
+    padded = service.preprocess_cube_faces(faces, 96)
+    assert faces == {}
+    assert padded.shape == (6, 98, 98, 4)
+
+    for i, face in enumerate(service.CUBE_FACE_ORDER):
+        # One LANCZOS pass instead of two
+        diff = np.abs(padded[i, 1:-1, 1:-1, :3].astype(np.int32) - expected[face])
+        assert diff.max() <= 4, face
+        assert diff.mean() < 1, face
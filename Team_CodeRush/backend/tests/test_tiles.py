@@ -0,0 +1,51 @@
+import io
+import json
+import os
+
+from PIL import Image
+
+import panorama_service as ps
+from conftest import jpeg_bytes, smooth_image
+
+
+def test_pyramid_levels():
+    assert ps.pyramid_levels(512) == 1
+    assert ps.pyramid_levels(1024) == 2
+    assert ps.pyramid_levels(160, tile_size=64) == 3
+    # Half of 1025 rounds to exactly one tile, so no third level is needed
+    assert ps.pyramid_levels(1025) == 2
+
+
+def test_tile_pyramid_layout(service, tmp_path):
+    tiles_dir = str(tmp_path / 'pano')
+    manifest = service.generate_tile_pyramid(smooth_image(512, 256), tiles_dir, tile_size=64)
+
+    multires = manifest['multiRes']
+    assert (multires['cubeResolution'], multires['maxLevel']) == (160, 3)
+    with open(os.path.join(tiles_dir, 'config.json')) as f:
+        assert json.load(f) == manifest
+
+    # 160px faces in 64px tiles: 3x3 at full size, then 2x2 at 80px and one 40px tile
+    for level, (tiles, edge) in {3: (3, 32), 2: (2, 16), 1: (1, 40)}.items():
+        names = os.listdir(os.path.join(tiles_dir, str(level)))
+        assert len(names) == 6 * tiles * tiles
+        last = Image.open(os.path.join(tiles_dir, str(level), f'f{tiles - 1}_{tiles - 1}.jpg'))
+        assert last.size == (edge, edge)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_tiles_are_served(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(512, 256)), 'pano.jpg'), 'width': '512', 'tiles': '1'}
+    converted = client.post('/convert', data=data, content_type='multipart/form-data').get_json()
+    name = converted['filename'].rsplit('.', 1)[0]
+    assert converted['tilesUrl'] == f'/panorama/{name}/tiles/config.json'
+
+    manifest = client.get(converted['tilesUrl']).get_json()
+    assert manifest['multiRes']['basePath'] == f'/panorama/{name}/tiles'
+
+    response = client.get(f'/panorama/{name}/tiles/1/f0_0.jpg')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+
+    assert client.get('/panorama/missing/tiles/config.json').status_code == 404
+    assert client.get(f'/panorama/{name}/tiles/9/f0_0.jpg').status_code == 404
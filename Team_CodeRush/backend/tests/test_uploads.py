@@ -0,0 +1,68 @@
+import hashlib
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import cube_face_files, jpeg_bytes
+
+
+def encoded(image, fmt='PNG'):
+    buffer = io.BytesIO()
+    image.save(buffer, fmt)
+    return buffer.getvalue()
+
+
+def test_probe_accepts_and_rewinds(service):
+    stream = io.BytesIO(jpeg_bytes(512, 256))
+    assert service.probe_upload(stream) == (512, 256)
+    assert stream.tell() == 0
+
+
+@pytest.mark.parametrize('data, kind', [
+    (b'not an image', 'panorama'),
+    (encoded(Image.new('RGB', (64, 64)), 'GIF'), 'panorama'),
+    (encoded(Image.fromarray(np.zeros((64, 64), dtype=np.uint16))), 'panorama'),
+    (encoded(Image.new('RGB', (8, 8))), 'panorama'),
+    (encoded(Image.new('RGB', (200, 20))), 'panorama'),
+    (encoded(Image.new('RGB', (64, 20))), 'face'),
+], ids=['unreadable', 'gif', '16-bit', 'tiny', 'strip', 'face-aspect'])
+def test_probe_rejects(service, data, kind):
+    with pytest.raises(service.UploadError) as error:
+        service.probe_upload(data, kind)
+    assert error.value.status_code == 400
+
+
+def test_probe_rejects_oversized_images(service, monkeypatch):
+    monkeypatch.setattr(service, 'UPLOAD_MAX_PIXELS', 100 * 100)
+    with pytest.raises(service.UploadError) as error:
+        service.probe_upload(encoded(Image.new('RGB', (200, 100))))
+    assert error.value.status_code == 413
+
+
+def test_routes_reject_from_headers(client):
+    data = {'file': (io.BytesIO(b'not an image'), 'pano.jpg')}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+
+    data = cube_face_files()
+    data['left'] = (io.BytesIO(encoded(Image.new('RGB', (128, 32)))), 'left.png')
+    response = client.post('/stitch', data=data, content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith('left:')
+
+
+def test_large_parts_spool_to_disk(service, monkeypatch):
+    monkeypatch.setattr(service, 'UPLOAD_SPOOL_BYTES', 1024)
+    data = {'small': (io.BytesIO(b'x' * 100), 'a.jpg'), 'large': (io.BytesIO(b'x' * 4096), 'b.jpg')}
+    with service.app.test_request_context('/convert', method='POST', data=data):
+        files = service.request.files
+        assert not files['small'].stream._rolled
+        assert files['large'].stream._rolled
+        assert files['large'].stream.read() == b'x' * 4096
+
+
+def test_stream_digest_matches_hashlib(service):
+    data = jpeg_bytes(256, 128)
+    assert service.stream_digest(io.BytesIO(data), chunk_size=1000) == hashlib.sha256(data).digest()
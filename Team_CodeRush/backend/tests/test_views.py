@@ -0,0 +1,59 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import panorama_service as ps
+from conftest import jpeg_bytes
+
+
+@pytest.fixture
+def stored(client):
+    data = {'file': (io.BytesIO(jpeg_bytes(1024, 512)), 'pano.jpg'), 'width': '1024'}
+    response = client.post('/convert', data=data, content_type='multipart/form-data')
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def post_views(client, filename, views, **body):
+    return client.post(f'/panorama/{filename}/views', json={'views': views, **body})
+
+
+def test_views_share_one_master(client, service, stored):
+    service.master_cache.clear()
+    misses = service.master_cache.stats()['misses']
+    views = [{'yaw': 0, 'width': 320, 'height': 192}, {'yaw': 90, 'pitch': -20, 'fov': 60, 'width': 320},
+             {'projection': 'face', 'face': 'top', 'width': 256}]
+    response = post_views(client, stored['filename'], views, inline=True)
+    assert response.status_code == 200
+    results = response.get_json()['views']
+
+    # The default height (3/4 of the width) snaps to the 64px grid like any other size
+    assert [(view['width'], view['height']) for view in results] == [(320, 192), (320, 256), (256, 256)]
+    # All three sample the full-size level of the master, decoded once
+    assert service.master_cache.stats()['misses'] == misses + 1
+    for view in results:
+        inline = base64.b64decode(view['imageBase64'])
+        served = client.get(view['url'])
+        assert served.status_code == 200
+        assert served.data == inline
+        assert Image.open(io.BytesIO(inline)).size == (view['width'], view['height'])
+
+
+def test_master_level_width():
+    assert ps.master_level_width(4096, 300) == 512
+    assert ps.master_level_width(4096, 512) == 512
+    assert ps.master_level_width(4096, 513) == 1024
+    assert ps.master_level_width(4096, 8192) == 4096
+
+
+@pytest.mark.parametrize('views', [[], [1], [{'fov': 500}], 'front'])
+def test_invalid_views(client, stored, views):
+    assert post_views(client, stored['filename'], views).status_code == 400
+
+
+def test_view_limits_and_missing_panorama(client, service, stored, monkeypatch):
+    monkeypatch.setattr(service, 'MAX_VIEWS_PER_REQUEST', 1)
+    assert post_views(client, stored['filename'], [{}, {}]).status_code == 400
+    assert post_views(client, 'missing.jpg', [{}]).status_code == 404